@@ -0,0 +1,75 @@
+"""
+Activity feed
+
+Logins, note and file changes and admin actions are appended to system_logs
+by log_activity (inside the caller's transaction when it passes c, so an
+action and its log entry are committed together). Nothing is ever updated.
+
+activity_page reads the log newest first, continuing below the id of the last
+row shown (keyset pagination), so any page of the feed or of one user's
+timeline costs the same however long the log gets.
+"""
+
+from flask import request, session, has_request_context
+from database import connect, log_action
+
+ACTIVITY_PAGE_SIZE = 50
+
+ACTION_LABELS = {
+    'register': 'Registered',
+    'login': 'Logged in',
+    'login_failed': 'Failed login',
+    'logout': 'Logged out',
+    'password_reset': 'Reset password',
+    'note_created': 'Created a note',
+    'note_updated': 'Edited a note',
+    'note_deleted': 'Deleted a note',
+    'file_uploaded': 'Uploaded a file',
+    'file_deleted': 'Deleted a file',
+    'admin_granted': 'Made admin',
+    'admin_revoked': 'Removed admin',
+    'quota_changed': 'Changed quota',
+    'key_rotation': 'Rotated key',
+    'bulk_action': 'Bulk action',
+    'vault_exported': 'Exported vault',
+    'vault_imported': 'Imported vault',
+    'backup_failed': 'Backup failed',
+}
+
+def log_activity(action, details=None, user_id=None, c=None):
+    """Log an action by the current user (or user_id) with the request's address.
+    Outside a request (command line tools) pass user_id, the address is left empty"""
+    if not has_request_context():
+        log_action(user_id, action, details, None, None, c=c)
+        return
+    if user_id is None:
+        user_id = session.get('user_id')
+    log_action(user_id, action, details, request.remote_addr,
+               request.user_agent.string[:255] or None, c=c)
+
+def activity_page(user_id=None, before=None, limit=ACTIVITY_PAGE_SIZE):
+    """Up to limit events (newest first) with ids below before, for everyone
+    or one user. Returns (events, before value for the next page or None)"""
+    query = '''SELECT l.id, l.user_id, u.username, l.action, l.details, l.ip_address, l.created_at
+               FROM system_logs l LEFT JOIN users u ON u.id = l.user_id'''
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append('l.user_id = ?')
+        params.append(user_id)
+    if before:
+        conditions.append('l.id < ?')
+        params.append(before)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    conn = connect()
+    c = conn.cursor()
+    # One extra row just to find out whether there's another page
+    c.execute(query + ' ORDER BY l.id DESC LIMIT ?', params + [limit + 1])
+    events = c.fetchall()
+    conn.close()
+
+    if len(events) > limit:
+        return events[:limit], events[limit - 1][0]
+    return events, None
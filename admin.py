@@ -1,9 +1,16 @@
-import sqlite3
 from flask import Blueprint, render_template, redirect, url_for, session, flash, request
 from functools import wraps
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, Response
 from auth import login_required
-from utils import format_file_size, format_date
+from utils import format_file_size, format_date, escape_like
+from key_rotation import start_key_rotation, get_key_rotation
+from quotas import get_usage, set_user_quota
+from activity import log_activity, activity_page, ACTION_LABELS
+from live_stats import read_site_stats, event_stream, claim_stream
+from jobs import JOB_KINDS, start_job, get_job, list_jobs, cancel_job
+from fragments import cached_fragment, admin_version, bump_users_version
+from database import connect, iter_query
+from compression import stream_page
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -16,7 +23,7 @@ def admin_required(f):
             return redirect(url_for('auth.login'))
         
         # Check if user is admin
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
         c.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
         user = c.fetchone()
@@ -33,46 +40,34 @@ def admin_required(f):
 @admin_required
 def admin_dashboard():
     """Admin dashboard with system overview"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
+    version = admin_version(c)
+    conn.close()
     
-    # Get statistics
-    c.execute('SELECT COUNT(*) FROM users')
-    total_users = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*) FROM notes')
-    total_notes = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*), SUM(file_size) FROM files')
-    file_stats = c.fetchone()
-    total_files = file_stats[0]
-    total_file_size = file_stats[1] or 0
-    
-    c.execute('SELECT COUNT(*) FROM users WHERE created_at > datetime("now", "-7 days")')
-    new_users_week = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*) FROM notes WHERE created_at > datetime("now", "-7 days")')
-    new_notes_week = c.fetchone()[0]
-    
-    # Recent activity
-    c.execute('''SELECT u.username, COUNT(n.id) as note_count, MAX(n.created_at) as last_note
-                 FROM users u LEFT JOIN notes n ON u.id = n.user_id 
-                 GROUP BY u.id ORDER BY last_note DESC LIMIT 10''')
-    recent_activity = c.fetchall()
+    # Stats only change when notes, files or users do
+    overview = cached_fragment(('admin_overview', version), render_admin_overview)
+    # Newest few events, a single index read however long the log is
+    recent_activity, _ = activity_page(limit=10)
+    return render_template('admin/dashboard.html', overview=overview,
+                           recent_activity=recent_activity, action_labels=ACTION_LABELS)
+
+def render_admin_overview():
+    conn = connect()
+    c = conn.cursor()
     
+    # Counter rows kept up to date by triggers, no table scans
+    site_stats = read_site_stats(c)
     conn.close()
     
     stats = {
-        'total_users': total_users,
-        'total_notes': total_notes,
-        'total_files': total_files,
-        'total_file_size': format_file_size(total_file_size),
-        'new_users_week': new_users_week,
-        'new_notes_week': new_notes_week,
-        'recent_activity': recent_activity
+        'total_users': site_stats['users'],
+        'total_notes': site_stats['notes'],
+        'total_files': site_stats['files'],
+        'total_file_size': site_stats['storage']
     }
     
-    return render_template('admin/dashboard.html', stats=stats)
+    return render_template('admin/_overview.html', stats=stats)
 
 @admin_bp.route('/admin/users')
 @admin_required
@@ -80,56 +75,78 @@ def manage_users():
     """User management page"""
     search = request.args.get('search', '')
     page = int(request.args.get('page', 1))
-    per_page = 20
-    offset = (page - 1) * per_page
     
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
+    version = admin_version(c)
+    conn.close()
     
-    # Build query
-    base_query = '''SELECT u.id, u.username, u.created_at, u.is_admin,
-                           COUNT(DISTINCT n.id) as note_count,
-                           COUNT(DISTINCT f.id) as file_count,
-                           SUM(COALESCE(f.file_size, 0)) as total_file_size
-                    FROM users u 
-                    LEFT JOIN notes n ON u.id = n.user_id
-                    LEFT JOIN files f ON u.id = f.user_id'''
+    # Keyed by the viewing admin too, their own row has no actions
+    users_list = cached_fragment(('admin_users', session['user_id'], version, search, page),
+                                 lambda: render_users_list(search, page))
+    return render_template('admin/users.html', users_list=users_list, search=search)
+
+# Searches shorter than this match the start of usernames instead of anywhere in
+# them (trigram search needs three characters)
+MIN_SUBSTRING_SEARCH = 3
+
+def user_search_clause(c, search):
+    """WHERE clause and params matching usernames for the admin search box"""
+    if len(search) >= MIN_SUBSTRING_SEARCH:
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'")
+        if c.fetchone():
+            # Quoted so FTS5 treats the whole thing as text to find
+            return 'id IN (SELECT rowid FROM users_search WHERE users_search MATCH ?)', ['"' + search.replace('"', '""') + '"']
+        pattern = '%' + escape_like(search) + '%'
+    else:
+        pattern = escape_like(search) + '%'
+    return "username LIKE ? ESCAPE '\\'", [pattern]
+
+def render_users_list(search, page):
+    per_page = 20
+    offset = (page - 1) * per_page
     
-    where_clause = ""
-    params = []
+    conn = connect()
+    c = conn.cursor()
     
+    # One query for the page and the total. A window count is quick over search
+    # results, but over every user a plain COUNT(*) on the index is much faster
     if search:
-        where_clause = " WHERE u.username LIKE ?"
-        params.append(f'%{search}%')
-    
-    group_clause = " GROUP BY u.id ORDER BY u.created_at DESC"
-    limit_clause = f" LIMIT {per_page} OFFSET {offset}"
-    
-    full_query = base_query + where_clause + group_clause + limit_clause
-    c.execute(full_query, params)
+        where_clause, params = user_search_clause(c, search)
+        page_query = f'''SELECT id, username, created_at, is_admin, bytes_used, COUNT(*) OVER () AS total
+                         FROM users WHERE {where_clause}
+                         ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'''
+    else:
+        params = []
+        page_query = '''SELECT id, username, created_at, is_admin, bytes_used, (SELECT COUNT(*) FROM users) AS total
+                        FROM users ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'''
+    
+    # Note and file counts only for the users on this page
+    c.execute(f'''SELECT p.id, p.username, p.created_at, p.is_admin,
+                        (SELECT COUNT(*) FROM notes WHERE user_id = p.id),
+                        (SELECT COUNT(*) FROM files WHERE user_id = p.id),
+                        p.bytes_used, p.total
+                 FROM ({page_query}) p ORDER BY p.created_at DESC, p.id DESC''', params + [per_page, offset])
     users = c.fetchall()
-    
-    # Get total count
-    count_query = f"SELECT COUNT(*) FROM users u{where_clause}"
-    c.execute(count_query, params)
-    total_users = c.fetchone()[0]
+    total_users = users[0][7] if users else 0
     
     conn.close()
     
     total_pages = (total_users + per_page - 1) // per_page
     
-    return render_template('admin/users.html', 
+    return render_template('admin/_users_list.html', 
                          users=users, 
                          search=search,
                          page=page,
                          total_pages=total_pages,
-                         total_users=total_users)
+                         total_users=total_users,
+                         job_kinds=JOB_KINDS)
 
 @admin_bp.route('/admin/users/<int:user_id>')
 @admin_required
 def user_details(user_id):
     """Detailed view of a specific user"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Get user info
@@ -140,13 +157,14 @@ def user_details(user_id):
         flash('User not found', 'error')
         return redirect(url_for('admin.manage_users'))
     
-    # Get user's notes
-    c.execute('SELECT id, title, created_at, updated_at FROM notes WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-    notes = c.fetchall()
+    c.execute('SELECT COUNT(*) FROM notes WHERE user_id = ?', (user_id,))
+    note_count = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM files WHERE user_id = ?', (user_id,))
+    file_count = c.fetchone()[0]
     
-    # Get user's files
-    c.execute('SELECT id, original_filename, file_size, uploaded_at FROM files WHERE user_id = ? ORDER BY uploaded_at DESC', (user_id,))
-    files = c.fetchall()
+    c.execute('SELECT quota_bytes FROM users WHERE id = ?', (user_id,))
+    custom_quota = c.fetchone()[0]
+    bytes_used, quota_bytes = get_usage(c, user_id)
     
     conn.close()
     
@@ -155,11 +173,74 @@ def user_details(user_id):
         'username': user[1],
         'created_at': user[4],
         'is_admin': user[5] if len(user) > 5 else False,
-        'notes': notes,
-        'files': files
+        'note_count': note_count,
+        'file_count': file_count,
+        # Read as the page is streamed out rather than all up front
+        'notes': iter_query('SELECT id, title, created_at, updated_at FROM notes WHERE user_id = ? ORDER BY created_at DESC', (user_id,)),
+        'files': iter_query('SELECT id, original_filename, file_size, uploaded_at FROM files WHERE user_id = ? ORDER BY uploaded_at DESC', (user_id,)),
+        'bytes_used': bytes_used,
+        'quota_bytes': quota_bytes,
+        'custom_quota': custom_quota
     }
     
-    return render_template('admin/user_details.html', user=user_data)
+    activity, _ = activity_page(user_id=user_id, limit=10)
+    return stream_page('admin/user_details.html', user=user_data,
+                       key_rotation=get_key_rotation(user_id),
+                       activity=activity, action_labels=ACTION_LABELS)
+
+@admin_bp.route('/admin/users/<int:user_id>/rotate_key', methods=['POST'])
+@admin_required
+def rotate_key(user_id):
+    """Start re-encrypting a user's notes and files under a new key, or retry a failed rotation"""
+    previous = get_key_rotation(user_id)
+    if start_key_rotation(user_id):
+        if previous and previous['status'] == 'failed':
+            log_activity('key_rotation', f'user {user_id}, resumed')
+            flash('Key rotation resumed with the same keys.', 'success')
+        else:
+            log_activity('key_rotation', f'user {user_id}')
+            flash('Key rotation started. Data is re-encrypted in the background.', 'success')
+    else:
+        flash('A key rotation is already running for this user', 'error')
+    
+    return redirect(url_for('admin.user_details', user_id=user_id))
+
+@admin_bp.route('/admin/users/<int:user_id>/rotate_key/status')
+@admin_required
+def rotate_key_status(user_id):
+    """Progress of the latest key rotation as JSON"""
+    return jsonify(get_key_rotation(user_id) or {})
+
+@admin_bp.route('/admin/users/<int:user_id>/quota', methods=['POST'])
+@admin_required
+def update_quota(user_id):
+    """Set a user's storage quota in MB, blank for the default and 0 for no limit"""
+    quota_mb = request.form.get('quota_mb', '').strip()
+    if quota_mb:
+        try:
+            quota_bytes = int(float(quota_mb) * 1024 * 1024)
+        except ValueError:
+            flash('Quota must be a number of MB', 'error')
+            return redirect(url_for('admin.user_details', user_id=user_id))
+        if quota_bytes < 0:
+            flash('Quota must be a number of MB', 'error')
+            return redirect(url_for('admin.user_details', user_id=user_id))
+    else:
+        quota_bytes = None
+    
+    conn = connect()
+    c = conn.cursor()
+    set_user_quota(c, user_id, quota_bytes)
+    if quota_bytes is None:
+        description = 'default'
+    else:
+        description = format_file_size(quota_bytes) if quota_bytes else 'no limit'
+    log_activity('quota_changed', f'user {user_id}: {description}', c=c)
+    conn.commit()
+    conn.close()
+    
+    flash('Storage quota updated', 'success')
+    return redirect(url_for('admin.user_details', user_id=user_id))
 
 @admin_bp.route('/admin/users/<int:user_id>/toggle_admin', methods=['POST'])
 @admin_required
@@ -169,7 +250,7 @@ def toggle_admin(user_id):
         flash('Cannot modify your own admin status', 'error')
         return redirect(url_for('admin.user_details', user_id=user_id))
     
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Check if user exists
@@ -182,6 +263,8 @@ def toggle_admin(user_id):
     
     new_admin_status = not user[1]
     c.execute('UPDATE users SET is_admin = ? WHERE id = ?', (new_admin_status, user_id))
+    log_activity('admin_granted' if new_admin_status else 'admin_revoked', f'user {user[0]}', c=c)
+    bump_users_version(c)
     conn.commit()
     conn.close()
     
@@ -193,28 +276,108 @@ def toggle_admin(user_id):
 @admin_bp.route('/admin/users/<int:user_id>/delete', methods=['POST'])
 @admin_required
 def delete_user(user_id):
-    """Delete a user and all their data"""
+    """Delete a user and all their data (in the background, see jobs.py)"""
     if user_id == session['user_id']:
         flash('Cannot delete your own account', 'error')
         return redirect(url_for('admin.user_details', user_id=user_id))
     
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Get user info
     c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
     user = c.fetchone()
+    conn.close()
     
     if not user:
         flash('User not found', 'error')
         return redirect(url_for('admin.admin_dashboard'))
 
-    return render_template('view_user.html', user=user, note_count=note_count, file_count=file_count)
+    start_job('delete_users', [user_id], session['user_id'])
+    log_activity('bulk_action', f"{JOB_KINDS['delete_users']}: user {user[0]}")
+    flash(f'Deleting user {user[0]} and all their data', 'success')
+    return redirect(url_for('admin.jobs'))
+
+@admin_bp.route('/admin/users/bulk', methods=['POST'])
+@admin_required
+def bulk_action():
+    """Run an action on every selected user as a background job"""
+    action = request.form.get('action')
+    user_ids = request.form.getlist('user_ids', type=int)
+    if action not in JOB_KINDS:
+        flash('Choose an action', 'error')
+        return redirect(url_for('admin.manage_users'))
+    
+    job_id = start_job(action, user_ids, session['user_id'])
+    if not job_id:
+        flash('No users selected', 'error')
+        return redirect(url_for('admin.manage_users'))
+    
+    total = get_job(job_id)['total']
+    log_activity('bulk_action', f'{JOB_KINDS[action]}: {total} users (job {job_id})')
+    flash(f'{JOB_KINDS[action]}: started for {total} users', 'success')
+    return redirect(url_for('admin.jobs'))
+
+@admin_bp.route('/admin/events')
+@admin_required
+def admin_events():
+    """Live dashboard updates as server-sent events (see live_stats.py)"""
+    release = claim_stream()
+    if release is None:
+        # The dashboard script tries again later
+        return Response('Too many open dashboards', status=503, headers={'Retry-After': '30'})
+    response = Response(event_stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called by the server once the connection is finished with, even if it never started
+    response.call_on_close(release)
+    return response
+
+@admin_bp.route('/admin/logs')
+@admin_required
+def activity_log():
+    """Everyone's activity, or one user's with ?user=<id>, newest first"""
+    user_id = request.args.get('user', type=int)
+    before = request.args.get('before', type=int)
+    events, next_before = activity_page(user_id=user_id, before=before)
+    
+    username = None
+    if user_id is not None:
+        conn = connect()
+        c = conn.cursor()
+        c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+        row = c.fetchone()
+        conn.close()
+        username = row[0] if row else f'#{user_id}'
+    
+    return render_template('admin/logs.html', events=events, next_before=next_before,
+                           user_id=user_id, username=username, action_labels=ACTION_LABELS)
+
+@admin_bp.route('/admin/jobs')
+@admin_required
+def jobs():
+    return render_template('admin/jobs.html', jobs=list_jobs())
+
+@admin_bp.route('/admin/jobs/<int:job_id>/status')
+@admin_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@admin_bp.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+@admin_required
+def cancel(job_id):
+    if cancel_job(job_id):
+        flash('Job cancelled, anything already done stays done', 'success')
+    else:
+        flash('Job has already finished', 'error')
+    return redirect(url_for('admin.jobs'))
 
 @admin_bp.route('/stats')
 @admin_required
 def system_stats():
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     c.execute('SELECT COUNT(*) FROM users')
     total_users = c.fetchone()[0]
@@ -0,0 +1,286 @@
+from functools import wraps
+from flask import Blueprint, request, session, jsonify, url_for
+from notes import encrypt_text, decrypt_text
+from revisions import record_revision
+from auth import account_deleted
+from activity import log_activity
+from sync import record_changes, changes_since, OP_DELETE, CHANGES_PAGE_SIZE, MAX_CHANGES_PAGE_SIZE
+from database import connect
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Most items a single batch operation (create, update, delete or ids) may list,
+# which also keeps IN (...) queries under SQLite's variable limit
+MAX_BATCH_SIZE = 500
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+def api_login_required(f):
+    """Like login_required, but answers with JSON instead of redirecting"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session or account_deleted():
+            return api_error('Authentication required', 401)
+        if session.get('force_reset'):
+            return api_error('Password reset required', 403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _placeholders(values):
+    return ','.join('?' * len(values))
+
+def _parse_ids(values):
+    """List of ints from a JSON list or a comma separated query string, or None if invalid"""
+    if isinstance(values, str):
+        values = [v for v in values.split(',') if v.strip()]
+    if not isinstance(values, list) or len(values) > MAX_BATCH_SIZE:
+        return None
+    try:
+        return [int(v) for v in values]
+    except (TypeError, ValueError):
+        return None
+
+def _note_json(row, content=None):
+    note = {'id': row[0], 'title': row[1], 'created_at': row[2], 'updated_at': row[3]}
+    if content is not None:
+        note['content'] = content
+    return note
+
+@api_bp.route('/notes')
+@api_login_required
+def list_notes():
+    """Note metadata, optionally limited to ?ids=1,2,3 and with ?content=1 decrypted"""
+    include_content = request.args.get('content') == '1'
+    query = '''SELECT n.id, n.title, n.created_at, n.updated_at, n.content,
+                      u.encryption_key, u.previous_encryption_key
+               FROM notes n JOIN users u ON n.user_id = u.id
+               WHERE n.user_id = ?'''
+    params = [session['user_id']]
+
+    if 'ids' in request.args:
+        ids = _parse_ids(request.args['ids'])
+        if ids is None:
+            return api_error(f'ids must be at most {MAX_BATCH_SIZE} integers', 400)
+        if not ids:
+            return jsonify({'notes': []})
+        query += f' AND n.id IN ({_placeholders(ids)})'
+        params += ids
+
+    conn = connect()
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY n.updated_at DESC', params)
+    rows = c.fetchall()
+    conn.close()
+
+    return jsonify({'notes': [
+        _note_json(row, decrypt_text(row[4], row[5], row[6]) if include_content else None)
+        for row in rows
+    ]})
+
+@api_bp.route('/notes/<int:note_id>')
+@api_login_required
+def get_note(note_id):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT n.id, n.title, n.created_at, n.updated_at, n.content,
+                        u.encryption_key, u.previous_encryption_key
+                 FROM notes n JOIN users u ON n.user_id = u.id
+                 WHERE n.id = ? AND n.user_id = ?''', (note_id, session['user_id']))
+    row = c.fetchone()
+    conn.close()
+
+    if not row:
+        return api_error('Note not found', 404)
+    return jsonify(_note_json(row, decrypt_text(row[4], row[5], row[6])))
+
+def _validate_batch(data):
+    """Check a notes batch body, returns (create, update, delete) or an error message"""
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+
+    create = data.get('create', [])
+    update = data.get('update', [])
+    delete = _parse_ids(data.get('delete', []))
+
+    for name, items in (('create', create), ('update', update)):
+        if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+            return f'{name} must be a list of at most {MAX_BATCH_SIZE} notes'
+        for item in items:
+            if not isinstance(item, dict):
+                return f'{name} items must be objects'
+            for field in ('title', 'content'):
+                if field in item and not isinstance(item[field], str):
+                    return f'{field} must be a string'
+
+    if any('title' not in item or 'content' not in item for item in create):
+        return 'Created notes need a title and content'
+    if any(not isinstance(item.get('id'), int) for item in update):
+        return 'Updated notes need an integer id'
+    if delete is None:
+        return f'delete must be a list of at most {MAX_BATCH_SIZE} ids'
+
+    return create, update, delete
+
+@api_bp.route('/notes/batch', methods=['POST'])
+@api_login_required
+def batch_notes():
+    """Create, update and delete notes in one transaction.
+
+    Body: {"create": [{"title", "content"}], "update": [{"id", "title"?, "content"?}],
+           "delete": [id, ...]}
+    Ids that don't exist or belong to someone else are listed under "missing"."""
+    batch = _validate_batch(request.get_json(silent=True))
+    if isinstance(batch, str):
+        return api_error(batch, 400)
+    create, update, delete = batch
+    user_id = session['user_id']
+
+    conn = connect()
+    c = conn.cursor()
+    try:
+        # Updated notes are the base of their revision deltas, read them under the write lock
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('SELECT encryption_key, previous_encryption_key FROM users WHERE id = ?', (user_id,))
+        key, previous_key = c.fetchone()
+
+        created = []
+        for item in create:
+            c.execute('INSERT INTO notes (user_id, title, content) VALUES (?, ?, ?)',
+                      (user_id, item['title'], encrypt_text(item['content'], key)))
+            created.append(c.lastrowid)
+        record_changes(c, user_id, 'note', created)
+
+        # Load every note being updated in one query
+        update_ids = [item['id'] for item in update]
+        current = {}
+        if update_ids:
+            c.execute(f'''SELECT id, title, content FROM notes
+                          WHERE user_id = ? AND id IN ({_placeholders(update_ids)})''',
+                      [user_id] + update_ids)
+            current = {row[0]: (row[1], decrypt_text(row[2], key, previous_key)) for row in c.fetchall()}
+
+        updated = []
+        for item in update:
+            if item['id'] not in current:
+                continue
+            previous_title, previous_content = current[item['id']]
+            title = item.get('title', previous_title)
+            content = item.get('content', previous_content)
+            c.execute('''UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND user_id = ?''',
+                      (title, encrypt_text(content, key), item['id'], user_id))
+            record_revision(c, item['id'], user_id, title, content, key,
+                            previous_title=previous_title, previous_content=previous_content,
+                            previous_key=previous_key)
+            # A note listed twice builds on its first update
+            current[item['id']] = (title, content)
+            updated.append(item['id'])
+        record_changes(c, user_id, 'note', dict.fromkeys(updated))
+
+        deleted = []
+        if delete:
+            c.execute(f'SELECT id FROM notes WHERE user_id = ? AND id IN ({_placeholders(delete)})',
+                      [user_id] + delete)
+            deleted = [row[0] for row in c.fetchall()]
+        if deleted:
+            c.execute(f'DELETE FROM notes WHERE user_id = ? AND id IN ({_placeholders(deleted)})',
+                      [user_id] + deleted)
+            c.execute(f'DELETE FROM note_revisions WHERE user_id = ? AND note_id IN ({_placeholders(deleted)})',
+                      [user_id] + deleted)
+            record_changes(c, user_id, 'note', deleted, OP_DELETE)
+
+        # One entry per kind of change for the whole batch
+        for action, ids in (('note_created', created), ('note_updated', updated), ('note_deleted', deleted)):
+            if ids:
+                log_activity(action, f"notes {', '.join(map(str, ids))} (api batch)", c=c)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    missing = sorted(set(update_ids) - set(current)) + sorted(set(delete) - set(deleted))
+    return jsonify({'created': created, 'updated': updated, 'deleted': deleted, 'missing': missing})
+
+def _file_metadata(user_id, ids=None):
+    query = '''SELECT id, original_filename, file_size, uploaded_at, file_key IS NOT NULL
+               FROM files WHERE user_id = ?'''
+    params = [user_id]
+    if ids is not None:
+        query += f' AND id IN ({_placeholders(ids)})'
+        params += ids
+
+    conn = connect()
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY uploaded_at DESC', params)
+    rows = c.fetchall()
+    conn.close()
+
+    return [{'id': row[0], 'name': row[1], 'size': row[2], 'uploaded_at': row[3],
+             'encrypted': bool(row[4]), 'download_url': url_for('files.download_file', file_id=row[0])}
+            for row in rows]
+
+@api_bp.route('/files')
+@api_login_required
+def list_files():
+    """File metadata, optionally limited to ?ids=1,2,3"""
+    ids = None
+    if 'ids' in request.args:
+        ids = _parse_ids(request.args['ids'])
+        if ids is None:
+            return api_error(f'ids must be at most {MAX_BATCH_SIZE} integers', 400)
+        if not ids:
+            return jsonify({'files': []})
+    return jsonify({'files': _file_metadata(session['user_id'], ids)})
+
+@api_bp.route('/files/query', methods=['POST'])
+@api_login_required
+def query_files():
+    """Metadata for the files in {"ids": [...]}, for id lists too long for a URL"""
+    data = request.get_json(silent=True)
+    ids = _parse_ids(data.get('ids')) if isinstance(data, dict) else None
+    if ids is None:
+        return api_error(f'ids must be a list of at most {MAX_BATCH_SIZE} integers', 400)
+    if not ids:
+        return jsonify({'files': [], 'missing': []})
+
+    files = _file_metadata(session['user_id'], ids)
+    found = {f['id'] for f in files}
+    return jsonify({'files': files, 'missing': [i for i in ids if i not in found]})
+
+@api_bp.route('/changes')
+@api_login_required
+def list_changes():
+    """Notes and files changed since ?since=<cursor>, oldest first.
+
+    Start with since=0 for a full listing, then pass back the returned cursor.
+    Deleted items come back with "op": "delete" and no data. Add ?content=1 to
+    include decrypted note content."""
+    try:
+        cursor = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', CHANGES_PAGE_SIZE)), MAX_CHANGES_PAGE_SIZE)
+    except ValueError:
+        return api_error('since and limit must be integers', 400)
+    if cursor < 0 or limit < 1:
+        return api_error('since must be >= 0 and limit >= 1', 400)
+    include_content = request.args.get('content') == '1'
+
+    rows, next_cursor, has_more = changes_since(session['user_id'], cursor, limit)
+
+    changes = []
+    for (seq, entity, entity_id, op, title, updated_at, content,
+         filename, file_size, uploaded_at, key, previous_key) in rows:
+        change = {'seq': seq, 'type': entity, 'id': entity_id, 'op': op}
+        if op != OP_DELETE and entity == 'note' and title is not None:
+            change['note'] = {'title': title, 'updated_at': updated_at}
+            if include_content:
+                change['note']['content'] = decrypt_text(content, key, previous_key)
+        elif op != OP_DELETE and entity == 'file' and filename is not None:
+            change['file'] = {'name': filename, 'size': file_size, 'uploaded_at': uploaded_at,
+                              'download_url': url_for('files.download_file', file_id=entity_id)}
+        changes.append(change)
+
+    return jsonify({'changes': changes, 'cursor': next_cursor, 'has_more': has_more})
@@ -1,75 +1,159 @@
 from flask import Flask, render_template, session
-from auth import auth_bp, login_required
-from notes import notes_bp
-from files import files_bp
-from admin import admin_bp
-from security import security_bp, init_security_db
-from database import init_db
 import secrets
 import os
 
-app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
-
-# Configuration
-UPLOAD_FOLDER = 'uploads'
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
-
-# Ensure upload directory exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-# Register blueprints
-app.register_blueprint(auth_bp)
-app.register_blueprint(notes_bp)
-app.register_blueprint(files_bp)
-app.register_blueprint(admin_bp)
-app.register_blueprint(security_bp)
-
-# Template context processor for admin check
-@app.context_processor
-def inject_admin_status():
-    is_admin = False
-    if 'user_id' in session:
-        import sqlite3
-        conn = sqlite3.connect('secure_app.db')
-        c = conn.cursor()
-        c.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
-        user = c.fetchone()
-        conn.close()
-        is_admin = user[0] if user else False
-    
-    return dict(is_admin=is_admin)
-
-# Routes
-@app.route('/')
-def home():
-    return render_template('home.html')
-
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    return render_template('dashboard.html', username=session['username'])
+# Defaults, each can be overridden by create_app(config) or a SECUREVAULT_<NAME> env var
+DEFAULT_CONFIG = {
+    'DATABASE': 'secure_app.db',
+    'UPLOAD_FOLDER': 'uploads',
+    'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB max file size
+    'STORAGE_BACKEND': 'local',  # see storage.py for the other backends
+    'STORAGE_VOLUMES': '',
+    'STORAGE_S3_BUCKET': '',
+    'STORAGE_S3_PREFIX': '',
+    'STORAGE_S3_ENDPOINT': '',
+    'STORAGE_S3_REGION': '',
+    'USER_QUOTA_BYTES': 1024 * 1024 * 1024,  # 1GB per user unless an admin changes it, 0 = no limit
+    'TOTAL_QUOTA_BYTES': 0,  # limit for everyone together, 0 = no limit
+    'PREVIEW_FOLDER': 'previews',  # encrypted thumbnail cache, safe to delete
+    'PREVIEW_WORKERS': 2,
+    'COMPRESS_MIN_SIZE': 1024,  # smaller responses aren't worth compressing
+    'BACKUP_FOLDER': 'backups',  # see backup.py
+    'BACKUP_INTERVAL': 0,  # seconds between scheduled backups, 0 = only by hand
+    'BACKUP_KEEP': 7,  # scheduled backups kept, 0 = keep them all
+}
 
-if __name__ == '__main__':
-    init_db()
-    init_security_db()
-    #app.run(debug=True)
-    app.run(host='0.0.0.0', port=5000, debug=True)
-def dashboard():
-    return render_template('dashboard.html', username=session['username'])
+def load_secret_key(instance_path):
+    """Session key shared by every worker and kept across restarts.
+    Uses SECRET_KEY from the environment, otherwise instance/secret_key (created once)."""
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+
+    os.makedirs(instance_path, exist_ok=True)
+    key_path = os.path.join(instance_path, 'secret_key')
+    try:
+        # O_EXCL so two processes starting together can't both write a key
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(key_path) as f:
+            return f.read().strip()
+
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
+
+def create_app(config=None):
+    """Build the app. config is a dict of settings, e.g. {'DATABASE': 'test.db'}"""
+    # /static is served by assets.py, which adds the long cache lifetimes
+    app = Flask(__name__, static_folder=None)
+    app.config.update(DEFAULT_CONFIG)
+    for name in DEFAULT_CONFIG:
+        if f'SECUREVAULT_{name}' in os.environ:
+            value = os.environ[f'SECUREVAULT_{name}']
+            app.config[name] = int(value) if isinstance(DEFAULT_CONFIG[name], int) else value
+    app.config.update(config or {})
+
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = load_secret_key(app.instance_path)
+
+    from database import configure_database, connect
+    configure_database(app.config['DATABASE'])
+
+    # Ensure upload directory exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    from storage import configure_storage
+    configure_storage(app.config)
+
+    from quotas import configure_quotas
+    configure_quotas(app.config)
+
+    from previews import configure_previews
+    configure_previews(app.config)
+
+    from backup import configure_backups
+    configure_backups(app.config)
+
+    from assets import init_assets
+    init_assets(app)
+
+    # Registered before everything else so it runs after every other after_request
+    from compression import init_compression
+    init_compression(app)
+
+    # Blueprints are imported here rather than at module level so importing
+    # app.py (or a worker preloading it) doesn't pull in every view module
+    from auth import auth_bp, login_required
+    from notes import notes_bp
+    from revisions import revisions_bp
+    from files import files_bp
+    from admin import admin_bp
+    from vault_export import export_bp
+    from api import api_bp
+    from security import security_bp
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(notes_bp)
+    app.register_blueprint(revisions_bp)
+    app.register_blueprint(files_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(export_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(security_bp)
+
+    # Template context processor for admin check
+    @app.context_processor
+    def inject_admin_status():
+        is_admin = False
+        if 'user_id' in session:
+            conn = connect()
+            c = conn.cursor()
+            c.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
+            user = c.fetchone()
+            conn.close()
+            is_admin = user[0] if user else False
+
+        return dict(is_admin=is_admin)
+
+    # Routes
+    @app.route('/')
+    def home():
+        return render_template('home.html')
+
+    @app.route('/dashboard')
+    @login_required
+    def dashboard():
+        return render_template('dashboard.html', username=session['username'])
+
+    return app
+
+def start_background_workers():
+    """Start the key rotation, note migration, admin job and backup threads in
+    this process, and queue any previews that weren't made before the last shutdown.
+    Rotation, migration and jobs claim work with conditional updates, backups by
+    creating their folder and previews skip anything already cached, so running
+    one per worker is safe."""
+    from key_rotation import start_rotation_worker
+    from notes import start_note_migrator
+    from previews import queue_pending_previews
+    from jobs import start_job_worker
+    from backup import start_backup_worker
+    start_rotation_worker()
+    start_note_migrator()
+    queue_pending_previews()
+    start_job_worker()
+    start_backup_worker()
 
 if __name__ == '__main__':
+    from database import init_db
+    from security import init_security_db
+    from fragments import warm_templates
+
+    app = create_app()
     init_db()
     init_security_db()
+    warm_templates(app)
+    start_background_workers()
     #app.run(debug=True)
     app.run(host='0.0.0.0', port=5000, debug=True)
-def dashboard():
-    return render_template('dashboard.html', username=session['username'])
-
-if __name__ == '__main__':
-    init_db()
-    #app.run(debug=True)
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+Zip archive browsing
+
+When a zip is uploaded its central directory is read (only the end of the
+file has to be decrypted for that) and every entry is saved in archive_entries
+with its offset. A single entry can then be streamed out by seeking straight to
+it, without reading the rest of the archive.
+"""
+
+import zlib
+import struct
+import zipfile
+from storage import storage_for
+from file_crypto import unwrap_file_key, DecryptingReader, FileDecryptionError
+from utils import file_extension
+from database import connect
+
+ARCHIVE_EXTENSIONS = {'zip'}
+
+# Compressed bytes read at a time when extracting an entry
+EXTRACT_CHUNK_SIZE = 64 * 1024
+
+# Local file header: signature, versions/flags/method/time/date/crc/sizes, name and extra lengths
+LOCAL_HEADER = struct.Struct('<4s22xHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+class ArchiveError(Exception):
+    """Raised when an archive or one of its entries can't be read"""
+
+def is_archive(filename):
+    return file_extension(filename) in ARCHIVE_EXTENSIONS
+
+def _open_file(c, file_id):
+    """Decrypting reader over a stored file, or None if it isn't encrypted"""
+    c.execute('''SELECT f.file_path, f.storage_backend, f.file_key, u.encryption_key, u.previous_encryption_key
+                 FROM files f JOIN users u ON f.user_id = u.id WHERE f.id = ?''', (file_id,))
+    row = c.fetchone()
+    if not row or not row[2]:
+        return None
+    storage, storage_key = storage_for(row[1], row[0])
+    return DecryptingReader(storage.open_read(storage_key), unwrap_file_key(row[2], row[3], row[4]))
+
+def index_archive(file_id):
+    """Save the entries of an uploaded zip, returns how many there are.
+    Anything that isn't a readable zip gets 0 entries so it isn't tried again."""
+    conn = connect()
+    c = conn.cursor()
+    entries = []
+    try:
+        reader = _open_file(c, file_id)
+        if reader:
+            with reader, zipfile.ZipFile(reader) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    entries.append((file_id, info.filename, info.file_size, info.compress_size,
+                                    info.header_offset, info.compress_type, info.CRC, info.flag_bits,
+                                    '%04d-%02d-%02d %02d:%02d:%02d' % info.date_time))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, FileDecryptionError, ValueError, EOFError):
+        entries = []
+
+    c.execute('DELETE FROM archive_entries WHERE file_id = ?', (file_id,))
+    c.executemany('''INSERT INTO archive_entries (file_id, name, file_size, compressed_size, header_offset,
+                                                  compress_type, crc, flag_bits, modified_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', entries)
+    c.execute('UPDATE files SET archive_entry_count = ? WHERE id = ?', (len(entries), file_id))
+    conn.commit()
+    conn.close()
+    return len(entries)
+
+def _decompressor(compress_type):
+    if compress_type == zipfile.ZIP_STORED:
+        return None
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    if compress_type == zipfile.ZIP_BZIP2:
+        import bz2
+        return bz2.BZ2Decompressor()
+    raise ArchiveError('Unsupported compression method')
+
+def extract_entry(file_id, entry):
+    """Open one archive entry and return a generator of its contents.
+    entry is (file_size, header_offset, compressed_size, compress_type, crc, flag_bits).
+    Raises ArchiveError up front if the entry can't be extracted."""
+    file_size, header_offset, compressed_size, compress_type, crc, flag_bits = entry
+    if flag_bits & 0x1:
+        raise ArchiveError('Password protected files can\'t be extracted')
+    decompressor = _decompressor(compress_type)
+
+    conn = connect()
+    reader = _open_file(conn.cursor(), file_id)
+    conn.close()
+    if reader is None:
+        raise ArchiveError('Archive is not encrypted')
+
+    try:
+        reader.seek(header_offset)
+        signature, name_length, extra_length = LOCAL_HEADER.unpack(reader.read(LOCAL_HEADER.size))
+    except struct.error:
+        signature = None
+    if signature != LOCAL_HEADER_SIGNATURE:
+        reader.close()
+        raise ArchiveError('Archive is corrupt')
+    # The local header's extra field can differ from the central directory's
+    reader.seek(header_offset + LOCAL_HEADER.size + name_length + extra_length)
+    return _stream_entry(reader, compressed_size, decompressor, file_size, crc)
+
+def _inflate(decompressor, data):
+    """Decompress data in pieces of at most EXTRACT_CHUNK_SIZE, so a small
+    entry that expands hugely never has to fit in memory"""
+    if hasattr(decompressor, 'needs_input'):
+        # bz2: keep asking until it wants more input
+        yield decompressor.decompress(data, EXTRACT_CHUNK_SIZE)
+        while not decompressor.eof and not decompressor.needs_input:
+            yield decompressor.decompress(b'', EXTRACT_CHUNK_SIZE)
+    else:
+        # zlib: a full piece may mean more output is pending even without input left
+        out = decompressor.decompress(data, EXTRACT_CHUNK_SIZE)
+        yield out
+        while decompressor.unconsumed_tail or len(out) == EXTRACT_CHUNK_SIZE:
+            out = decompressor.decompress(decompressor.unconsumed_tail, EXTRACT_CHUNK_SIZE)
+            yield out
+
+def _stream_entry(reader, compressed_size, decompressor, file_size, crc):
+    with reader:
+        remaining = compressed_size
+        size = 0
+        checksum = 0
+        while remaining:
+            data = reader.read(min(EXTRACT_CHUNK_SIZE, remaining))
+            if not data:
+                raise ArchiveError('Archive is truncated')
+            remaining -= len(data)
+            try:
+                pieces = _inflate(decompressor, data) if decompressor else [data]
+                for piece in pieces:
+                    size += len(piece)
+                    # The size is in the index, anything past it is a zip bomb or corruption
+                    if size > file_size:
+                        raise ArchiveError('Archive entry is bigger than it claims to be')
+                    checksum = zlib.crc32(piece, checksum)
+                    if piece:
+                        yield piece
+            except (zlib.error, OSError, EOFError):
+                raise ArchiveError('Archive is corrupt')
+
+    if size != file_size or checksum != crc:
+        raise ArchiveError('Archive entry failed its checksum')
@@ -0,0 +1,65 @@
+"""
+Static file serving
+
+Fingerprinted copies made by build_assets.py (static/dist/) never change, so
+they're served with a one year immutable cache lifetime, and as the
+pre-compressed .br or .gz copy when the browser accepts it. Anything else in
+static/ is revalidated on every use.
+
+Templates link assets with {{ asset_url('app.css') }}, which points at the
+fingerprinted copy when there is one.
+"""
+
+import os
+import json
+import mimetypes
+from flask import url_for, send_file, request, abort
+from werkzeug.security import safe_join
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Content-Encoding of each pre-compressed copy, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, 'dist', 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def init_assets(app):
+    """Serve /static with the cache rules above and add asset_url to templates.
+    The app must be created with static_folder=None."""
+    static_folder = os.path.join(app.root_path, 'static')
+    manifest = load_manifest(static_folder)
+
+    def asset_url(name):
+        return url_for('static', filename=manifest.get(name, name))
+
+    def static(filename):
+        path = safe_join(static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        if not filename.startswith('dist/'):
+            # no-cache still lets the browser keep it, it just has to check the ETag first
+            response = send_file(path, max_age=0)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding in request.accept_encodings and os.path.isfile(path + suffix):
+                response = send_file(path + suffix, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_file(path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.add_url_rule('/static/<path:filename>', endpoint='static', view_func=static)
+    app.jinja_env.globals['asset_url'] = asset_url
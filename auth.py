@@ -1,16 +1,31 @@
 import sqlite3
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 from cryptography.fernet import Fernet
+from auth_service import begin_login, login_redirect
+from fragments import bump_users_version
+from activity import log_activity
+from database import connect
 
 auth_bp = Blueprint('auth', __name__)
 
+def account_deleted():
+    """True if the logged in user's account has been deleted, and logs them out"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM users WHERE id = ?', (session['user_id'],))
+    exists = c.fetchone()
+    conn.close()
+    if not exists:
+        session.clear()
+    return not exists
+
 # Authentication decorator
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if 'user_id' not in session or account_deleted():
             return redirect(url_for('auth.login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -25,52 +40,12 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        conn = sqlite3.connect('secure_app.db')
-        c = conn.cursor()
-        c.execute('SELECT id, username, password_hash, is_admin, force_reset FROM users WHERE username = ?', (username,))
-        user = c.fetchone()
-<<<<<<< HEAD
-        conn.close()
+        step = begin_login(username, password)
+        if step:
+            return login_redirect(step)
 
-        if user and check_password_hash(user[2], password):
-            session['user_id'] = user[0]
-            session['username'] = user[1]
-            session['is_admin'] = user[3]
-
-            if user[4] == 1:
-                session['force_reset'] = True
-                flash('You must reset your password before continuing.', 'warning')
-                return redirect(url_for('auth.reset_password'))
-
-            flash('Login successful!', 'success')
-            return redirect(url_for('dashboard'))
-=======
-        
-        if user and check_password_hash(user[1], password):
-            # Check if user has 2FA enabled
-            c.execute('SELECT is_enabled FROM user_totp WHERE user_id = ? AND is_enabled = 1', (user[0],))
-            has_2fa = c.fetchone()
-            
-            # Check if user has passkeys
-            c.execute('SELECT COUNT(*) FROM user_passkeys WHERE user_id = ?', (user[0],))
-            has_passkeys = c.fetchone()[0] > 0
-            
-            conn.close()
-            
-            if has_2fa:
-                # Require 2FA verification
-                session['pending_user_id'] = user[0]
-                return redirect(url_for('security.verify_2fa'))
-            else:
-                # Complete login directly
-                session['user_id'] = user[0]
-                session['username'] = username
-                flash('Login successful!', 'success')
-                return redirect(url_for('dashboard'))
->>>>>>> ee3fdc1 (Release v2.0.0: Admin panel v2, half created passkey and totp system, and local network actcess)
-        else:
-            conn.close()
-            flash('Invalid username or password', 'error')
+        log_activity('login_failed', f'username {username}')
+        flash('Invalid username or password', 'error')
 
     return render_template('login.html')
 
@@ -87,12 +62,14 @@ def register():
         password_hash = generate_password_hash(password)
         encryption_key = generate_key().decode()
 
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
 
         try:
             c.execute('INSERT INTO users (username, password_hash, encryption_key) VALUES (?, ?, ?)',
                       (username, password_hash, encryption_key))
+            log_activity('register', user_id=c.lastrowid, c=c)
+            bump_users_version(c)
             conn.commit()
             flash('Registration successful! Please log in and consider setting up two-factor authentication.', 'success')
             return redirect(url_for('auth.login'))
@@ -105,6 +82,8 @@ def register():
 
 @auth_bp.route('/logout')
 def logout():
+    if 'user_id' in session:
+        log_activity('logout')
     session.clear()
     flash('You have been logged out', 'info')
     return redirect(url_for('home'))
@@ -123,9 +102,10 @@ def reset_password():
 
         password_hash = generate_password_hash(new_password)
 
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
         c.execute('UPDATE users SET password_hash = ?, force_reset = 0 WHERE id = ?', (password_hash, session['user_id']))
+        log_activity('password_reset', c=c)
         conn.commit()
         conn.close()
 
@@ -0,0 +1,167 @@
+import hashlib
+import secrets
+import pyotp
+from werkzeug.security import check_password_hash
+from flask import session, redirect, url_for, flash
+from activity import log_activity
+from database import connect
+
+# Login steps
+STEP_2FA = '2fa'
+STEP_RESET = 'reset'
+STEP_DONE = 'done'
+
+# Wrong TOTP or backup codes (counted together) before the second factor is locked,
+# it unlocks LOCKOUT_MINUTES after the last counted attempt
+MAX_2FA_ATTEMPTS = 5
+LOCKOUT_MINUTES = 15
+
+# Backup codes are BACKUP_CODE_LENGTH base32 characters (5 bits each), shown in groups of 4
+BACKUP_CODE_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+BACKUP_CODE_LENGTH = 12
+
+class TooManyAttempts(Exception):
+    """Raised when a user has had too many wrong second factor codes recently"""
+
+def load_login_profile(username):
+    """Get the user row and their 2FA / passkey status in one indexed query"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT u.id, u.username, u.password_hash, u.is_admin, u.force_reset,
+                        COALESCE(t.is_enabled, 0),
+                        EXISTS(SELECT 1 FROM user_passkeys p WHERE p.user_id = u.id)
+                 FROM users u LEFT JOIN user_totp t ON t.user_id = u.id
+                 WHERE u.username = ?''', (username,))
+    row = c.fetchone()
+    conn.close()
+
+    if not row:
+        return None
+
+    return {
+        'user_id': row[0],
+        'username': row[1],
+        'password_hash': row[2],
+        'is_admin': row[3],
+        'force_reset': row[4],
+        'has_2fa': bool(row[5]),
+        'has_passkeys': bool(row[6])
+    }
+
+def generate_backup_codes(count=10):
+    """New random backup codes, formatted like ABCD-EFGH-JKLM"""
+    codes = []
+    for _ in range(count):
+        code = ''.join(secrets.choice(BACKUP_CODE_ALPHABET) for _ in range(BACKUP_CODE_LENGTH))
+        codes.append('-'.join(code[i:i + 4] for i in range(0, BACKUP_CODE_LENGTH, 4)))
+    return codes
+
+def hash_backup_code(user_id, code):
+    """Hash a backup code for storage and lookup. Dashes and spaces are ignored, so
+    codes can be typed with or without them (older 8 character hex codes still match)"""
+    normalized = ''.join(code.split()).replace('-', '').upper()
+    return hashlib.sha256(f"{user_id}:{normalized}".encode()).hexdigest()
+
+def store_backup_codes(c, user_id, backup_codes):
+    """Replace a user's backup codes with hashed entries"""
+    c.execute('DELETE FROM user_backup_codes WHERE user_id = ?', (user_id,))
+    c.executemany('INSERT INTO user_backup_codes (user_id, code_hash) VALUES (?, ?)',
+                  [(user_id, hash_backup_code(user_id, code)) for code in backup_codes])
+
+def redeem_backup_code(c, user_id, code):
+    """Mark a backup code as used, returns True if it was valid and unused"""
+    c.execute('''UPDATE user_backup_codes SET used_at = CURRENT_TIMESTAMP
+                 WHERE user_id = ? AND code_hash = ? AND used_at IS NULL''',
+              (user_id, hash_backup_code(user_id, code)))
+    return c.rowcount == 1
+
+def claim_2fa_attempt(c, user_id):
+    """Count a second factor attempt before checking it, False if the user is locked out.
+    A single conditional UPDATE, so parallel guesses can't get past the limit."""
+    window = f'-{LOCKOUT_MINUTES} minutes'
+    c.execute('''UPDATE user_totp
+                 SET failed_attempts = CASE WHEN last_failed_at < datetime('now', ?) THEN 1
+                                            ELSE failed_attempts + 1 END,
+                     last_failed_at = CURRENT_TIMESTAMP
+                 WHERE user_id = ? AND (failed_attempts < ? OR last_failed_at < datetime('now', ?))''',
+              (window, user_id, MAX_2FA_ATTEMPTS, window))
+    return c.rowcount == 1
+
+def begin_login(username, password):
+    """Password step, returns the next login step or None if the login failed"""
+    profile = load_login_profile(username)
+    if not profile or not check_password_hash(profile['password_hash'], password):
+        return None
+
+    if profile['has_2fa']:
+        # Keep what we need to finish the login so the 2FA step doesn't re-query it
+        session['pending_login'] = {
+            'user_id': profile['user_id'],
+            'username': profile['username'],
+            'is_admin': profile['is_admin'],
+            'force_reset': profile['force_reset']
+        }
+        return STEP_2FA
+
+    return complete_login(profile)
+
+def verify_second_factor(token=None, backup_code=None):
+    """2FA step, returns the next login step or None if the code was wrong.
+    Raises TooManyAttempts while the user is locked out."""
+    pending = session.get('pending_login')
+    if not pending:
+        return None
+
+    conn = connect()
+    c = conn.cursor()
+    verified = False
+
+    if not claim_2fa_attempt(c, pending['user_id']):
+        conn.commit()
+        conn.close()
+        raise TooManyAttempts(f'Too many wrong codes, try again in {LOCKOUT_MINUTES} minutes')
+
+    if token:
+        c.execute('SELECT secret FROM user_totp WHERE user_id = ? AND is_enabled = 1',
+                  (pending['user_id'],))
+        totp_data = c.fetchone()
+        verified = bool(totp_data) and pyotp.TOTP(totp_data[0]).verify(token)
+    elif backup_code:
+        # Backup codes only exist while TOTP is enabled
+        verified = redeem_backup_code(c, pending['user_id'], backup_code)
+
+    if verified:
+        c.execute('UPDATE user_totp SET failed_attempts = 0 WHERE user_id = ?', (pending['user_id'],))
+    conn.commit()
+    conn.close()
+
+    if not verified:
+        return None
+
+    return complete_login(pending)
+
+def complete_login(profile):
+    """Move a verified user into the session, returns the next login step"""
+    session.pop('pending_login', None)
+    log_activity('login', user_id=profile['user_id'])
+    session['user_id'] = profile['user_id']
+    session['username'] = profile['username']
+    session['is_admin'] = profile['is_admin']
+
+    if profile['force_reset'] == 1:
+        session['force_reset'] = True
+        return STEP_RESET
+
+    return STEP_DONE
+
+def login_redirect(step):
+    """Redirect to the page for the given login step"""
+    if step == STEP_2FA:
+        return redirect(url_for('security.verify_2fa'))
+
+    if step == STEP_RESET:
+        flash('You must reset your password before continuing.', 'warning')
+        return redirect(url_for('auth.reset_password'))
+
+    flash('Login successful!', 'success')
+    return redirect(url_for('dashboard'))
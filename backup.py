@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Backups of the database and uploaded files, taken while the app is running
+
+    python backup.py create [--to <folder>]   # one backup now (e.g. from cron)
+    python backup.py verify <backup>          # check a backup against its manifest
+    python backup.py restore <backup>         # verify, then put it back (stop the app first)
+
+Each backup is a folder named after when it was taken, holding a copy of the
+database, the uploaded files (blobs/) and manifest.json with the size and
+sha256 of everything in it. It is written as <name>.partial and renamed once
+complete, so a folder without .partial is always a whole backup.
+
+The database is copied with SQLite's online backup API a few pages at a time,
+inside one read transaction. In WAL mode that doesn't block writers, and
+everything is copied as it was when the backup started: the files rows, and
+so the blobs listed in the manifest, match the copied database exactly.
+
+Uploaded files are never changed once written (key rotation only rewraps
+files.file_key), so they are hard-linked rather than copied. A file that was
+in the previous backup is linked from there without being read again, so a
+backup only costs the files uploaded since the last one. Files on the s3
+backend aren't included (use the bucket's versioning for those), and where
+the backup folder is on another filesystem new files are copied instead.
+
+Backups run in the background every BACKUP_INTERVAL seconds when it is set
+(0, the default, means only when run by hand), keeping the newest BACKUP_KEEP
+in BACKUP_FOLDER.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+import traceback
+from datetime import datetime
+
+# Database pages copied per step, and the pause between steps so a big copy
+# doesn't hog the disk
+BACKUP_PAGES = 1024
+STEP_PAUSE = 0.01
+
+# Blob folders fan out by file id so no directory gets too big
+BLOBS_PER_FOLDER = 1000
+
+MANIFEST = 'manifest.json'
+DATABASE_NAME = 'secure_app.db'
+PARTIAL = '.partial'
+NAME_FORMAT = '%Y%m%d-%H%M%S'
+# Partial backups untouched for this long were left by a crash
+STALE_PARTIAL = 24 * 3600
+
+_folder = 'backups'
+_interval = 0
+_keep = 7
+_worker = None
+_worker_lock = threading.Lock()
+
+class BackupError(Exception):
+    """Raised when a backup can't be made, read or restored"""
+
+def configure_backups(config):
+    """Read BACKUP_FOLDER, BACKUP_INTERVAL and BACKUP_KEEP from the app config"""
+    global _folder, _interval, _keep
+    _folder = config.get('BACKUP_FOLDER') or 'backups'
+    _interval = int(config.get('BACKUP_INTERVAL') or 0)
+    _keep = int(config.get('BACKUP_KEEP') or 0)
+
+def file_sha256(path):
+    from storage import COPY_CHUNK_SIZE
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _link_or_copy(source, dest):
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    try:
+        os.link(source, dest)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # Another filesystem, or one without hard links
+        shutil.copyfile(source, dest)
+
+def _blob_path(file_id):
+    return os.path.join('blobs', str(file_id // BLOBS_PER_FOLDER), str(file_id))
+
+def list_backups(folder=None):
+    """Names of the complete backups in folder, oldest first"""
+    folder = folder or _folder
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if not name.endswith(PARTIAL) and os.path.isfile(os.path.join(folder, name, MANIFEST)))
+
+def read_manifest(backup):
+    try:
+        with open(os.path.join(backup, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise BackupError(f'{backup}: no readable manifest ({e})')
+
+def _copy_database(source, dest_path):
+    """Copy the database a step at a time into dest_path. source must already
+    be inside a read transaction, so every step reads the same snapshot and
+    commits made meanwhile don't restart the copy"""
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest, pages=BACKUP_PAGES, progress=lambda *args: time.sleep(STEP_PAUSE))
+        # One self-contained file, no -wal/-shm needed to open it
+        dest.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        dest.close()
+
+def _snapshot_blobs(rows, partial, previous, log):
+    """Link or copy each file into the backup, returns (entries, skipped ids, missing ids).
+    New files are left with sha256 None, to be hashed once the snapshot is released"""
+    from storage import LocalStorage, StorageError, storage_for
+
+    entries, skipped, missing = [], [], []
+    previous_entries = {}
+    if previous:
+        previous_entries = {entry['id']: entry for entry in read_manifest(previous)['files']}
+
+    for file_id, key, backend_name in rows:
+        try:
+            backend, key = storage_for(backend_name, key)
+        except StorageError:
+            backend = None
+        if not isinstance(backend, LocalStorage):
+            skipped.append(file_id)
+            continue
+
+        relative = _blob_path(file_id)
+        dest = os.path.join(partial, relative)
+        entry = {'id': file_id, 'backend': backend.name, 'key': key, 'path': relative}
+        try:
+            size = os.path.getsize(backend.path(key))
+            old = previous_entries.get(file_id)
+            if (old and old['backend'] == backend.name and old['key'] == key and old['size'] == size
+                    and os.path.exists(os.path.join(previous, old['path']))):
+                # Unchanged since the last backup, link that copy and trust its hash
+                _link_or_copy(os.path.join(previous, old['path']), dest)
+                entry.update(size=size, sha256=old['sha256'])
+            else:
+                _link_or_copy(backend.path(key), dest)
+                entry.update(size=size, sha256=None)
+        except FileNotFoundError:
+            # Deleted since the snapshot was taken, or already missing
+            log(f"❌ File {file_id}: {backend.name}:{key} not found")
+            missing.append(file_id)
+            continue
+        entries.append(entry)
+    return entries, skipped, missing
+
+def create_backup(folder=None, name=None, log=print):
+    """Back up the database and uploads into folder/<name>, returns its path.
+    Raises FileExistsError if that backup exists or is already being made"""
+    from database import DATABASE, connect
+
+    folder = folder or _folder
+    name = name or datetime.utcnow().strftime(NAME_FORMAT)
+    backup = os.path.join(folder, name)
+    partial = backup + PARTIAL
+    if os.path.exists(backup):
+        raise FileExistsError(backup)
+    try:
+        os.makedirs(folder, exist_ok=True)
+    except OSError as e:
+        # Not the FileExistsError below, which means someone else is on it
+        raise BackupError(f"Can't use {folder} for backups: {e}")
+    # Fails if another process is already making this one
+    os.mkdir(partial)
+
+    previous = list_backups(folder)
+    previous = os.path.join(folder, previous[-1]) if previous else None
+    started = time.time()
+    try:
+        conn = connect()
+        try:
+            # The snapshot starts with the first read and lasts until COMMIT
+            conn.execute('BEGIN')
+            rows = conn.execute('SELECT id, file_path, storage_backend FROM files ORDER BY id').fetchall()
+            # Links are quick, so do them first: less time for a file to be
+            # deleted after the snapshot and before it is linked
+            entries, skipped, missing = _snapshot_blobs(rows, partial, previous, log)
+            _copy_database(conn, os.path.join(partial, DATABASE_NAME))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        # Hashed only now: an open read transaction holds up WAL checkpoints, and the
+        # linked copies can't change anyway
+        for entry in entries:
+            if entry['sha256'] is None:
+                entry['sha256'] = file_sha256(os.path.join(partial, entry['path']))
+
+        db_path = os.path.join(partial, DATABASE_NAME)
+        manifest = {
+            'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'source': os.path.abspath(DATABASE),
+            'database': {'path': DATABASE_NAME, 'size': os.path.getsize(db_path), 'sha256': file_sha256(db_path)},
+            'files': entries,
+            'skipped': skipped,
+            'missing': missing,
+        }
+        with open(os.path.join(partial, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(partial, backup)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    log(f"… {name}: {len(entries)} files, {len(skipped)} skipped (not on local disk), "
+        f"{len(missing)} missing, took {time.time() - started:.1f}s")
+    return backup
+
+def prune_backups(folder=None, keep=None):
+    """Delete all but the newest keep backups (0 keeps everything), and
+    partial ones left by a crash. Files shared with newer backups through
+    hard links stay until nothing links to them"""
+    folder = folder or _folder
+    keep = _keep if keep is None else keep
+    backups = list_backups(folder)
+    removed = backups[:-keep] if keep and len(backups) > keep else []
+    for name in removed:
+        shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+    for name in os.listdir(folder) if os.path.isdir(folder) else []:
+        path = os.path.join(folder, name)
+        if name.endswith(PARTIAL) and time.time() - os.path.getmtime(path) > STALE_PARTIAL:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+def verify_backup(backup, log=print):
+    """Check the database and every file against the manifest, and that every
+    files row is accounted for. Returns a list of problems (empty if it's fine)"""
+    manifest = read_manifest(backup)
+    problems = []
+
+    db_path = os.path.join(backup, manifest['database']['path'])
+    if not os.path.exists(db_path):
+        return [f'{db_path} is missing']
+    if os.path.getsize(db_path) != manifest['database']['size'] or file_sha256(db_path) != manifest['database']['sha256']:
+        problems.append('database does not match the manifest')
+
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchall()
+        if result != [('ok',)]:
+            problems.append('database integrity check failed: ' + '; '.join(row[0] for row in result[:5]))
+        rows = conn.execute('SELECT id, file_path, storage_backend FROM files').fetchall()
+    except sqlite3.DatabaseError as e:
+        return problems + [f'database unreadable: {e}']
+    finally:
+        conn.close()
+
+    entries = {entry['id']: entry for entry in manifest['files']}
+    accounted = set(manifest['skipped']) | set(manifest['missing'])
+    for file_id, key, backend_name in rows:
+        entry = entries.pop(file_id, None)
+        if entry is None:
+            if file_id not in accounted:
+                problems.append(f'file {file_id} is in the database but not the backup')
+        elif entry['key'] != key or entry['backend'] != (backend_name or 'legacy'):
+            problems.append(f'file {file_id} has a different location in the database')
+    for file_id in entries:
+        problems.append(f'file {file_id} is in the backup but not the database')
+
+    for entry in manifest['files']:
+        path = os.path.join(backup, entry['path'])
+        if not os.path.exists(path):
+            problems.append(f"file {entry['id']} is missing from the backup")
+        elif os.path.getsize(path) != entry['size'] or file_sha256(path) != entry['sha256']:
+            problems.append(f"file {entry['id']} does not match the manifest")
+
+    if manifest['missing']:
+        log(f"… {len(manifest['missing'])} files were already gone when the backup was made")
+    return problems
+
+def restore_backup(backup, log=print):
+    """Verify backup, then copy its files back to their backends and its
+    database over the configured one. Run with the app stopped"""
+    from database import connect
+    from storage import storage_for
+
+    problems = verify_backup(backup, log)
+    if problems:
+        raise BackupError(f'{backup} failed verification: ' + '; '.join(problems[:5]))
+    manifest = read_manifest(backup)
+
+    restored = 0
+    for entry in manifest['files']:
+        backend, key = storage_for(entry['backend'], entry['key'])
+        dest = backend.path(key)
+        if os.path.exists(dest) and os.path.getsize(dest) == entry['size']:
+            # Still there (files are never changed in place)
+            continue
+        # Replaced in one go so a half-copied file is never left in place
+        tmp = dest + PARTIAL
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        _link_or_copy(os.path.join(backup, entry['path']), tmp)
+        os.replace(tmp, dest)
+        restored += 1
+    log(f"… {restored} files restored, {len(manifest['files']) - restored} already in place")
+
+    # Through SQLite rather than over the file, so the live database's WAL is
+    # dealt with properly
+    source = sqlite3.connect(f"file:{os.path.join(backup, manifest['database']['path'])}?mode=ro", uri=True)
+    dest = connect()
+    try:
+        source.backup(dest, pages=BACKUP_PAGES)
+    finally:
+        dest.close()
+        source.close()
+
+def _next_run(interval):
+    return (time.time() // interval + 1) * interval
+
+def _worker_loop():
+    from database import log_action
+    while True:
+        # Named after the start of the interval, so when several workers wake
+        # up together only the first one to create the folder makes the backup
+        slot = time.time() // _interval * _interval
+        name = datetime.utcfromtimestamp(slot).strftime(NAME_FORMAT)
+        if not os.path.exists(os.path.join(_folder, name)):
+            try:
+                create_backup(name=name, log=lambda message: None)
+                prune_backups()
+            except FileExistsError:
+                pass
+            except Exception as e:
+                # Tried again next interval, but say so where admins will see it
+                print(f"❌ Scheduled backup {name} failed:", file=sys.stderr)
+                traceback.print_exc()
+                try:
+                    log_action(None, 'backup_failed', f'{name}: {e}')
+                except sqlite3.Error:
+                    pass
+        time.sleep(max(1, _next_run(_interval) - time.time()))
+
+def start_backup_worker():
+    """Start the scheduled backup thread if BACKUP_INTERVAL is set"""
+    global _worker
+    if not _interval:
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_worker_loop, name='backups', daemon=True)
+            _worker.start()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Back up and restore SecureVault')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='make a backup now')
+    create.add_argument('--to', dest='folder', help='folder to put it in (default BACKUP_FOLDER)')
+    create.add_argument('--keep', type=int, help='then delete all but this many backups (default BACKUP_KEEP)')
+    verify = commands.add_parser('verify', help='check a backup is complete and undamaged')
+    verify.add_argument('backup', help='path of the backup folder')
+    restore = commands.add_parser('restore', help='restore a backup over the current data (stop the app first)')
+    restore.add_argument('backup', help='path of the backup folder')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from storage import StorageError
+    # Run as a script this module is __main__, not the backup create_app configures
+    configure_backups(create_app().config)
+
+    try:
+        if args.command == 'create':
+            backup = create_backup(args.folder)
+            removed = prune_backups(args.folder, args.keep)
+            print(f"✅ Backed up to {backup}" + (f", removed {len(removed)} old backups" if removed else ''))
+        elif args.command == 'verify':
+            problems = verify_backup(args.backup)
+            for problem in problems:
+                print(f"❌ {problem}")
+            if problems:
+                return 1
+            print(f"✅ {args.backup} is complete")
+        else:
+            restore_backup(args.backup)
+            print(f"✅ Restored {args.backup}")
+    except (BackupError, StorageError, FileExistsError) as e:
+        print(f"❌ {e}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Small load generator for SecureVault (standard library only)
+
+Logs in once, then hammers one or more pages from --concurrency threads for
+--duration seconds and prints requests/second and latency percentiles.
+--slow-clients opens that many extra connections that trickle an upload at
+~1 byte/second for the whole run, to see whether slow clients starve the rest.
+
+    python bench.py --username bench --password benchpass --path /notes --path /files
+"""
+
+import sys
+import time
+import socket
+import argparse
+import threading
+import http.cookiejar
+import urllib.parse
+import urllib.request
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Measure SecureVault throughput')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--username', required=True, help='a user without 2FA')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--path', action='append', help='page to request (repeatable, default /notes)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--slow-clients', type=int, default=0)
+    return parser.parse_args(argv)
+
+def login(url, username, password):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+    opener.open(f'{url}/login', data).read()
+    cookie = '; '.join(f'{c.name}={c.value}' for c in jar)
+    if 'session=' not in cookie:
+        sys.exit('❌ Login failed')
+    return cookie
+
+def slow_client(url, cookie, stop):
+    """Start an upload and send its body one byte a second until told to stop"""
+    parts = urllib.parse.urlsplit(url)
+    sock = socket.create_connection((parts.hostname, parts.port or 80))
+    sock.sendall((f'POST /upload_file HTTP/1.1\r\nHost: {parts.netloc}\r\nCookie: {cookie}\r\n'
+                  'Content-Type: application/octet-stream\r\nContent-Length: 1000000\r\n\r\n').encode())
+    try:
+        while not stop.is_set():
+            sock.sendall(b'x')
+            stop.wait(1)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+def worker(url, cookie, paths, deadline, results):
+    latencies, errors = [], 0
+    i = 0
+    while time.monotonic() < deadline:
+        request = urllib.request.Request(url + paths[i % len(paths)], headers={'Cookie': cookie})
+        i += 1
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            latencies.append(time.monotonic() - start)
+        except Exception:
+            errors += 1
+    results.append((latencies, errors))
+
+def main(argv):
+    args = parse_args(argv)
+    paths = args.path or ['/notes']
+    cookie = login(args.url, args.username, args.password)
+
+    stop = threading.Event()
+    slow = [threading.Thread(target=slow_client, args=(args.url, cookie, stop), daemon=True)
+            for _ in range(args.slow_clients)]
+    for t in slow:
+        t.start()
+    time.sleep(1 if slow else 0)
+
+    results = []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=worker, args=(args.url, cookie, paths, deadline, results))
+               for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+
+    latencies = sorted(l for result in results for l in result[0])
+    errors = sum(result[1] for result in results)
+    if not latencies:
+        print(f"❌ No successful requests ({errors} errors)")
+        return 1
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"{len(latencies) / args.duration:.1f} req/s, {len(latencies)} ok, {errors} errors, "
+          f"p50 {percentile(0.5):.1f} ms, p95 {percentile(0.95):.1f} ms, p99 {percentile(0.99):.1f} ms")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Build the static assets
+
+    python build_assets.py              # compile the CSS, then fingerprint everything
+    python build_assets.py --skip-css   # only fingerprint (no Tailwind binary needed)
+
+1. Compiles static/src/app.css with the Tailwind CLI into a minified
+   static/app.css containing only the classes the templates use. The CLI is
+   the standalone binary (pip install tailwindcss-bin, or set TAILWIND to its path).
+2. Copies every file in static/ to static/dist/<name>.<hash>.<ext>, with .gz
+   and .br (if brotli is installed) copies next to it, and writes
+   static/dist/manifest.json mapping each name to its hashed copy.
+
+Run it after changing templates or static files and commit the results, so
+servers don't need any build tools.
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+SOURCE_FOLDER = os.path.join(STATIC_FOLDER, 'src')
+DIST_FOLDER = os.path.join(STATIC_FOLDER, 'dist')
+MANIFEST_NAME = 'manifest.json'
+
+# Compressing these doesn't make them any smaller
+PRECOMPRESSED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'woff', 'woff2', 'zip'}
+
+def build_css():
+    tailwind = os.environ.get('TAILWIND') or shutil.which('tailwindcss')
+    if not tailwind:
+        sys.exit('❌ Tailwind CLI not found, pip install tailwindcss-bin or set TAILWIND')
+    subprocess.run([tailwind, '--input', os.path.join(SOURCE_FOLDER, 'app.css'),
+                    '--output', os.path.join(STATIC_FOLDER, 'app.css'), '--minify'],
+                   cwd=STATIC_FOLDER, check=True)
+
+def static_files():
+    """Names (relative to static/) of everything that gets fingerprinted"""
+    for root, dirs, files in os.walk(STATIC_FOLDER):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in (SOURCE_FOLDER, DIST_FOLDER)]
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), STATIC_FOLDER).replace(os.sep, '/')
+
+def write_compressed(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # mtime=0 so rebuilding unchanged files gives identical output
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, 9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+
+def fingerprint():
+    shutil.rmtree(DIST_FOLDER, ignore_errors=True)
+    os.makedirs(DIST_FOLDER)
+
+    manifest = {}
+    for name in static_files():
+        with open(os.path.join(STATIC_FOLDER, name), 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        stem, dot, ext = name.rpartition('.')
+        hashed_name = f'{stem}.{digest}.{ext}' if dot else f'{name}.{digest}'
+
+        dest = os.path.join(DIST_FOLDER, hashed_name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(os.path.join(STATIC_FOLDER, name), dest)
+        if ext.lower() not in PRECOMPRESSED_EXTENSIONS:
+            write_compressed(dest)
+        manifest[name] = f'dist/{hashed_name}'
+        print(f"  {name} -> dist/{hashed_name}")
+
+    with open(os.path.join(DIST_FOLDER, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build and fingerprint static assets')
+    parser.add_argument('--skip-css', action='store_true', help="don't run Tailwind")
+    args = parser.parse_args(argv)
+
+    if not args.skip_css:
+        build_css()
+    fingerprint()
+    print("✅ Assets built")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,139 @@
+"""
+Response compression and streamed pages
+
+init_compression gzips (or brotli-compresses, if the brotli package is
+installed and the browser accepts it) text responses of COMPRESS_MIN_SIZE
+bytes or more. Streamed responses are compressed chunk by chunk and flushed
+after each one, so the browser can start rendering before the end arrives.
+
+stream_page renders a template bit by bit as the response is sent, instead of
+building the whole page in memory first. Use it with database.iter_query for
+pages listing everything a user has.
+"""
+
+import zlib
+from flask import Response, current_app, request, stream_with_context, get_flashed_messages
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+# Brotli's higher levels are too slow to run on every response
+BROTLI_QUALITY = 5
+# Template events (text runs and {{ }} values) joined into each streamed chunk
+STREAM_BUFFER = 100
+
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'image/svg+xml'}
+
+class _Gzip:
+    encoding = 'gzip'
+
+    def __init__(self):
+        # wbits 31 = gzip header and trailer rather than a bare zlib stream
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class _Brotli:
+    encoding = 'br'
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+def _choose_compressor():
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding == 'br':
+        return _Brotli()
+    if encoding == 'gzip':
+        return _Gzip()
+    return None
+
+def _compressible(response):
+    if request.method == 'HEAD' or response.status_code in (204, 206, 304) or response.status_code < 200:
+        return False
+    if 'Content-Encoding' in response.headers or response.direct_passthrough:
+        # Already compressed, or a file send_file streams straight from disk
+        return False
+    mimetype = response.mimetype or ''
+    # Event streams need every event delivered as soon as it's written
+    if mimetype == 'text/event-stream':
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+def _compress_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # Lets stream_with_context and friends clean up
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if not _compressible(response):
+        return response
+
+    min_size = current_app.config['COMPRESS_MIN_SIZE']
+    if not response.is_streamed:
+        if response.content_length is None or response.content_length < min_size:
+            return response
+    elif response.content_length is not None and response.content_length < min_size:
+        return response
+
+    compressor = _choose_compressor()
+    if compressor is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = compressor.encoding
+    # The compressed bytes differ from the uncompressed ones, so a strong ETag no longer fits
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def init_compression(app):
+    app.after_request(compress_response)
+
+def stream_page(template_name, **context):
+    """Like render_template, but sends the page as it's rendered"""
+    app = current_app._get_current_object()
+    # Pop the flashes now, while the session can still be saved. The template
+    # runs after the cookie has gone out and gets them from the request cache
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return Response(stream_with_context(stream), mimetype='text/html')
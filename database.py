@@ -1,17 +1,32 @@
 import sqlite3
 
+# Path of the SQLite database, set from the app config by create_app
+DATABASE = 'secure_app.db'
+
+def configure_database(path):
+    """Point every connect() in this process at the database at path"""
+    global DATABASE
+    DATABASE = path
+
+def connect():
+    """Open a connection to the configured database"""
+    return sqlite3.connect(DATABASE)
+
 def init_db():
     """Initialize the database with required tables"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
+    # WAL lets readers carry on while another process writes (stored in the file,
+    # so it applies to every connection from now on)
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   username TEXT UNIQUE NOT NULL,
                   password_hash TEXT NOT NULL,
                   encryption_key TEXT NOT NULL,
-<<<<<<< HEAD
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
 
     # Add missing columns if needed
@@ -21,12 +36,42 @@ def init_db():
         c.execute("ALTER TABLE users ADD COLUMN is_admin INTEGER DEFAULT 0")
     if 'force_reset' not in columns:
         c.execute("ALTER TABLE users ADD COLUMN force_reset INTEGER DEFAULT 0")
+    if 'previous_encryption_key' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN previous_encryption_key TEXT")
+    # Storage quota (see quotas.py). quota_bytes NULL means the configured default
+    if 'quota_bytes' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN quota_bytes INTEGER")
+    backfill_usage = 'bytes_used' not in columns
+    if backfill_usage:
+        c.execute("ALTER TABLE users ADD COLUMN bytes_used INTEGER NOT NULL DEFAULT 0")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)')
+    # NOCASE so username LIKE 'abc%' can use it (LIKE ignores case)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)')
+
+    # Username substring search for the admin users page, kept in step with
+    # users by triggers. The trigram tokenizer needs SQLite 3.34+, without it
+    # the search falls back to LIKE
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users_search'")
+    new_users_search = c.fetchone() is None
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_search
+                     USING fts5(username, content='users', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError:
+        new_users_search = False
+    else:
+        c.execute('''CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+                         INSERT INTO users_search (rowid, username) VALUES (new.id, new.username);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+                         INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username ON users BEGIN
+                         INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username);
+                         INSERT INTO users_search (rowid, username) VALUES (new.id, new.username);
+                     END''')
+    if new_users_search:
+        c.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
 
-=======
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  is_admin BOOLEAN DEFAULT 0)''')
-    
->>>>>>> ee3fdc1 (Release v2.0.0: Admin panel v2, half created passkey and totp system, and local network actcess)
     # Notes table
     c.execute('''CREATE TABLE IF NOT EXISTS notes
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -36,6 +81,23 @@ def init_db():
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_notes_user ON notes (user_id)')
+    
+    # Note revisions (full snapshots every few revisions, deltas in between)
+    c.execute('''CREATE TABLE IF NOT EXISTS note_revisions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  note_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  revision INTEGER NOT NULL,
+                  title TEXT NOT NULL,
+                  is_snapshot INTEGER NOT NULL DEFAULT 0,
+                  payload TEXT NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (note_id) REFERENCES notes (id),
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_note_revisions_note
+                 ON note_revisions (note_id, revision)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_note_revisions_user ON note_revisions (user_id, id)')
     
     # Files table
     c.execute('''CREATE TABLE IF NOT EXISTS files
@@ -47,6 +109,147 @@ def init_db():
                   file_size INTEGER NOT NULL,
                   uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_user ON files (user_id)')
+
+    # Per-file key (wrapped with the user's key), NULL for files stored before encryption
+    c.execute("PRAGMA table_info(files)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'file_key' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN file_key TEXT")
+    # Storage backend the file is on (see storage.py), file_path is then the
+    # key within that backend. NULL for files uploaded before backends existed
+    if 'storage_backend' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN storage_backend TEXT")
+    # SHA-256 of the original content and preview state (see previews.py)
+    if 'content_hash' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN content_hash TEXT")
+    if 'preview_status' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN preview_status TEXT")
+        # Queue previews for what was uploaded before they existed
+        c.execute('''UPDATE files SET preview_status = 'pending' WHERE file_key IS NOT NULL AND (
+                         lower(original_filename) LIKE '%.png' OR lower(original_filename) LIKE '%.jpg' OR
+                         lower(original_filename) LIKE '%.jpeg' OR lower(original_filename) LIKE '%.gif' OR
+                         lower(original_filename) LIKE '%.pdf')''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (content_hash)')
+    # MIME type verified from the file's first bytes at upload (see filetypes.py)
+    if 'mime_type' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN mime_type TEXT")
+    # Number of entries in archive_entries, NULL until a zip has been indexed
+    if 'archive_entry_count' not in columns:
+        c.execute("ALTER TABLE files ADD COLUMN archive_entry_count INTEGER")
+
+    # Central directory of uploaded zips (see archives.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_entries
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  file_id INTEGER NOT NULL,
+                  name TEXT NOT NULL,
+                  file_size INTEGER NOT NULL,
+                  compressed_size INTEGER NOT NULL,
+                  header_offset INTEGER NOT NULL,
+                  compress_type INTEGER NOT NULL,
+                  crc INTEGER NOT NULL,
+                  flag_bits INTEGER NOT NULL DEFAULT 0,
+                  modified_at TEXT,
+                  FOREIGN KEY (file_id) REFERENCES files (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_archive_entries_file ON archive_entries (file_id, name)')
+
+    # Bytes stored by all users together, one row kept up to date by quotas.py
+    c.execute('''CREATE TABLE IF NOT EXISTS storage_usage
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  bytes_used INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('INSERT OR IGNORE INTO storage_usage (id, bytes_used) VALUES (1, 0)')
+    if backfill_usage:
+        # Count what was uploaded before usage was tracked, only needed once
+        c.execute('''UPDATE users SET bytes_used =
+                     (SELECT COALESCE(SUM(file_size), 0) FROM files WHERE files.user_id = users.id)''')
+        c.execute('UPDATE storage_usage SET bytes_used = (SELECT COALESCE(SUM(file_size), 0) FROM files) WHERE id = 1')
+
+    # Row counts for the admin dashboard, kept exact by triggers so reading them
+    # doesn't need a COUNT(*) over each table (see live_stats.py)
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'site_stats'")
+    new_site_stats = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS site_stats
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  users INTEGER NOT NULL DEFAULT 0,
+                  notes INTEGER NOT NULL DEFAULT 0,
+                  files INTEGER NOT NULL DEFAULT 0)''')
+    for table in ('users', 'notes', 'files'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table} BEGIN
+                          UPDATE site_stats SET {table} = {table} + 1 WHERE id = 1;
+                      END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table} BEGIN
+                          UPDATE site_stats SET {table} = {table} - 1 WHERE id = 1;
+                      END''')
+    if new_site_stats:
+        c.execute('''INSERT INTO site_stats (id, users, notes, files) VALUES
+                     (1, (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM notes), (SELECT COUNT(*) FROM files))''')
+    
+    # Key rotation jobs (checkpointed so they can resume after a restart)
+    c.execute('''CREATE TABLE IF NOT EXISTS key_rotations
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'running',
+                  last_note_id INTEGER NOT NULL DEFAULT 0,
+                  last_file_id INTEGER NOT NULL DEFAULT 0,
+                  last_revision_id INTEGER NOT NULL DEFAULT 0,
+                  rows_skipped INTEGER NOT NULL DEFAULT 0,
+                  notes_done INTEGER NOT NULL DEFAULT 0,
+                  notes_total INTEGER NOT NULL DEFAULT 0,
+                  files_done INTEGER NOT NULL DEFAULT 0,
+                  files_total INTEGER NOT NULL DEFAULT 0,
+                  error TEXT,
+                  started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  finished_at TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute("PRAGMA table_info(key_rotations)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'last_revision_id' not in columns:
+        c.execute("ALTER TABLE key_rotations ADD COLUMN last_revision_id INTEGER NOT NULL DEFAULT 0")
+    if 'rows_skipped' not in columns:
+        c.execute("ALTER TABLE key_rotations ADD COLUMN rows_skipped INTEGER NOT NULL DEFAULT 0")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_key_rotations_user ON key_rotations (user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_key_rotations_status ON key_rotations (status)')
+    
+    # Bulk admin actions run in the background (see jobs.py). user_ids is a JSON
+    # list, position is how many of them are finished
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'running',
+                  user_ids TEXT NOT NULL,
+                  position INTEGER NOT NULL DEFAULT 0,
+                  total INTEGER NOT NULL,
+                  error TEXT,
+                  created_by INTEGER,
+                  started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+    
+    # Change log for client sync: one row per note/file, re-numbered on every
+    # change, deletes kept as tombstones
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'change_log'")
+    new_change_log = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS change_log
+                 (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  entity TEXT NOT NULL,
+                  entity_id INTEGER NOT NULL,
+                  op TEXT NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_entity ON change_log (entity, entity_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_change_log_user ON change_log (user_id, seq)')
+    if new_change_log:
+        # Existing notes and files show up in a client's first sync
+        c.execute("INSERT INTO change_log (user_id, entity, entity_id, op) SELECT user_id, 'note', id, 'upsert' FROM notes ORDER BY id")
+        c.execute("INSERT INTO change_log (user_id, entity, entity_id, op) SELECT user_id, 'file', id, 'upsert' FROM files ORDER BY id")
+    
+    # Version counters for cached page fragments (see fragments.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions
+                 (name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0)''')
     
     # System logs table
     c.execute('''CREATE TABLE IF NOT EXISTS system_logs
@@ -58,6 +261,8 @@ def init_db():
                   user_agent TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
+    # Per-user timelines (see activity.py), the global feed reads by id
+    c.execute('CREATE INDEX IF NOT EXISTS idx_system_logs_user ON system_logs (user_id, id)')
     
     # Create default admin user if no users exist
     c.execute('SELECT COUNT(*) FROM users')
@@ -77,7 +282,7 @@ def init_db():
 
 def get_db_connection():
     """Get a database connection"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -107,11 +312,29 @@ def execute_single_query(query, params=None):
     finally:
         conn.close()
 
-def log_action(user_id, action, details=None, ip_address=None, user_agent=None):
-    """Log user actions for admin monitoring"""
-    conn = sqlite3.connect('secure_app.db')
-    c = conn.cursor()
+def iter_query(query, params=(), batch_size=500):
+    """Yield rows a batch at a time on a connection of its own, for pages that
+    stream long lists instead of loading them up front"""
+    conn = connect()
+    try:
+        c = conn.execute(query, params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def log_action(user_id, action, details=None, ip_address=None, user_agent=None, c=None):
+    """Log user actions for admin monitoring. Pass c to log inside the caller's
+    transaction, otherwise it's written straight away on a connection of its own"""
+    conn = None
+    if c is None:
+        conn = connect()
+        c = conn.cursor()
     c.execute('''INSERT INTO system_logs (user_id, action, details, ip_address, user_agent)
                  VALUES (?, ?, ?, ?, ?)''', (user_id, action, details, ip_address, user_agent))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    if conn:
+        conn.commit()
+        conn.close()
\ No newline at end of file
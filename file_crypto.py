@@ -0,0 +1,173 @@
+import os
+import struct
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Encrypted file layout:
+#   header: MAGIC (4) | chunk size (4, big endian) | nonce prefix (7)
+#   chunks: AES-GCM(plaintext chunk) + 16 byte tag, all but the last are full size
+# Each chunk nonce is prefix | chunk index (4) | last chunk flag (1), so chunks
+# can't be reordered, dropped or the file truncated without failing to decrypt.
+MAGIC = b'SVF1'
+HEADER_SIZE = 15
+TAG_SIZE = 16
+CHUNK_SIZE = 64 * 1024
+
+class FileDecryptionError(Exception):
+    """Raised when an encrypted file is corrupt or the key is wrong"""
+
+def generate_file_key(user_key):
+    """Create a random per-file key, returns (key, key wrapped with the user's key)"""
+    file_key = AESGCM.generate_key(bit_length=256)
+    wrapped_key = Fernet(user_key.encode()).encrypt(file_key).decode()
+    return file_key, wrapped_key
+
+def unwrap_file_key(wrapped_key, user_key, previous_key=None):
+    """Decrypt a per-file key with the user's key (or their previous key mid-rotation)"""
+    if previous_key:
+        f = MultiFernet([Fernet(user_key.encode()), Fernet(previous_key.encode())])
+    else:
+        f = Fernet(user_key.encode())
+    return f.decrypt(wrapped_key.encode())
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack('>I', index) + (b'\x01' if last else b'\x00')
+
+def _read_full(source, size):
+    """Read exactly size bytes unless the stream ends first"""
+    data = source.read(size)
+    if not data or len(data) == size:
+        return data or b''
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        more = source.read(remaining)
+        if not more:
+            break
+        parts.append(more)
+        remaining -= len(more)
+    return b''.join(parts)
+
+def encrypt_stream(source, dest, file_key, chunk_size=CHUNK_SIZE):
+    """Encrypt a readable stream into dest one chunk at a time, returns the plaintext size"""
+    prefix = os.urandom(7)
+    header = MAGIC + struct.pack('>I', chunk_size) + prefix
+    dest.write(header)
+
+    aead = AESGCM(file_key)
+    size = 0
+    index = 0
+    chunk = _read_full(source, chunk_size)
+    while True:
+        # Read one chunk ahead so we know which chunk is the last one
+        next_chunk = _read_full(source, chunk_size) if len(chunk) == chunk_size else b''
+        last = not next_chunk
+        dest.write(aead.encrypt(_nonce(prefix, index, last), chunk, header))
+        size += len(chunk)
+        index += 1
+        if last:
+            return size
+        chunk = next_chunk
+
+def read_header(source):
+    """Read and check the header, returns (header, chunk size, nonce prefix)"""
+    header = source.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:4] != MAGIC:
+        raise FileDecryptionError('Not an encrypted file')
+    chunk_size = struct.unpack('>I', header[4:8])[0]
+    return header, chunk_size, header[8:]
+
+def plaintext_size(ciphertext_size, chunk_size):
+    """Size of the original file given the size of the encrypted file"""
+    body = ciphertext_size - HEADER_SIZE
+    chunk_count = max(1, -(-body // (chunk_size + TAG_SIZE)))
+    return body - chunk_count * TAG_SIZE
+
+def _decrypt_chunk(source, aead, header, prefix, chunk_size, index, last_index):
+    source.seek(HEADER_SIZE + index * (chunk_size + TAG_SIZE))
+    try:
+        return aead.decrypt(_nonce(prefix, index, index == last_index),
+                            _read_full(source, chunk_size + TAG_SIZE), header)
+    except InvalidTag:
+        raise FileDecryptionError('Encrypted file is corrupt')
+
+def _open_encrypted(source):
+    """Read the header and work out the plaintext size, returns (header, chunk size, prefix, size)"""
+    header, chunk_size, prefix = read_header(source)
+    source.seek(0, os.SEEK_END)
+    size = plaintext_size(source.tell(), chunk_size)
+    if size < 0:
+        raise FileDecryptionError('Encrypted file is truncated')
+    return header, chunk_size, prefix, size
+
+def decrypt_range(source, file_key, start=0, stop=None):
+    """Yield decrypted bytes [start, stop) reading only the chunks that cover them"""
+    header, chunk_size, prefix, size = _open_encrypted(source)
+    stop = size if stop is None else min(stop, size)
+    if start >= stop:
+        return
+
+    aead = AESGCM(file_key)
+    last_index = max(0, -(-size // chunk_size) - 1)
+
+    for index in range(start // chunk_size, (stop - 1) // chunk_size + 1):
+        chunk = _decrypt_chunk(source, aead, header, prefix, chunk_size, index, last_index)
+        chunk_start = index * chunk_size
+        yield chunk[max(start - chunk_start, 0):stop - chunk_start]
+
+class DecryptingReader:
+    """Seekable read-only file over an encrypted file, for code that wants a
+    real file object (e.g. zipfile). Only the chunks actually read are decrypted."""
+
+    def __init__(self, source, file_key):
+        self.source = source
+        self.header, self.chunk_size, self.prefix, self.size = _open_encrypted(source)
+        self.aead = AESGCM(file_key)
+        self.last_index = max(0, -(-self.size // self.chunk_size) - 1)
+        self.pos = 0
+        self._index = None
+        self._chunk = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.source.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position')
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        stop = self.size if size is None or size < 0 else min(self.pos + size, self.size)
+        parts = []
+        while self.pos < stop:
+            index = self.pos // self.chunk_size
+            if index != self._index:
+                self._chunk = _decrypt_chunk(self.source, self.aead, self.header, self.prefix,
+                                             self.chunk_size, index, self.last_index)
+                self._index = index
+            offset = self.pos - index * self.chunk_size
+            part = self._chunk[offset:offset + stop - self.pos]
+            parts.append(part)
+            self.pos += len(part)
+        return b''.join(parts)
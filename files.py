@@ -1,35 +1,75 @@
-import os
-import sqlite3
 import secrets
+import mimetypes
+import posixpath
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_file, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_file, Response, stream_with_context
 from auth import login_required
+from sync import record_change, OP_DELETE
+from fragments import cached_fragment, user_version
+from activity import log_activity
+from storage import get_storage, storage_for, LocalStorage, StorageError
+from quotas import would_exceed, charge, release, get_usage, QuotaExceeded
+from previews import (HashingReader, can_preview, queue_previews, read_preview, generate_previews,
+                      remove_cached, preview_mimetype, PREVIEW_SIZES, PREVIEW_PENDING, PREVIEW_READY)
+from archives import is_archive, index_archive, extract_entry, ArchiveError
+from filetypes import FILE_TYPES, FileTypeError, check_upload, mime_type_for
+from utils import allowed_file_type
+from file_crypto import generate_file_key, unwrap_file_key, encrypt_stream, decrypt_range, read_header, plaintext_size
+from database import connect
 
 files_bp = Blueprint('files', __name__)
 
-# Configuration
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'zip', 'rar'}
+# Configuration, see filetypes.py for what each type is checked against
+ALLOWED_EXTENSIONS = set(FILE_TYPES)
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return allowed_file_type(filename, ALLOWED_EXTENSIONS)
+
+def _discard_upload(storage, storage_key):
+    """Remove the stored copy of an upload that wasn't saved, keeping the original error"""
+    try:
+        storage.delete(storage_key)
+    except (StorageError, OSError):
+        pass
 
 @files_bp.route('/files')
 @login_required
 def files():
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
-    c.execute('''SELECT id, original_filename, file_size, uploaded_at 
+    version = user_version(c, session['user_id'])
+    bytes_used, quota_bytes = get_usage(c, session['user_id'])
+    conn.close()
+    
+    files_list = cached_fragment(('files', session['user_id'], version), render_files_list)
+    return render_template('files.html', files_list=files_list, bytes_used=bytes_used, quota_bytes=quota_bytes)
+
+def render_files_list():
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, original_filename, file_size, uploaded_at, content_hash, preview_status
                  FROM files WHERE user_id = ? ORDER BY uploaded_at DESC''', 
               (session['user_id'],))
     files_data = c.fetchall()
     conn.close()
     
-    return render_template('files.html', files=files_data)
+    return render_template('_files_list.html', files=files_data)
 
 @files_bp.route('/upload_file', methods=['GET', 'POST'])
 @login_required
 def upload_file():
     if request.method == 'POST':
+        # Turn away uploads that can't fit before reading the body. Content-Length
+        # includes a little form overhead, charge() below uses the real size
+        if request.content_length:
+            conn = connect()
+            too_big = would_exceed(conn.cursor(), session['user_id'], request.content_length)
+            conn.close()
+            if too_big:
+                flash('Not enough storage space left for this file', 'error')
+                return redirect(request.url)
+        
         if 'file' not in request.files:
             flash('No file selected', 'error')
             return redirect(request.url)
@@ -40,23 +80,64 @@ def upload_file():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
+            # Check the first bytes before anything is encrypted or stored
+            try:
+                mime_type, stream = check_upload(file.filename, file.stream)
+            except FileTypeError as e:
+                flash(str(e), 'error')
+                return redirect(request.url)
+            
             # Generate secure filename
             original_filename = file.filename
             filename = secure_filename(f"{session['user_id']}_{secrets.token_hex(8)}_{original_filename}")
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            
-            file.save(file_path)
-            file_size = os.path.getsize(file_path)
+            storage = get_storage()
+            storage_key = storage.new_key(filename)
             
-            # Save file info to database
-            conn = sqlite3.connect('secure_app.db')
+            conn = connect()
             c = conn.cursor()
-            c.execute('''INSERT INTO files (user_id, filename, original_filename, file_path, file_size)
-                         VALUES (?, ?, ?, ?, ?)''',
-                     (session['user_id'], filename, original_filename, file_path, file_size))
-            conn.commit()
+            c.execute('SELECT encryption_key FROM users WHERE id = ?', (session['user_id'],))
+            encryption_key = c.fetchone()[0]
+            
+            # Encrypt chunk by chunk while copying, so large files never sit in memory
+            file_key, wrapped_key = generate_file_key(encryption_key)
+            source = HashingReader(stream)
+            try:
+                with storage.open_write(storage_key) as dest:
+                    file_size = encrypt_stream(source, dest, file_key)
+                
+                charge(c, session['user_id'], file_size)
+                
+                # Save file info to database
+                preview_status = PREVIEW_PENDING if can_preview(original_filename) else None
+                c.execute('''INSERT INTO files (user_id, filename, original_filename, file_path, file_size, file_key, storage_backend,
+                                                content_hash, preview_status, mime_type)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (session['user_id'], filename, original_filename, storage_key, file_size, wrapped_key, storage.name,
+                          source.hexdigest(), preview_status, mime_type))
+                file_id = c.lastrowid
+                record_change(c, session['user_id'], 'file', file_id)
+                log_activity('file_uploaded', original_filename, c=c)
+                conn.commit()
+            except QuotaExceeded as e:
+                conn.rollback()
+                conn.close()
+                _discard_upload(storage, storage_key)
+                flash(f'{e}, the file was not saved', 'error')
+                return redirect(request.url)
+            except Exception:
+                # e.g. the client went away mid-upload, don't keep the partial file
+                conn.rollback()
+                conn.close()
+                _discard_upload(storage, storage_key)
+                raise
             conn.close()
             
+            if preview_status:
+                queue_previews([file_id])
+            if is_archive(original_filename):
+                # Only the central directory at the end of the file is read
+                index_archive(file_id)
+            
             flash('File uploaded successfully!', 'success')
             return redirect(url_for('files.files'))
         else:
@@ -67,10 +148,12 @@ def upload_file():
 @files_bp.route('/download_file/<int:file_id>')
 @login_required
 def download_file(file_id):
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
-    c.execute('''SELECT file_path, original_filename FROM files 
-                 WHERE id = ? AND user_id = ?''', (file_id, session['user_id']))
+    c.execute('''SELECT f.file_path, f.original_filename, f.file_key, u.encryption_key, u.previous_encryption_key,
+                        f.storage_backend, f.mime_type
+                 FROM files f JOIN users u ON f.user_id = u.id
+                 WHERE f.id = ? AND f.user_id = ?''', (file_id, session['user_id']))
     file_data = c.fetchone()
     conn.close()
     
@@ -78,28 +161,199 @@ def download_file(file_id):
         flash('File not found', 'error')
         return redirect(url_for('files.files'))
     
-    return send_file(file_data[0], as_attachment=True, download_name=file_data[1])
+    storage, storage_key = storage_for(file_data[5], file_data[0])
+    # Type checked at upload, files from before then go by their extension
+    mime_type = file_data[6] or mime_type_for(file_data[1])
+    
+    # Files uploaded before encryption was added are stored as-is
+    if not file_data[2]:
+        return send_plain_file(storage, storage_key, file_data[1], mime_type)
+    
+    file_key = unwrap_file_key(file_data[2], file_data[3], file_data[4])
+    return send_encrypted_file(storage, storage_key, file_key, file_data[1], mime_type)
+
+def send_plain_file(storage, storage_key, download_name, mimetype='application/octet-stream'):
+    """Send an unencrypted legacy file from any backend"""
+    if isinstance(storage, LocalStorage):
+        response = send_file(storage.path(storage_key), mimetype=mimetype, as_attachment=True,
+                             download_name=download_name)
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        return response
+    
+    def generate():
+        with storage.open_read(storage_key) as f:
+            yield from iter(lambda: f.read(64 * 1024), b'')
+    
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Length': str(storage.size(storage_key)),
+                             'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+                             'X-Content-Type-Options': 'nosniff'})
+
+def send_encrypted_file(storage, storage_key, file_key, download_name, mimetype='application/octet-stream'):
+    """Stream an encrypted file, decrypting only the chunks needed for a Range request"""
+    with storage.open_read(storage_key) as f:
+        _, chunk_size, _ = read_header(f)
+    size = plaintext_size(storage.size(storage_key), chunk_size)
+    
+    start, stop, status = 0, size, 200
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, stop = byte_range
+        status = 206
+    
+    def generate():
+        with storage.open_read(storage_key) as f:
+            yield from decrypt_range(f, file_key, start, stop)
+    
+    headers = {
+        'Content-Length': str(stop - start),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+        'X-Content-Type-Options': 'nosniff'
+    }
+    if status == 206:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    
+    return Response(stream_with_context(generate()), status=status, mimetype=mimetype,
+                    headers=headers, direct_passthrough=True)
+
+@files_bp.route('/browse_file/<int:file_id>')
+@login_required
+def browse_file(file_id):
+    """List the files inside a zip"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT id, original_filename, archive_entry_count FROM files WHERE id = ? AND user_id = ?',
+              (file_id, session['user_id']))
+    file_data = c.fetchone()
+    
+    if not file_data or not is_archive(file_data[1]):
+        conn.close()
+        flash('File not found', 'error')
+        return redirect(url_for('files.files'))
+    
+    # Zips uploaded before indexing existed are indexed on first look
+    if file_data[2] is None:
+        index_archive(file_id)
+    
+    c.execute('''SELECT id, name, file_size, modified_at FROM archive_entries
+                 WHERE file_id = ? ORDER BY name''', (file_id,))
+    entries = c.fetchall()
+    conn.close()
+    
+    return render_template('browse_file.html', file_id=file_id, filename=file_data[1], entries=entries)
+
+@files_bp.route('/download_file/<int:file_id>/entries/<int:entry_id>')
+@login_required
+def download_archive_entry(file_id, entry_id):
+    """Stream one file out of a zip without sending the whole archive"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT e.name, e.file_size, e.header_offset, e.compressed_size, e.compress_type, e.crc, e.flag_bits
+                 FROM archive_entries e JOIN files f ON e.file_id = f.id
+                 WHERE e.id = ? AND e.file_id = ? AND f.user_id = ?''', (entry_id, file_id, session['user_id']))
+    entry = c.fetchone()
+    conn.close()
+    
+    if not entry:
+        flash('File not found', 'error')
+        return redirect(url_for('files.files'))
+    
+    try:
+        contents = extract_entry(file_id, entry[1:])
+    except ArchiveError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('files.browse_file', file_id=file_id))
+    
+    download_name = posixpath.basename(entry[0])
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    return Response(stream_with_context(contents), mimetype=mimetype,
+                    headers={'Content-Length': str(entry[1]),
+                             'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+                             'X-Content-Type-Options': 'nosniff'},
+                    direct_passthrough=True)
+
+@files_bp.route('/preview_file/<int:file_id>/<size>')
+@login_required
+def preview_file(file_id, size):
+    """Thumbnail (small) or larger preview (large) of an image or PDF"""
+    if size not in PREVIEW_SIZES:
+        return Response(status=404)
+    
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT content_hash, preview_status FROM files WHERE id = ? AND user_id = ?',
+              (file_id, session['user_id']))
+    file_data = c.fetchone()
+    conn.close()
+    
+    if not file_data or file_data[1] != PREVIEW_READY:
+        return Response(status=404)
+    
+    # A preview never changes for the same content, so browsers can keep it
+    etag = f'{file_data[0]}-{size}'
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    
+    image = read_preview(file_data[0], size)
+    if image is None:
+        # Cache folder was cleared, make it again
+        if generate_previews(file_id) == PREVIEW_READY:
+            image = read_preview(file_data[0], size)
+        if image is None:
+            return Response(status=404)
+    
+    response = Response(image, mimetype=preview_mimetype(image))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 @files_bp.route('/delete_file/<int:file_id>')
 @login_required
 def delete_file(file_id):
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
-    c.execute('''SELECT file_path FROM files WHERE id = ? AND user_id = ?''', 
+    c.execute('''SELECT id, file_path, storage_backend, file_size, content_hash FROM files WHERE id = ? AND user_id = ?''', 
               (file_id, session['user_id']))
     file_data = c.fetchone()
     
     if file_data:
-        # Delete physical file
-        if os.path.exists(file_data[0]):
-            os.remove(file_data[0])
-        
-        # Delete from database
-        c.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
+        deleted = delete_file_rows(c, session['user_id'], [file_data])
+        if deleted:
+            log_activity('file_deleted', f'file {file_id}', c=c)
         conn.commit()
+        remove_stored_files(c, deleted)
         flash('File deleted successfully!', 'success')
     else:
         flash('File not found', 'error')
     
     conn.close()
-    return redirect(url_for('files.files'))
\ No newline at end of file
+    return redirect(url_for('files.files'))
+
+def delete_file_rows(c, user_id, rows):
+    """Delete files from the database inside the caller's transaction.
+    rows are (id, file_path, storage_backend, file_size, content_hash); returns
+    the ones this call removed, pass them to remove_stored_files after committing"""
+    deleted = []
+    for row in rows:
+        c.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (row[0], user_id))
+        # Another request or job may have got to it first
+        if c.rowcount:
+            c.execute('DELETE FROM archive_entries WHERE file_id = ?', (row[0],))
+            release(c, user_id, row[3])
+            record_change(c, user_id, 'file', row[0], OP_DELETE)
+            deleted.append(row)
+    return deleted
+
+def remove_stored_files(c, rows):
+    """Delete the stored copies (and unshared previews) of rows from delete_file_rows"""
+    for file_id, file_path, backend, file_size, content_hash in rows:
+        storage, storage_key = storage_for(backend, file_path)
+        storage.delete(storage_key)
+        # Previews are shared by files with the same content
+        if content_hash:
+            c.execute('SELECT 1 FROM files WHERE content_hash = ? LIMIT 1', (content_hash,))
+            if not c.fetchone():
+                remove_cached(content_hash)
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Upload content checks
+
+The first few KB of every upload are checked against the signature its
+extension promises before anything is stored. The MIME type that was verified
+is saved with the file, so downloads send it as-is.
+"""
+
+from utils import file_extension
+
+# Bytes looked at to work out what a file is
+SNIFF_SIZE = 4096
+
+ZIP_SIGNATURES = (b'PK\x03\x04', b'PK\x05\x06')
+
+# extension: (MIME type, signatures the file must start with, None for text)
+FILE_TYPES = {
+    'txt': ('text/plain', None),
+    'pdf': ('application/pdf', (b'%PDF-',)),
+    'png': ('image/png', (b'\x89PNG\r\n\x1a\n',)),
+    'jpg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    'jpeg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    'gif': ('image/gif', (b'GIF87a', b'GIF89a')),
+    'doc': ('application/msword', (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',)),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', ZIP_SIGNATURES),
+    'zip': ('application/zip', ZIP_SIGNATURES),
+    'rar': ('application/vnd.rar', (b'Rar!\x1a\x07\x00', b'Rar!\x1a\x07\x01\x00')),
+}
+
+class FileTypeError(Exception):
+    """Raised when an upload's content doesn't match its extension"""
+
+class PrefixedReader:
+    """Gives back bytes already read from a stream before reading the rest of it"""
+
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.source.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.source.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.source.read(size - len(data))
+        return data
+
+def _looks_like_text(head):
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return True  # UTF-16 with a byte order mark
+    if b'\x00' in head:
+        return False
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A character cut in half at the end of the sample is fine
+        return e.reason == 'unexpected end of data' and e.start >= len(head) - 3
+    return True
+
+def mime_type_for(filename):
+    """MIME type for an allowed extension, for files stored before types were checked"""
+    file_type = FILE_TYPES.get(file_extension(filename))
+    return file_type[0] if file_type else 'application/octet-stream'
+
+def check_upload(filename, stream):
+    """Check the start of an upload against its extension.
+    Returns (verified MIME type, stream to read the whole upload from) or raises FileTypeError."""
+    file_type = FILE_TYPES.get(file_extension(filename))
+    if file_type is None:
+        raise FileTypeError('File type not allowed')
+
+    head = stream.read(SNIFF_SIZE)
+    mime_type, signatures = file_type
+    if signatures is None:
+        matches = _looks_like_text(head)
+    else:
+        matches = head.startswith(signatures)
+    if not matches:
+        raise FileTypeError(f"File contents don't match the .{file_extension(filename)} extension")
+
+    return mime_type, PrefixedReader(head, stream)
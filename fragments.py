@@ -0,0 +1,74 @@
+"""
+Template warm-up and fragment caching
+
+warm_templates compiles every template once at startup (before gunicorn forks,
+so workers share the compiled code) instead of on the first request to each page.
+
+cached_fragment keeps rendered HTML for expensive blocks in memory, keyed by a
+version that changes whenever the data behind the block does:
+    user_version      a user's latest change_log seq, for their own notes/files,
+                      plus a counter bumped by bump_previews_version when a
+                      thumbnail is made (not a sync change, so not in change_log)
+    admin_version     the latest change_log seq overall plus a counter bumped by
+                      bump_users_version whenever the users table changes
+A repeat view with the same version skips both the queries and the rendering.
+Each process has its own cache, the versions come from the database so they
+agree across processes.
+"""
+
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+
+# Characters of rendered HTML kept per process before the least recently used is dropped
+FRAGMENT_CACHE_SIZE = 32 * 1024 * 1024
+
+_fragments = OrderedDict()
+_fragments_size = 0
+_lock = threading.Lock()
+
+def warm_templates(app):
+    """Compile every template now rather than on first use"""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+def user_version(c, user_id):
+    c.execute('''SELECT (SELECT COALESCE(MAX(seq), 0) FROM change_log WHERE user_id = ?),
+                        (SELECT COALESCE(MAX(version), 0) FROM cache_versions WHERE name = ?)''',
+              (user_id, f'previews:{user_id}'))
+    return tuple(c.fetchone())
+
+def admin_version(c):
+    # sqlite_sequence holds the highest seq change_log has ever handed out
+    c.execute('''SELECT (SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'change_log'),
+                        (SELECT COALESCE(MAX(version), 0) FROM cache_versions WHERE name = 'users')''')
+    return tuple(c.fetchone())
+
+def bump_users_version(c):
+    """Call in the same transaction as any change to the users table"""
+    c.execute('''INSERT INTO cache_versions (name, version) VALUES ('users', 1)
+                 ON CONFLICT (name) DO UPDATE SET version = version + 1''')
+
+def bump_previews_version(c, user_id):
+    """Call in the same transaction as a change to one of the user's preview statuses"""
+    c.execute('''INSERT INTO cache_versions (name, version) VALUES (?, 1)
+                 ON CONFLICT (name) DO UPDATE SET version = version + 1''', (f'previews:{user_id}',))
+
+def cached_fragment(key, render):
+    """Rendered HTML for key, calling render() to make it on a miss"""
+    global _fragments_size
+    with _lock:
+        html = _fragments.get(key)
+        if html is not None:
+            _fragments.move_to_end(key)
+            return html
+
+    html = Markup(render())
+    with _lock:
+        if key not in _fragments and len(html) <= FRAGMENT_CACHE_SIZE // 4:
+            _fragments[key] = html
+            _fragments_size += len(html)
+            while _fragments_size > FRAGMENT_CACHE_SIZE:
+                _, old = _fragments.popitem(last=False)
+                _fragments_size -= len(old)
+    return html
@@ -0,0 +1,232 @@
+"""
+Background jobs for bulk admin actions
+
+An admin picks some users and an action, start_job records it in the jobs
+table and a worker thread works through it a batch at a time, committing after
+each one. The write lock is only held for a batch, so the site stays usable
+while a large account is deleted, and the admin can watch progress or cancel.
+
+Jobs are checkpointed (position = users finished) and picked up again after a
+restart. Every process runs a worker; batches are claimed with conditional
+updates and deletes, so two workers never do the same work.
+"""
+
+import json
+import sqlite3
+import threading
+from files import delete_file_rows, remove_stored_files
+from fragments import bump_users_version
+from database import connect
+
+JOB_KINDS = {
+    'delete_users': 'Delete users',
+    'purge_files': 'Delete all files',
+    'force_reset': 'Force password reset',
+    'promote': 'Make admin',
+}
+
+# Actions an admin can't run on their own account
+SELF_EXCLUDED = {'delete_users', 'purge_files', 'force_reset'}
+
+# Rows deleted (or users updated) per transaction
+BATCH_SIZE = 100
+
+# Pause between batches (seconds) so requests can get the write lock
+BATCH_PAUSE = 0.05
+
+# Per-user rows removed along with the account. system_logs are kept for the audit trail
+USER_TABLES = ('note_revisions', 'change_log', 'key_rotations', 'user_totp',
+               'user_backup_codes', 'user_passkeys', 'auth_sessions')
+
+_worker = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+def start_job(kind, user_ids, created_by):
+    """Queue a bulk action, returns the job id (None if there's nothing to do)"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind {kind!r}')
+    user_ids = list(dict.fromkeys(user_ids))
+    if kind in SELF_EXCLUDED:
+        user_ids = [user_id for user_id in user_ids if user_id != created_by]
+    if not user_ids:
+        return None
+
+    conn = connect()
+    c = conn.cursor()
+    c.execute('INSERT INTO jobs (kind, user_ids, total, created_by) VALUES (?, ?, ?, ?)',
+              (kind, json.dumps(user_ids), len(user_ids), created_by))
+    job_id = c.lastrowid
+    conn.commit()
+    conn.close()
+
+    start_job_worker()
+    _wake.set()
+    return job_id
+
+def _job_dict(row):
+    job_id, kind, status, position, total, error, started_at, finished_at = row
+    return {
+        'id': job_id,
+        'kind': kind,
+        'label': JOB_KINDS.get(kind, kind),
+        'status': status,
+        'done': position,
+        'total': total,
+        'percent': 100 if status == 'done' or not total else min(100, position * 100 // total),
+        'error': error,
+        'started_at': started_at,
+        'finished_at': finished_at
+    }
+
+def get_job(job_id):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, kind, status, position, total, error, started_at, finished_at
+                 FROM jobs WHERE id = ?''', (job_id,))
+    row = c.fetchone()
+    conn.close()
+    return _job_dict(row) if row else None
+
+def list_jobs(limit=50):
+    """Most recent jobs first"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, kind, status, position, total, error, started_at, finished_at
+                 FROM jobs ORDER BY id DESC LIMIT ?''', (limit,))
+    rows = c.fetchall()
+    conn.close()
+    return [_job_dict(row) for row in rows]
+
+def cancel_job(job_id):
+    """Stop a running job after its current batch, returns False if it had already stopped.
+    Whatever was done before that stays done."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''UPDATE jobs SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP,
+                        finished_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND status = 'running' ''', (job_id,))
+    cancelled = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return cancelled
+
+def _advance(c, job_id, position, count):
+    """Claim the next count users by moving the checkpoint"""
+    c.execute('''UPDATE jobs SET position = ?, updated_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND position = ? AND status = 'running' ''',
+              (position + count, job_id, position))
+    return c.rowcount == 1
+
+def run_job_batch(job_id):
+    """Do the next batch of a job, returns True once it has finished"""
+    conn = connect()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT kind, status, user_ids, position, total FROM jobs WHERE id = ?', (job_id,))
+        job = c.fetchone()
+        if not job or job[1] != 'running':
+            return True
+
+        kind, _, user_ids, position, total = job
+        user_ids = json.loads(user_ids)
+        if position >= total:
+            c.execute('''UPDATE jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP,
+                                finished_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND status = 'running' ''', (job_id,))
+            conn.commit()
+            return True
+
+        if kind in ('force_reset', 'promote'):
+            batch = user_ids[position:position + BATCH_SIZE]
+            if _advance(c, job_id, position, len(batch)):
+                column = 'force_reset' if kind == 'force_reset' else 'is_admin'
+                c.executemany(f'UPDATE users SET {column} = 1 WHERE id = ?', [(user_id,) for user_id in batch])
+                bump_users_version(c)
+            conn.commit()
+            return False
+
+        # Deletes go one user at a time, a batch of their rows per call
+        user_id = user_ids[position]
+        c.execute('''SELECT id, file_path, storage_backend, file_size, content_hash FROM files
+                     WHERE user_id = ? ORDER BY id LIMIT ?''', (user_id, BATCH_SIZE))
+        files = c.fetchall()
+        if files:
+            deleted = delete_file_rows(c, user_id, files)
+            # File counts on the admin pages
+            bump_users_version(c)
+            conn.commit()
+            # Only once the rows are gone, so nothing points at a missing file
+            remove_stored_files(c, deleted)
+            return False
+
+        if kind == 'delete_users':
+            c.execute('SELECT id FROM notes WHERE user_id = ? ORDER BY id LIMIT ?', (user_id, BATCH_SIZE))
+            note_ids = [(row[0],) for row in c.fetchall()]
+            if note_ids:
+                c.executemany('DELETE FROM note_revisions WHERE note_id = ?', note_ids)
+                c.executemany('DELETE FROM notes WHERE id = ?', note_ids)
+                bump_users_version(c)
+                conn.commit()
+                return False
+
+        if _advance(c, job_id, position, 1):
+            if kind == 'delete_users':
+                # The claim holds the write lock, so nothing can be added between this
+                # check and the delete. Anything saved since the batches above (say an
+                # upload that was already running) gets its own batch first
+                c.execute('''SELECT EXISTS (SELECT 1 FROM files WHERE user_id = ?)
+                                 OR EXISTS (SELECT 1 FROM notes WHERE user_id = ?)''', (user_id, user_id))
+                if c.fetchone()[0]:
+                    conn.rollback()
+                    return False
+                for table in USER_TABLES:
+                    c.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+                c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            bump_users_version(c)
+        conn.commit()
+        return False
+    finally:
+        conn.close()
+
+def _fail_job(job_id, error):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''UPDATE jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND status = 'running' ''', (error, job_id))
+    conn.commit()
+    conn.close()
+
+def _worker_loop():
+    while True:
+        conn = connect()
+        c = conn.cursor()
+        c.execute("SELECT id FROM jobs WHERE status = 'running' ORDER BY id")
+        job_ids = [row[0] for row in c.fetchall()]
+        conn.close()
+
+        if not job_ids:
+            _wake.wait()
+            _wake.clear()
+            continue
+
+        # Round robin one batch per job so a big delete doesn't hold up a quick promote
+        for job_id in job_ids:
+            try:
+                run_job_batch(job_id)
+            except sqlite3.OperationalError:
+                # Database busy, try again on the next pass
+                pass
+            except Exception as e:
+                # e.g. the storage backend refusing a delete, retrying won't help
+                _fail_job(job_id, str(e) or e.__class__.__name__)
+        _wake.wait(BATCH_PAUSE)
+        _wake.clear()
+
+def start_job_worker():
+    """Start the background job thread, resuming any unfinished jobs"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_worker_loop, name='jobs', daemon=True)
+            _worker.start()
@@ -0,0 +1,233 @@
+import sqlite3
+import threading
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from notes import reencrypt_text, decrypt_text
+from database import connect
+
+# Rows re-encrypted per transaction, small so the write lock is only held briefly
+BATCH_SIZE = 100
+
+# Pause between batches (seconds) so requests can get the write lock
+BATCH_PAUSE = 0.05
+
+_worker = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+def start_key_rotation(user_id):
+    """Switch a user to a new key and queue their notes and files for re-encryption.
+    If the last rotation failed it is resumed with the same keys instead, since
+    the old key is still needed for whatever it didn't get to. Returns the
+    rotation id, or None if one is already running"""
+    conn = connect()
+    c = conn.cursor()
+
+    c.execute('SELECT previous_encryption_key FROM users WHERE id = ?', (user_id,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return None
+
+    if row[0] is not None:
+        # Unfinished rotation, carry on from its checkpoint if it failed
+        c.execute('SELECT id, status FROM key_rotations WHERE user_id = ? ORDER BY id DESC LIMIT 1', (user_id,))
+        rotation = c.fetchone()
+        resumed = False
+        if rotation and rotation[1] == 'failed':
+            c.execute('''UPDATE key_rotations SET status = 'running', error = NULL,
+                                updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND status = ?''', (rotation[0], 'failed'))
+            resumed = c.rowcount == 1
+            conn.commit()
+        conn.close()
+        if not resumed:
+            return None
+        start_rotation_worker()
+        _wake.set()
+        return rotation[0]
+
+    c.execute('SELECT COUNT(*) FROM notes WHERE user_id = ?', (user_id,))
+    notes_total = c.fetchone()[0]
+    c.execute('SELECT COUNT(*) FROM files WHERE user_id = ? AND file_key IS NOT NULL', (user_id,))
+    files_total = c.fetchone()[0]
+
+    # New writes use the new key straight away, reads accept either key until we finish.
+    # Only when no old key is left to migrate, so two requests can't both rotate
+    new_key = Fernet.generate_key().decode()
+    c.execute('''UPDATE users SET previous_encryption_key = encryption_key, encryption_key = ?
+                 WHERE id = ? AND previous_encryption_key IS NULL''', (new_key, user_id))
+    if c.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return None
+    c.execute('''INSERT INTO key_rotations (user_id, notes_total, files_total)
+                 VALUES (?, ?, ?)''', (user_id, notes_total, files_total))
+    rotation_id = c.lastrowid
+    conn.commit()
+    conn.close()
+
+    start_rotation_worker()
+    _wake.set()
+    return rotation_id
+
+def get_key_rotation(user_id):
+    """Latest key rotation for a user as a dict, or None"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, status, notes_done, notes_total, files_done, files_total,
+                        error, started_at, finished_at
+                 FROM key_rotations WHERE user_id = ? ORDER BY id DESC LIMIT 1''', (user_id,))
+    row = c.fetchone()
+    conn.close()
+
+    if not row:
+        return None
+
+    total = row[3] + row[5]
+    done = row[2] + row[4]
+    return {
+        'id': row[0],
+        'status': row[1],
+        'notes_done': row[2],
+        'notes_total': row[3],
+        'files_done': row[4],
+        'files_total': row[5],
+        'percent': 100 if row[1] == 'done' or not total else min(100, done * 100 // total),
+        'error': row[6],
+        'started_at': row[7],
+        'finished_at': row[8]
+    }
+
+def run_rotation_batch(rotation_id):
+    """Re-encrypt the next batch of a rotation, returns True once it has finished"""
+    conn = connect()
+    c = conn.cursor()
+    try:
+        c.execute('''SELECT r.user_id, r.status, r.last_note_id, r.last_file_id, r.last_revision_id,
+                            u.encryption_key, u.previous_encryption_key
+                     FROM key_rotations r JOIN users u ON r.user_id = u.id
+                     WHERE r.id = ?''', (rotation_id,))
+        rotation = c.fetchone()
+        if not rotation or rotation[1] != 'running':
+            return True
+
+        user_id, _, last_note_id, last_file_id, last_revision_id, new_key, old_key = rotation
+        new_fernet = Fernet(new_key.encode())
+        keys = MultiFernet([new_fernet] + ([Fernet(old_key.encode())] if old_key else []))
+
+        c.execute('''SELECT id, content FROM notes WHERE user_id = ? AND id > ?
+                     ORDER BY id LIMIT ?''', (user_id, last_note_id, BATCH_SIZE))
+        notes = c.fetchall()
+        if notes:
+            # Claim the batch by moving the checkpoint, so two workers can't both do it
+            c.execute('''UPDATE key_rotations SET last_note_id = ?, notes_done = notes_done + ?,
+                                updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND last_note_id = ?''',
+                      (notes[-1][0], len(notes), rotation_id, last_note_id))
+            if c.rowcount == 1:
+                _reencrypt_rows(c, rotation_id, 'notes', 'content', notes,
+                                lambda content: reencrypt_text(content, new_key, old_key),
+                                lambda content: decrypt_text(content, new_key))
+            conn.commit()
+            return False
+
+        c.execute('''SELECT id, file_key FROM files
+                     WHERE user_id = ? AND id > ? AND file_key IS NOT NULL
+                     ORDER BY id LIMIT ?''', (user_id, last_file_id, BATCH_SIZE))
+        files = c.fetchall()
+        if files:
+            c.execute('''UPDATE key_rotations SET last_file_id = ?, files_done = files_done + ?,
+                                updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND last_file_id = ?''',
+                      (files[-1][0], len(files), rotation_id, last_file_id))
+            if c.rowcount == 1:
+                _reencrypt_rows(c, rotation_id, 'files', 'file_key', files,
+                                lambda file_key: keys.rotate(file_key.encode()).decode(),
+                                lambda file_key: new_fernet.decrypt(file_key.encode()))
+            conn.commit()
+            return False
+
+        # Note history is re-encrypted last, it isn't counted in the progress
+        c.execute('''SELECT id, payload FROM note_revisions WHERE user_id = ? AND id > ?
+                     ORDER BY id LIMIT ?''', (user_id, last_revision_id, BATCH_SIZE))
+        revisions = c.fetchall()
+        if revisions:
+            c.execute('''UPDATE key_rotations SET last_revision_id = ?, updated_at = CURRENT_TIMESTAMP
+                         WHERE id = ? AND last_revision_id = ?''',
+                      (revisions[-1][0], rotation_id, last_revision_id))
+            if c.rowcount == 1:
+                _reencrypt_rows(c, rotation_id, 'note_revisions', 'payload', revisions,
+                                lambda payload: reencrypt_text(payload, new_key, old_key),
+                                lambda payload: decrypt_text(payload, new_key))
+            conn.commit()
+            return False
+
+        # Everything is on the new key, drop the old one
+        c.execute('UPDATE users SET previous_encryption_key = NULL WHERE id = ?', (user_id,))
+        c.execute('''UPDATE key_rotations SET status = 'done', updated_at = CURRENT_TIMESTAMP,
+                            finished_at = CURRENT_TIMESTAMP,
+                            error = CASE WHEN rows_skipped > 0
+                                         THEN 'Left as they were, neither key could decrypt them: ' || rows_skipped || ' item(s)'
+                                    END
+                     WHERE id = ?''', (rotation_id,))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def _reencrypt_rows(c, rotation_id, table, column, rows, reencrypt, decrypt_new):
+    """Write back a claimed batch. Rows changed since they were read are read again,
+    the write lock is held by now, and redone if the change still used the old key.
+    Rows neither key can decrypt are counted and left as they are, so a corrupt row
+    can't stop the rotation."""
+    skipped = 0
+    for row_id, value in rows:
+        try:
+            c.execute(f'UPDATE {table} SET {column} = ? WHERE id = ? AND {column} = ?',
+                      (reencrypt(value), row_id, value))
+            if c.rowcount == 1:
+                continue
+            c.execute(f'SELECT {column} FROM {table} WHERE id = ?', (row_id,))
+            row = c.fetchone()
+            if not row or row[0] is None:
+                continue
+            try:
+                decrypt_new(row[0])
+            except InvalidToken:
+                c.execute(f'UPDATE {table} SET {column} = ? WHERE id = ?', (reencrypt(row[0]), row_id))
+        except InvalidToken:
+            skipped += 1
+    if skipped:
+        c.execute('UPDATE key_rotations SET rows_skipped = rows_skipped + ? WHERE id = ?',
+                  (skipped, rotation_id))
+
+def _worker_loop():
+    while True:
+        conn = connect()
+        c = conn.cursor()
+        c.execute("SELECT id FROM key_rotations WHERE status = 'running' ORDER BY id")
+        rotation_ids = [row[0] for row in c.fetchall()]
+        conn.close()
+
+        if not rotation_ids:
+            _wake.wait()
+            _wake.clear()
+            continue
+
+        # Round robin one batch per rotation so one large user can't starve the rest
+        for rotation_id in rotation_ids:
+            try:
+                run_rotation_batch(rotation_id)
+            except sqlite3.OperationalError:
+                # Database busy, try again on the next pass
+                pass
+        _wake.wait(BATCH_PAUSE)
+        _wake.clear()
+
+def start_rotation_worker():
+    """Start the background re-encryption thread, resuming any unfinished rotations"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_worker_loop, name='key-rotation', daemon=True)
+            _worker.start()
@@ -0,0 +1,245 @@
+"""
+Live admin dashboard
+
+Open dashboards keep a server-sent events connection to /admin/events and get
+pushed whatever changed, instead of reloading the page and rerunning its queries.
+
+Each process has one tailer thread, started when the first dashboard connects
+and idle while none are connected. Once a second it reads the site_stats and
+storage_usage rows (counters kept exact by triggers and quotas.py) and any
+system_logs rows newer than the last one it saw, then publishes to the event
+bus. Every open tab gets its events from that bus, so ten tabs cost the same
+two queries a second as one. Because the tailer reads the database rather than
+hooking the views, it sees what every process did, including API syncs,
+imports and background jobs.
+
+Under waitress or gthread workers each open stream holds a worker thread, so
+only MAX_THREAD_STREAMS dashboards per process get one. The rest are turned
+away with a 503 and the page tries again later. Under gevent there's no limit.
+
+"Active users" are the users with logged activity in the last
+ACTIVE_WINDOW seconds who haven't logged out since.
+"""
+
+import sys
+import json
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+from activity import ACTION_LABELS
+from utils import format_file_size
+from database import connect
+
+POLL_INTERVAL = 1.0
+ACTIVE_WINDOW = 15 * 60
+# Comment line sent when nothing has happened, so proxies don't close the connection
+KEEPALIVE_INTERVAL = 15
+# Events queued per open dashboard before it starts missing them. Stats events
+# hold totals rather than differences, so a missed one is corrected by the next
+SUBSCRIBER_QUEUE_SIZE = 100
+# Log rows read per poll, the rest are picked up on the next one
+LOG_BATCH = 200
+# Dashboards streaming at once per process when each one holds a worker thread
+# (waitress, gthread), so open tabs can't take every thread from other requests
+MAX_THREAD_STREAMS = 2
+
+class EventBus:
+    """Fan out (event, data) pairs to every subscriber's queue in this process"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.has_subscribers = threading.Event()
+
+    def subscribe(self):
+        q = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(q)
+            self.has_subscribers.set()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+            if not self._subscribers:
+                self.has_subscribers.clear()
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                # A stalled connection, drop the event rather than block everyone
+                pass
+
+bus = EventBus()
+
+_tailer = None
+_tailer_lock = threading.Lock()
+_state_lock = threading.Lock()
+_stats = {}
+_last_seen = {}
+_stream_slots = threading.BoundedSemaphore(MAX_THREAD_STREAMS)
+
+def read_site_stats(c):
+    """Totals for the dashboard from the counter rows, without scanning any table"""
+    c.execute('''SELECT s.users, s.notes, s.files, u.bytes_used
+                 FROM site_stats s, storage_usage u WHERE s.id = 1 AND u.id = 1''')
+    users, notes, files, bytes_used = c.fetchone()
+    return {
+        'users': users,
+        'notes': notes,
+        'files': files,
+        'bytes_used': bytes_used,
+        'storage': format_file_size(bytes_used)
+    }
+
+def _parse_time(created_at):
+    return datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+
+def _seed_active_users(c):
+    """Fill _last_seen from the log, walking back from the newest row until it
+    gets past the active window. Returns the newest log id"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ACTIVE_WINDOW)
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM system_logs')
+    last_id = c.fetchone()[0]
+    logged_out = set()
+    c.execute('SELECT user_id, action, created_at FROM system_logs ORDER BY id DESC')
+    for user_id, action, created_at in c:
+        seen = _parse_time(created_at)
+        if seen < cutoff:
+            break
+        if user_id is None or user_id in _last_seen or user_id in logged_out:
+            continue
+        if action == 'logout':
+            logged_out.add(user_id)
+        else:
+            _last_seen[user_id] = seen
+    return last_id
+
+def _active_users():
+    cutoff = datetime.utcnow() - timedelta(seconds=ACTIVE_WINDOW)
+    for user_id in [user_id for user_id, seen in _last_seen.items() if seen < cutoff]:
+        del _last_seen[user_id]
+    return len(_last_seen)
+
+def _poll(c, last_id):
+    """Publish what changed since the last poll, returns the newest log id seen"""
+    c.execute('''SELECT l.id, l.user_id, u.username, l.action, l.details, l.ip_address, l.created_at
+                 FROM system_logs l LEFT JOIN users u ON u.id = l.user_id
+                 WHERE l.id > ? ORDER BY l.id LIMIT ?''', (last_id, LOG_BATCH))
+    events = c.fetchall()
+    stats = read_site_stats(c)
+
+    with _state_lock:
+        for event_id, user_id, username, action, details, ip_address, created_at in events:
+            if user_id is None:
+                continue
+            if action == 'logout':
+                _last_seen.pop(user_id, None)
+            else:
+                _last_seen[user_id] = _parse_time(created_at)
+        stats['active_users'] = _active_users()
+        # Only the values that changed
+        changes = {name: value for name, value in stats.items() if _stats.get(name) != value}
+        _stats.update(stats)
+
+    if changes:
+        bus.publish('stats', changes)
+    for event_id, user_id, username, action, details, ip_address, created_at in events:
+        bus.publish('activity', {
+            'id': event_id,
+            'user_id': user_id,
+            'username': username,
+            'action': ACTION_LABELS.get(action, action),
+            'details': details,
+            'ip_address': ip_address,
+            'created_at': created_at
+        })
+    return events[-1][0] if events else last_id
+
+def _tailer_loop():
+    last_id = None
+    while True:
+        if not bus.has_subscribers.is_set():
+            # Nothing is tracked while idle, so forget the totals and start
+            # again from the log when someone connects
+            with _state_lock:
+                _stats.clear()
+            bus.has_subscribers.wait()
+            last_id = None
+
+        conn = connect()
+        c = conn.cursor()
+        try:
+            if last_id is None:
+                with _state_lock:
+                    _last_seen.clear()
+                    last_id = _seed_active_users(c)
+            last_id = _poll(c, last_id)
+        except Exception:
+            # Most likely the database being busy, the next poll catches up
+            pass
+        finally:
+            conn.close()
+        time.sleep(POLL_INTERVAL)
+
+def _start_tailer():
+    global _tailer
+    with _tailer_lock:
+        if _tailer is None:
+            _tailer = threading.Thread(target=_tailer_loop, name='live-stats', daemon=True)
+            _tailer.start()
+
+def current_stats():
+    """Latest totals, straight from the database if the tailer hasn't got them yet"""
+    with _state_lock:
+        if 'active_users' in _stats:
+            return dict(_stats)
+
+    conn = connect()
+    c = conn.cursor()
+    stats = read_site_stats(c)
+    conn.close()
+    stats['active_users'] = None
+    return stats
+
+def _greenlets():
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('threading'))
+
+def claim_stream():
+    """Make room for one more open dashboard. Returns a function to call when
+    its stream closes, or None if this process already has MAX_THREAD_STREAMS.
+    Under gevent a stream only parks a greenlet, so there's no limit"""
+    if _greenlets():
+        return lambda: None
+    if not _stream_slots.acquire(blocking=False):
+        return None
+    return _stream_slots.release
+
+def _format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+def event_stream():
+    """Server-sent events for one dashboard, starting with the current totals.
+    Subscribes before taking them so nothing is missed in between"""
+    q = bus.subscribe()
+    try:
+        _start_tailer()
+        # Reconnect after 5s if the connection drops
+        yield 'retry: 5000\n\n'
+        yield _format_event('stats', current_stats())
+        while True:
+            try:
+                event, data = q.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                # Also how a closed connection gets noticed
+                yield ': keepalive\n\n'
+                continue
+            yield _format_event(event, data)
+    finally:
+        bus.unsubscribe(q)
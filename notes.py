@@ -1,31 +1,119 @@
 import sqlite3
+import threading
+import time
+import zlib
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from auth import login_required
+from sync import record_change, OP_DELETE
+from fragments import cached_fragment, user_version
+from activity import log_activity
+from database import connect
 
 notes_bp = Blueprint('notes', __name__)
 
+# Note payload format: PAYLOAD_PREFIX + Fernet token of (codec byte + body).
+# Older notes are a plain Fernet token of the UTF-8 text and still decrypt.
+PAYLOAD_PREFIX = 'v2:'
+CODEC_RAW = b'\x00'
+CODEC_ZLIB = b'\x01'
+
+# Notes smaller than this aren't worth compressing
+COMPRESS_THRESHOLD = 256
+
+# Legacy notes converted per transaction by the background migrator
+MIGRATE_BATCH_SIZE = 200
+
+def get_fernet(key, previous_key=None):
+    # During a key rotation notes can be on either the new or the previous key
+    if previous_key:
+        return MultiFernet([Fernet(key.encode()), Fernet(previous_key.encode())])
+    return Fernet(key.encode())
+
 # Encryption utilities
 def encrypt_text(text, key):
-    f = Fernet(key.encode())
-    return f.encrypt(text.encode()).decode()
+    data = text.encode()
+    payload = CODEC_RAW + data
+    if len(data) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            payload = CODEC_ZLIB + compressed
+    return PAYLOAD_PREFIX + Fernet(key.encode()).encrypt(payload).decode()
+
+def decrypt_text(encrypted_text, key, previous_key=None):
+    f = get_fernet(key, previous_key)
+    if not encrypted_text.startswith(PAYLOAD_PREFIX):
+        return f.decrypt(encrypted_text.encode()).decode()
+
+    payload = f.decrypt(encrypted_text[len(PAYLOAD_PREFIX):].encode())
+    codec, body = payload[:1], payload[1:]
+    if codec == CODEC_ZLIB:
+        body = zlib.decompress(body)
+    return body.decode()
+
+def reencrypt_text(encrypted_text, key, previous_key=None):
+    """Re-encrypt a note with key in the current payload format"""
+    return encrypt_text(decrypt_text(encrypted_text, key, previous_key), key)
+
+def migrate_legacy_notes(after_id=0, batch_size=MIGRATE_BATCH_SIZE):
+    """Convert the next batch of legacy notes to the compressed format.
+    Returns the last note id looked at, or None when there are none left."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT n.id, n.content, u.encryption_key, u.previous_encryption_key
+                 FROM notes n JOIN users u ON n.user_id = u.id
+                 WHERE n.id > ? AND n.content NOT LIKE ? ORDER BY n.id LIMIT ?''',
+              (after_id, PAYLOAD_PREFIX + '%', batch_size))
+    rows = c.fetchall()
+
+    updates = []
+    for note_id, content, key, previous_key in rows:
+        try:
+            updates.append((reencrypt_text(content, key, previous_key), note_id, content))
+        except InvalidToken:
+            # Leave notes we can't decrypt as they are
+            continue
+
+    # Only replace notes that weren't edited since we read them
+    c.executemany('UPDATE notes SET content = ? WHERE id = ? AND content = ?', updates)
+    conn.commit()
+    conn.close()
+    return rows[-1][0] if rows else None
+
+def _migrate_loop():
+    after_id = 0
+    while after_id is not None:
+        try:
+            after_id = migrate_legacy_notes(after_id)
+        except sqlite3.OperationalError:
+            # Database busy, back off and retry
+            time.sleep(1)
+        time.sleep(0.05)
 
-def decrypt_text(encrypted_text, key):
-    f = Fernet(key.encode())
-    return f.decrypt(encrypted_text.encode()).decode()
+def start_note_migrator():
+    """Convert legacy notes to the compressed format in a background thread"""
+    threading.Thread(target=_migrate_loop, name='note-migrator', daemon=True).start()
 
 @notes_bp.route('/notes')
 @login_required
 def notes():
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
-    c.execute('''SELECT n.id, n.title, n.created_at, n.updated_at, u.encryption_key
-                 FROM notes n JOIN users u ON n.user_id = u.id 
-                 WHERE n.user_id = ? ORDER BY n.updated_at DESC''', (session['user_id'],))
+    version = user_version(c, session['user_id'])
+    conn.close()
+    
+    notes_list = cached_fragment(('notes', session['user_id'], version), render_notes_list)
+    return render_template('notes.html', notes_list=notes_list)
+
+def render_notes_list():
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, title, created_at, updated_at
+                 FROM notes WHERE user_id = ? ORDER BY updated_at DESC''', (session['user_id'],))
     notes_data = c.fetchall()
     conn.close()
     
-    return render_template('notes.html', notes=notes_data)
+    return render_template('_notes_list.html', notes=notes_data)
 
 @notes_bp.route('/add_note', methods=['GET', 'POST'])
 @login_required
@@ -35,7 +123,7 @@ def add_note():
         content = request.form['content']
         
         # Get user's encryption key
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
         c.execute('SELECT encryption_key FROM users WHERE id = ?', (session['user_id'],))
         encryption_key = c.fetchone()[0]
@@ -45,6 +133,9 @@ def add_note():
         
         c.execute('INSERT INTO notes (user_id, title, content) VALUES (?, ?, ?)',
                  (session['user_id'], title, encrypted_content))
+        note_id = c.lastrowid
+        record_change(c, session['user_id'], 'note', note_id)
+        log_activity('note_created', f'note {note_id}', c=c)
         conn.commit()
         conn.close()
         
@@ -56,16 +147,31 @@ def add_note():
 @notes_bp.route('/edit_note/<int:note_id>', methods=['GET', 'POST'])
 @login_required
 def edit_note(note_id):
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     if request.method == 'POST':
         title = request.form['title']
         content = request.form['content']
         
-        # Get user's encryption key
-        c.execute('SELECT encryption_key FROM users WHERE id = ?', (session['user_id'],))
-        encryption_key = c.fetchone()[0]
+        from revisions import record_revision
+        
+        # Take the write lock before reading, so a concurrent edit can't land in
+        # between and leave the revision delta built on a stale note
+        c.execute('BEGIN IMMEDIATE')
+        
+        # Get the current note and user's encryption key
+        c.execute('''SELECT n.title, n.content, u.encryption_key, u.previous_encryption_key
+                     FROM notes n JOIN users u ON n.user_id = u.id 
+                     WHERE n.id = ? AND n.user_id = ?''', (note_id, session['user_id']))
+        note_data = c.fetchone()
+        
+        if not note_data:
+            conn.close()
+            flash('Note not found', 'error')
+            return redirect(url_for('notes.notes'))
+        
+        encryption_key = note_data[2]
         
         # Encrypt the new content
         encrypted_content = encrypt_text(content, encryption_key)
@@ -73,6 +179,14 @@ def edit_note(note_id):
         c.execute('''UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP 
                      WHERE id = ? AND user_id = ?''',
                  (title, encrypted_content, note_id, session['user_id']))
+        
+        # Keep the previous version in the note's history
+        record_revision(c, note_id, session['user_id'], title, content, encryption_key,
+                        previous_title=note_data[0],
+                        previous_content=decrypt_text(note_data[1], encryption_key, note_data[3]),
+                        previous_key=note_data[3])
+        record_change(c, session['user_id'], 'note', note_id)
+        log_activity('note_updated', f'note {note_id}', c=c)
         conn.commit()
         conn.close()
         
@@ -80,7 +194,7 @@ def edit_note(note_id):
         return redirect(url_for('notes.notes'))
     
     # Get note for editing
-    c.execute('''SELECT n.title, n.content, u.encryption_key
+    c.execute('''SELECT n.title, n.content, u.encryption_key, u.previous_encryption_key
                  FROM notes n JOIN users u ON n.user_id = u.id 
                  WHERE n.id = ? AND n.user_id = ?''', (note_id, session['user_id']))
     note_data = c.fetchone()
@@ -91,7 +205,7 @@ def edit_note(note_id):
         return redirect(url_for('notes.notes'))
     
     # Decrypt content for editing
-    decrypted_content = decrypt_text(note_data[1], note_data[2])
+    decrypted_content = decrypt_text(note_data[1], note_data[2], note_data[3])
     
     return render_template('edit_note.html', note_id=note_id, 
                          title=note_data[0], content=decrypted_content)
@@ -99,9 +213,9 @@ def edit_note(note_id):
 @notes_bp.route('/view_note/<int:note_id>')
 @login_required
 def view_note(note_id):
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
-    c.execute('''SELECT n.title, n.content, n.created_at, n.updated_at, u.encryption_key
+    c.execute('''SELECT n.title, n.content, n.created_at, n.updated_at, u.encryption_key, u.previous_encryption_key
                  FROM notes n JOIN users u ON n.user_id = u.id 
                  WHERE n.id = ? AND n.user_id = ?''', (note_id, session['user_id']))
     note_data = c.fetchone()
@@ -112,7 +226,7 @@ def view_note(note_id):
         return redirect(url_for('notes.notes'))
     
     # Decrypt content for viewing
-    decrypted_content = decrypt_text(note_data[1], note_data[4])
+    decrypted_content = decrypt_text(note_data[1], note_data[4], note_data[5])
     
     return render_template('view_note.html', 
                          title=note_data[0], content=decrypted_content,
@@ -121,9 +235,14 @@ def view_note(note_id):
 @notes_bp.route('/delete_note/<int:note_id>')
 @login_required
 def delete_note(note_id):
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     c.execute('DELETE FROM notes WHERE id = ? AND user_id = ?', (note_id, session['user_id']))
+    if c.rowcount:
+        # Leave a tombstone so synced clients drop the note too
+        record_change(c, session['user_id'], 'note', note_id, OP_DELETE)
+        log_activity('note_deleted', f'note {note_id}', c=c)
+    c.execute('DELETE FROM note_revisions WHERE note_id = ? AND user_id = ?', (note_id, session['user_id']))
     conn.commit()
     conn.close()
     
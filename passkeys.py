@@ -0,0 +1,147 @@
+import sqlite3
+import base64
+import binascii
+import threading
+import atexit
+from collections import OrderedDict
+from datetime import datetime
+from database import connect
+
+# How many decoded public keys to keep in memory
+PUBLIC_KEY_CACHE_SIZE = 1024
+
+# How often (seconds) pending sign count updates are written to the database
+FLUSH_INTERVAL = 5
+
+_public_keys = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Write-behind queue: credential_key -> (sign_count, last_used)
+_pending_updates = {}
+_pending_lock = threading.Lock()
+_writer = None
+_writer_stop = threading.Event()
+
+def decode_credential_id(value):
+    """Decode a credential ID sent by the browser (base64 or base64url) to bytes"""
+    if not value:
+        return None
+    value = value.replace('-', '+').replace('_', '/')
+    try:
+        return base64.b64decode(value + '=' * (-len(value) % 4))
+    except (binascii.Error, ValueError):
+        return None
+
+def _cached_public_key(credential_key):
+    with _cache_lock:
+        public_key = _public_keys.get(credential_key)
+        if public_key is not None:
+            _public_keys.move_to_end(credential_key)
+        return public_key
+
+def _cache_public_key(credential_key, public_key):
+    with _cache_lock:
+        _public_keys[credential_key] = public_key
+        _public_keys.move_to_end(credential_key)
+        while len(_public_keys) > PUBLIC_KEY_CACHE_SIZE:
+            _public_keys.popitem(last=False)
+
+def forget_passkey(credential_key):
+    """Drop a credential from the in-memory cache"""
+    with _cache_lock:
+        _public_keys.pop(credential_key, None)
+
+def get_passkey(credential_key):
+    """Load everything needed to verify a passkey login with one indexed read"""
+    public_key = _cached_public_key(credential_key)
+
+    conn = connect()
+    c = conn.cursor()
+    if public_key is None:
+        c.execute('''SELECT p.user_id, u.username, u.is_admin, u.force_reset, p.sign_count, p.public_key
+                     FROM user_passkeys p JOIN users u ON u.id = p.user_id
+                     WHERE p.credential_key = ?''', (credential_key,))
+    else:
+        c.execute('''SELECT p.user_id, u.username, u.is_admin, u.force_reset, p.sign_count
+                     FROM user_passkeys p JOIN users u ON u.id = p.user_id
+                     WHERE p.credential_key = ?''', (credential_key,))
+    row = c.fetchone()
+    conn.close()
+
+    if not row:
+        forget_passkey(credential_key)
+        return None
+
+    if public_key is None:
+        public_key = base64.b64decode(row[5])
+        _cache_public_key(credential_key, public_key)
+
+    # The database may lag behind updates still sitting in the queue
+    sign_count = row[4] or 0
+    with _pending_lock:
+        pending = _pending_updates.get(credential_key)
+    if pending:
+        sign_count = max(sign_count, pending[0])
+
+    return {
+        'user_id': row[0],
+        'username': row[1],
+        'is_admin': row[2],
+        'force_reset': row[3],
+        'sign_count': sign_count,
+        'public_key': public_key
+    }
+
+def record_passkey_use(credential_key, sign_count):
+    """Queue a sign count / last used update for the background writer"""
+    last_used = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    with _pending_lock:
+        previous = _pending_updates.get(credential_key)
+        if previous:
+            sign_count = max(sign_count, previous[0])
+        _pending_updates[credential_key] = (sign_count, last_used)
+    _start_writer()
+
+def flush_passkey_updates():
+    """Write all queued passkey updates in a single transaction"""
+    global _pending_updates
+    with _pending_lock:
+        if not _pending_updates:
+            return 0
+        updates, _pending_updates = _pending_updates, {}
+
+    conn = connect()
+    try:
+        conn.executemany('''UPDATE user_passkeys SET sign_count = MAX(sign_count, ?), last_used = ?
+                            WHERE credential_key = ?''',
+                         [(sign_count, last_used, credential_key)
+                          for credential_key, (sign_count, last_used) in updates.items()])
+        conn.commit()
+    except sqlite3.Error:
+        # Put the updates back so the next flush retries them
+        with _pending_lock:
+            for credential_key, update in updates.items():
+                _pending_updates.setdefault(credential_key, update)
+        raise
+    finally:
+        conn.close()
+    return len(updates)
+
+def _writer_loop():
+    while not _writer_stop.wait(FLUSH_INTERVAL):
+        try:
+            flush_passkey_updates()
+        except sqlite3.Error:
+            pass
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _pending_lock:
+        if _writer is not None:
+            return
+        _writer = threading.Thread(target=_writer_loop, name='passkey-writer', daemon=True)
+        _writer.start()
+
+atexit.register(flush_passkey_updates)
@@ -0,0 +1,233 @@
+"""
+Thumbnails and previews for uploaded images and PDFs
+
+Previews are made in a small thread pool after upload and cached on local disk
+(PREVIEW_FOLDER) by the SHA-256 of the original file, so the same content is only
+rendered once. Cached previews are encrypted with a key derived from that hash:
+without the files table (which holds the hashes) the cache is unreadable.
+
+Images need Pillow (installed with qrcode[pil]), PDFs also need PyMuPDF
+(pip install pymupdf). Without them files just don't get a preview.
+"""
+
+import os
+import io
+import hashlib
+import tempfile
+import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from storage import storage_for
+from file_crypto import unwrap_file_key, decrypt_range
+from utils import file_extension
+from database import connect
+from fragments import bump_previews_version
+
+# Longest side in pixels of each preview size
+PREVIEW_SIZES = {'small': 256, 'large': 1280}
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+PDF_EXTENSIONS = {'pdf'}
+
+# files.preview_status values
+PREVIEW_PENDING = 'pending'
+PREVIEW_READY = 'ready'
+PREVIEW_FAILED = 'failed'
+
+# Decrypted originals bigger than this are spooled to a temp file while rendering
+SPOOL_SIZE = 8 * 1024 * 1024
+
+_folder = 'previews'
+_workers = 2
+_executor = None
+_lock = threading.Lock()
+
+def configure_previews(config):
+    """Read PREVIEW_FOLDER and PREVIEW_WORKERS from the app config"""
+    global _folder, _workers
+    _folder = config.get('PREVIEW_FOLDER') or 'previews'
+    _workers = int(config.get('PREVIEW_WORKERS') or 2)
+    os.makedirs(_folder, exist_ok=True)
+
+class HashingReader:
+    """Wraps a readable stream and hashes everything read through it"""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+def _have_pdf_renderer():
+    try:
+        import fitz  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def can_preview(filename):
+    """Whether previews can be made for this kind of file here"""
+    ext = file_extension(filename)
+    return ext in IMAGE_EXTENSIONS or (ext in PDF_EXTENSIONS and _have_pdf_renderer())
+
+def _cache_name(content_hash, size):
+    # Name and key are both derived from the hash, but neither gives away the other
+    digest = hashlib.sha256(f'name:{content_hash}:{size}'.encode()).hexdigest()
+    return os.path.join(_folder, digest[:2], digest)
+
+def _cache_key(content_hash):
+    return hashlib.sha256(f'key:{content_hash}'.encode()).digest()
+
+def read_preview(content_hash, size):
+    """Decrypted preview image bytes, or None if it isn't cached"""
+    try:
+        with open(_cache_name(content_hash, size), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    return AESGCM(_cache_key(content_hash)).decrypt(data[:12], data[12:], size.encode())
+
+def _write_preview(content_hash, size, image):
+    path = _cache_name(content_hash, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nonce = os.urandom(12)
+    data = nonce + AESGCM(_cache_key(content_hash)).encrypt(nonce, image, size.encode())
+    # Write then rename so a reader never sees half a file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def is_cached(content_hash):
+    return all(os.path.exists(_cache_name(content_hash, size)) for size in PREVIEW_SIZES)
+
+def remove_cached(content_hash):
+    for size in PREVIEW_SIZES:
+        try:
+            os.remove(_cache_name(content_hash, size))
+        except FileNotFoundError:
+            pass
+
+def preview_mimetype(image):
+    return 'image/png' if image.startswith(b'\x89PNG') else 'image/jpeg'
+
+def _open_pdf_page(source):
+    import fitz
+    from PIL import Image
+    with fitz.open(stream=source.read(), filetype='pdf') as doc:
+        page = doc[0]
+        zoom = max(PREVIEW_SIZES.values()) / max(page.rect.width, page.rect.height)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+def _open_image(source):
+    from PIL import Image, ImageOps
+    image = Image.open(source)
+    # Let JPEG decode at reduced scale, much faster for big photos
+    largest = max(PREVIEW_SIZES.values())
+    image.draft('RGB', (largest, largest))
+    image.seek(0)  # first frame of an animated GIF
+    return ImageOps.exif_transpose(image)
+
+def render_previews(source, filename):
+    """{size: encoded image} for an image or PDF read from source"""
+    image = _open_pdf_page(source) if file_extension(filename) in PDF_EXTENSIONS else _open_image(source)
+
+    transparent = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if transparent else 'RGB')
+
+    results = {}
+    # Biggest first so each smaller size is scaled from the previous one
+    for size, pixels in sorted(PREVIEW_SIZES.items(), key=lambda item: -item[1]):
+        image.thumbnail((pixels, pixels))
+        out = io.BytesIO()
+        if transparent:
+            image.save(out, 'PNG', optimize=True)
+        else:
+            image.save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+        results[size] = out.getvalue()
+    return results
+
+def generate_previews(file_id):
+    """Make and cache the previews for one file, returns the new preview status"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT f.file_path, f.storage_backend, f.original_filename, f.file_key, f.content_hash,
+                        u.encryption_key, u.previous_encryption_key, f.user_id
+                 FROM files f JOIN users u ON f.user_id = u.id WHERE f.id = ?''', (file_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row or not row[3] or not can_preview(row[2]):
+        return None
+
+    file_path, backend, filename, wrapped_key, content_hash, user_key, previous_key, user_id = row
+    status = PREVIEW_READY
+    if not (content_hash and is_cached(content_hash)):
+        try:
+            file_key = unwrap_file_key(wrapped_key, user_key, previous_key)
+            storage, storage_key = storage_for(backend, file_path)
+            with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as plain:
+                hasher = hashlib.sha256()
+                with storage.open_read(storage_key) as f:
+                    for chunk in decrypt_range(f, file_key):
+                        hasher.update(chunk)
+                        plain.write(chunk)
+                content_hash = hasher.hexdigest()
+                if not is_cached(content_hash):
+                    plain.seek(0)
+                    for size, image in render_previews(plain, filename).items():
+                        _write_preview(content_hash, size, image)
+        except Exception:
+            # Missing or corrupt files, and Pillow and PyMuPDF raise all sorts
+            # of errors for images and PDFs they can't read
+            status = PREVIEW_FAILED
+
+    conn = connect()
+    c = conn.cursor()
+    c.execute('UPDATE files SET content_hash = COALESCE(content_hash, ?), preview_status = ? WHERE id = ?',
+              (content_hash, status, file_id))
+    if c.rowcount == 1:
+        # So the cached file list picks up the thumbnail
+        bump_previews_version(c, user_id)
+        conn.commit()
+    elif content_hash:
+        # Deleted while we rendered, after delete_file cleared the cache. Drop what
+        # we wrote unless another file has the same content
+        c.execute('SELECT 1 FROM files WHERE content_hash = ? LIMIT 1', (content_hash,))
+        if not c.fetchone():
+            remove_cached(content_hash)
+        status = None
+    conn.close()
+    return status
+
+def _generate_safely(file_id):
+    try:
+        generate_previews(file_id)
+    except sqlite3.OperationalError:
+        # Database busy, the file stays pending and is picked up on the next start
+        pass
+
+def queue_previews(file_ids):
+    """Make previews for these files in the background"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='previews')
+    for file_id in file_ids:
+        _executor.submit(_generate_safely, file_id)
+
+def queue_pending_previews():
+    """Queue every file still waiting for a preview, e.g. after a restart"""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT id FROM files WHERE preview_status = ? ORDER BY id', (PREVIEW_PENDING,))
+    file_ids = [row[0] for row in c.fetchall()]
+    conn.close()
+    queue_previews(file_ids)
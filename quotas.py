@@ -0,0 +1,68 @@
+"""
+Storage quotas
+
+Each user has a running users.bytes_used counter, and storage_usage holds the
+total for the whole instance. Both are changed with a conditional UPDATE in the
+same transaction as the files row, so checking a quota never sums the files table.
+
+Limits come from the app config (0 means no limit):
+    USER_QUOTA_BYTES     default per-user limit, overridden by users.quota_bytes
+    TOTAL_QUOTA_BYTES    limit for all users together
+"""
+
+_user_quota = 0
+_total_quota = 0
+
+class QuotaExceeded(Exception):
+    """Raised when storing a file would go over a user's or the instance's quota"""
+
+def configure_quotas(config):
+    """Read the limits from the app config"""
+    global _user_quota, _total_quota
+    _user_quota = int(config.get('USER_QUOTA_BYTES') or 0)
+    _total_quota = int(config.get('TOTAL_QUOTA_BYTES') or 0)
+
+def get_usage(c, user_id):
+    """(bytes used, limit or 0 for none) for a user"""
+    c.execute('SELECT bytes_used, quota_bytes FROM users WHERE id = ?', (user_id,))
+    row = c.fetchone()
+    if not row:
+        return 0, 0
+    return row[0], row[1] if row[1] is not None else _user_quota
+
+def would_exceed(c, user_id, nbytes):
+    """Cheap check before accepting an upload, e.g. from its Content-Length.
+    Not a reservation, charge() is still what enforces the quota."""
+    used, limit = get_usage(c, user_id)
+    if limit and used + nbytes > limit:
+        return True
+    if _total_quota:
+        c.execute('SELECT bytes_used FROM storage_usage WHERE id = 1')
+        row = c.fetchone()
+        if row and row[0] + nbytes > _total_quota:
+            return True
+    return False
+
+def charge(c, user_id, nbytes):
+    """Add nbytes to the user's and instance's usage, or raise QuotaExceeded.
+    Runs inside the caller's transaction, so roll back on failure."""
+    c.execute('''UPDATE users SET bytes_used = bytes_used + ?
+                 WHERE id = ? AND (COALESCE(quota_bytes, ?) = 0 OR bytes_used + ? <= COALESCE(quota_bytes, ?))''',
+              (nbytes, user_id, _user_quota, nbytes, _user_quota))
+    if c.rowcount == 0:
+        raise QuotaExceeded('Storage quota exceeded')
+
+    c.execute('''UPDATE storage_usage SET bytes_used = bytes_used + ?
+                 WHERE id = 1 AND (? = 0 OR bytes_used + ? <= ?)''',
+              (nbytes, _total_quota, nbytes, _total_quota))
+    if c.rowcount == 0:
+        raise QuotaExceeded('Server storage is full')
+
+def release(c, user_id, nbytes):
+    """Give back the space of a deleted file"""
+    c.execute('UPDATE users SET bytes_used = MAX(bytes_used - ?, 0) WHERE id = ?', (nbytes, user_id))
+    c.execute('UPDATE storage_usage SET bytes_used = MAX(bytes_used - ?, 0) WHERE id = 1', (nbytes,))
+
+def set_user_quota(c, user_id, quota_bytes):
+    """Set a user's limit, None goes back to the default and 0 means unlimited"""
+    c.execute('UPDATE users SET quota_bytes = ? WHERE id = ?', (quota_bytes, user_id))
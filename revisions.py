@@ -0,0 +1,192 @@
+import json
+import difflib
+from flask import Blueprint, render_template, redirect, url_for, session, flash
+from auth import login_required
+from notes import encrypt_text, decrypt_text
+from activity import log_activity
+from sync import record_change
+from database import connect
+
+revisions_bp = Blueprint('revisions', __name__)
+
+# Every Nth revision is stored in full, the ones in between as deltas
+SNAPSHOT_INTERVAL = 10
+
+# Revisions kept per note, older ones are pruned
+MAX_REVISIONS = 50
+
+def make_delta(old_text, new_text):
+    """Line based delta that turns old_text into new_text"""
+    old_lines = old_text.splitlines(keepends=True)
+    new_lines = new_text.splitlines(keepends=True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(['=', i2 - i1])
+            continue
+        if tag in ('replace', 'delete'):
+            delta.append(['-', i2 - i1])
+        if tag in ('replace', 'insert'):
+            delta.append(['+', ''.join(new_lines[j1:j2])])
+    return delta
+
+def apply_delta(old_text, delta):
+    """Rebuild the new text from old_text and a delta from make_delta"""
+    old_lines = old_text.splitlines(keepends=True)
+    position = 0
+    parts = []
+    for op, value in delta:
+        if op == '=':
+            parts.extend(old_lines[position:position + value])
+            position += value
+        elif op == '-':
+            position += value
+        else:
+            parts.append(value)
+    return ''.join(parts)
+
+def record_revision(c, note_id, user_id, title, content, key,
+                    previous_title=None, previous_content=None, previous_key=None):
+    """Add a revision for a note that was just saved with content.
+    previous_title/previous_content are the note before the save, used for the
+    delta and to start history for notes created before revisions existed.
+    They must be read in the same write transaction (BEGIN IMMEDIATE), or two
+    concurrent edits get a delta against a stale note and the same revision number."""
+    c.execute('SELECT MAX(revision) FROM note_revisions WHERE note_id = ?', (note_id,))
+    latest = c.fetchone()[0]
+
+    if latest is None and previous_content is not None:
+        c.execute('''INSERT INTO note_revisions (note_id, user_id, revision, title, is_snapshot, payload)
+                     VALUES (?, ?, 1, ?, 1, ?)''',
+                  (note_id, user_id, previous_title or title, encrypt_text(previous_content, key)))
+        latest = 1
+
+    revision = (latest or 0) + 1
+    if previous_content is None or (revision - 1) % SNAPSHOT_INTERVAL == 0:
+        is_snapshot, payload = 1, content
+    else:
+        is_snapshot, payload = 0, json.dumps(make_delta(previous_content, content))
+
+    c.execute('''INSERT INTO note_revisions (note_id, user_id, revision, title, is_snapshot, payload)
+                 VALUES (?, ?, ?, ?, ?, ?)''',
+              (note_id, user_id, revision, title, is_snapshot, encrypt_text(payload, key)))
+
+    prune_revisions(c, note_id, key, previous_key)
+    return revision
+
+def load_revision(c, note_id, revision, key, previous_key=None):
+    """Rebuild the content of a revision from the nearest snapshot and the deltas after it"""
+    c.execute('''SELECT revision, is_snapshot, payload FROM note_revisions
+                 WHERE note_id = ? AND revision <= ? AND revision >= (
+                     SELECT MAX(revision) FROM note_revisions
+                     WHERE note_id = ? AND revision <= ? AND is_snapshot = 1)
+                 ORDER BY revision''', (note_id, revision, note_id, revision))
+    rows = c.fetchall()
+    if not rows or rows[-1][0] != revision:
+        return None
+
+    content = decrypt_text(rows[0][2], key, previous_key)
+    for _, _, payload in rows[1:]:
+        content = apply_delta(content, json.loads(decrypt_text(payload, key, previous_key)))
+    return content
+
+def prune_revisions(c, note_id, key, previous_key=None, limit=None):
+    """Drop revisions beyond the limit, turning the oldest kept one into a snapshot"""
+    limit = limit or MAX_REVISIONS
+    c.execute('SELECT MIN(revision), MAX(revision) FROM note_revisions WHERE note_id = ?', (note_id,))
+    oldest, latest = c.fetchone()
+    if latest is None or latest - oldest + 1 <= limit:
+        return 0
+
+    cutoff = latest - limit + 1
+    c.execute('SELECT is_snapshot FROM note_revisions WHERE note_id = ? AND revision = ?', (note_id, cutoff))
+    if not c.fetchone()[0]:
+        content = load_revision(c, note_id, cutoff, key, previous_key)
+        c.execute('''UPDATE note_revisions SET is_snapshot = 1, payload = ?
+                     WHERE note_id = ? AND revision = ?''',
+                  (encrypt_text(content, key), note_id, cutoff))
+
+    c.execute('DELETE FROM note_revisions WHERE note_id = ? AND revision < ?', (note_id, cutoff))
+    return c.rowcount
+
+@revisions_bp.route('/note_history/<int:note_id>')
+@login_required
+def note_history(note_id):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT title FROM notes WHERE id = ? AND user_id = ?', (note_id, session['user_id']))
+    note = c.fetchone()
+
+    if not note:
+        conn.close()
+        flash('Note not found', 'error')
+        return redirect(url_for('notes.notes'))
+
+    c.execute('''SELECT revision, title, created_at FROM note_revisions
+                 WHERE note_id = ? ORDER BY revision DESC''', (note_id,))
+    revisions = c.fetchall()
+    conn.close()
+
+    return render_template('note_history.html', note_id=note_id, title=note[0], revisions=revisions)
+
+@revisions_bp.route('/note_history/<int:note_id>/<int:revision>')
+@login_required
+def view_revision(note_id, revision):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('''SELECT r.title, r.created_at, u.encryption_key, u.previous_encryption_key
+                 FROM note_revisions r JOIN users u ON r.user_id = u.id
+                 WHERE r.note_id = ? AND r.revision = ? AND r.user_id = ?''',
+              (note_id, revision, session['user_id']))
+    revision_data = c.fetchone()
+
+    content = None
+    if revision_data:
+        content = load_revision(c, note_id, revision, revision_data[2], revision_data[3])
+    conn.close()
+
+    if content is None:
+        flash('Revision not found', 'error')
+        return redirect(url_for('notes.notes'))
+
+    return render_template('view_revision.html', note_id=note_id, revision=revision,
+                         title=revision_data[0], content=content, created_at=revision_data[1])
+
+@revisions_bp.route('/note_history/<int:note_id>/<int:revision>/restore', methods=['POST'])
+@login_required
+def restore_revision(note_id, revision):
+    conn = connect()
+    c = conn.cursor()
+    # Write lock first, the current note is the base of the new revision's delta
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('''SELECT r.title, n.title, n.content, u.encryption_key, u.previous_encryption_key
+                 FROM note_revisions r
+                 JOIN notes n ON r.note_id = n.id
+                 JOIN users u ON r.user_id = u.id
+                 WHERE r.note_id = ? AND r.revision = ? AND r.user_id = ?''',
+              (note_id, revision, session['user_id']))
+    revision_data = c.fetchone()
+
+    if not revision_data:
+        conn.close()
+        flash('Revision not found', 'error')
+        return redirect(url_for('notes.notes'))
+
+    title, current_title, current, key, previous_key = revision_data
+    content = load_revision(c, note_id, revision, key, previous_key)
+
+    c.execute('''UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND user_id = ?''',
+              (title, encrypt_text(content, key), note_id, session['user_id']))
+    record_revision(c, note_id, session['user_id'], title, content, key,
+                    previous_title=current_title,
+                    previous_content=decrypt_text(current, key, previous_key),
+                    previous_key=previous_key)
+    record_change(c, session['user_id'], 'note', note_id)
+    log_activity('note_updated', f'note {note_id}, restored revision {revision}', c=c)
+    conn.commit()
+    conn.close()
+
+    flash(f'Note restored to revision {revision}', 'success')
+    return redirect(url_for('notes.view_note', note_id=note_id))
@@ -1,17 +1,19 @@
-import sqlite3
-import secrets
 import base64
 import json
 from functools import wraps
 from datetime import datetime, timedelta
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, current_app
 from auth import login_required
+from auth_service import (store_backup_codes, generate_backup_codes, verify_second_factor, complete_login,
+                          login_redirect, TooManyAttempts, STEP_RESET)
+from activity import log_activity
+from passkeys import decode_credential_id, get_passkey, record_passkey_use, forget_passkey
 import pyotp
-import qrcode
 from io import BytesIO
-from webauthn import generate_registration_options, verify_registration_response, generate_authentication_options, verify_authentication_response
-from webauthn.helpers.structs import AuthenticatorSelectionCriteria, UserVerificationRequirement, ResidentKeyRequirement, AuthenticatorAttachment
-from webauthn.helpers.cose import COSEAlgorithmIdentifier
+from database import connect
+
+# qrcode (with PIL) and webauthn are slow to import and only needed on the
+# setup and passkey pages, so they are imported inside those views
 
 security_bp = Blueprint('security', __name__)
 
@@ -22,7 +24,7 @@ WEBAUTHN_ORIGIN = "http://localhost:5000"  # Change this to your URL in producti
 
 def init_security_db():
     """Initialize security-related database tables"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # TOTP secrets table
@@ -34,6 +36,31 @@ def init_security_db():
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
     
+    # Wrong 2FA codes, see claim_2fa_attempt
+    c.execute("PRAGMA table_info(user_totp)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'failed_attempts' not in columns:
+        c.execute("ALTER TABLE user_totp ADD COLUMN failed_attempts INTEGER NOT NULL DEFAULT 0")
+    if 'last_failed_at' not in columns:
+        c.execute("ALTER TABLE user_totp ADD COLUMN last_failed_at TIMESTAMP")
+    
+    # Backup codes table (one hashed row per code)
+    c.execute('''CREATE TABLE IF NOT EXISTS user_backup_codes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  code_hash TEXT NOT NULL,
+                  used_at TIMESTAMP,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_backup_codes_user_hash
+                 ON user_backup_codes (user_id, code_hash)''')
+    
+    # Move any legacy JSON backup codes into the table
+    c.execute('SELECT user_id, backup_codes FROM user_totp WHERE backup_codes IS NOT NULL')
+    for user_id, codes_json in c.fetchall():
+        store_backup_codes(c, user_id, json.loads(codes_json))
+        c.execute('UPDATE user_totp SET backup_codes = NULL WHERE user_id = ?', (user_id,))
+    
     # Passkeys table
     c.execute('''CREATE TABLE IF NOT EXISTS user_passkeys
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -46,6 +73,19 @@ def init_security_db():
                   last_used TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
     
+    # Binary credential IDs for indexed lookups at login
+    c.execute("PRAGMA table_info(user_passkeys)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'credential_key' not in columns:
+        c.execute("ALTER TABLE user_passkeys ADD COLUMN credential_key BLOB")
+    c.execute('SELECT id, credential_id FROM user_passkeys WHERE credential_key IS NULL')
+    for passkey_id, credential_id in c.fetchall():
+        c.execute('UPDATE user_passkeys SET credential_key = ? WHERE id = ?',
+                  (decode_credential_id(credential_id), passkey_id))
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_user_passkeys_credential_key
+                 ON user_passkeys (credential_key)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_passkeys_user ON user_passkeys (user_id)')
+    
     # Authentication sessions table
     c.execute('''CREATE TABLE IF NOT EXISTS auth_sessions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -67,7 +107,7 @@ def require_2fa_setup(f):
             return redirect(url_for('auth.login'))
         
         # Check if user has 2FA enabled
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
         c.execute('SELECT is_enabled FROM user_totp WHERE user_id = ?', (session['user_id'],))
         totp_enabled = c.fetchone()
@@ -91,7 +131,7 @@ def require_2fa_setup(f):
 @login_required
 def security_settings():
     """Security settings page"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Get TOTP status
@@ -133,6 +173,7 @@ def setup_totp():
     )
     
     # Generate QR code image
+    import qrcode
     qr = qrcode.QRCode(version=1, box_size=10, border=5)
     qr.add_data(provisioning_uri)
     qr.make(fit=True)
@@ -167,18 +208,19 @@ def verify_totp():
         return redirect(url_for('security.setup_totp'))
     
     # Generate backup codes
-    backup_codes = [secrets.token_hex(4).upper() for _ in range(10)]
+    backup_codes = generate_backup_codes()
     
     # Save to database
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Remove existing TOTP if any
     c.execute('DELETE FROM user_totp WHERE user_id = ?', (session['user_id'],))
     
     # Insert new TOTP
-    c.execute('INSERT INTO user_totp (user_id, secret, is_enabled, backup_codes) VALUES (?, ?, 1, ?)',
-              (session['user_id'], secret, json.dumps(backup_codes)))
+    c.execute('INSERT INTO user_totp (user_id, secret, is_enabled) VALUES (?, ?, 1)',
+              (session['user_id'], secret))
+    store_backup_codes(c, session['user_id'], backup_codes)
     
     conn.commit()
     conn.close()
@@ -200,7 +242,7 @@ def disable_totp():
     
     # Verify password
     from werkzeug.security import check_password_hash
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     c.execute('SELECT password_hash FROM users WHERE id = ?', (session['user_id'],))
     user = c.fetchone()
@@ -211,6 +253,7 @@ def disable_totp():
     
     # Disable TOTP
     c.execute('DELETE FROM user_totp WHERE user_id = ?', (session['user_id'],))
+    c.execute('DELETE FROM user_backup_codes WHERE user_id = ?', (session['user_id'],))
     conn.commit()
     conn.close()
     
@@ -227,9 +270,12 @@ def setup_passkey():
 @login_required
 def passkey_register_begin():
     """Begin passkey registration"""
+    from webauthn import generate_registration_options
+    from webauthn.helpers.structs import AuthenticatorSelectionCriteria, UserVerificationRequirement, ResidentKeyRequirement, AuthenticatorAttachment
+    from webauthn.helpers.cose import COSEAlgorithmIdentifier
     try:
         # Get user info
-        conn = sqlite3.connect('secure_app.db')
+        conn = connect()
         c = conn.cursor()
         c.execute('SELECT username FROM users WHERE id = ?', (session['user_id'],))
         user = c.fetchone()
@@ -287,6 +333,7 @@ def passkey_register_begin():
 @login_required
 def passkey_register_complete():
     """Complete passkey registration"""
+    from webauthn import verify_registration_response
     try:
         data = request.get_json()
         challenge = session.get('passkey_challenge')
@@ -306,17 +353,19 @@ def passkey_register_complete():
             # Store passkey in database
             passkey_name = data.get('name', f"Passkey {datetime.now().strftime('%Y-%m-%d %H:%M')}")
             
-            conn = sqlite3.connect('secure_app.db')
+            conn = connect()
             c = conn.cursor()
             c.execute('''INSERT INTO user_passkeys 
-                         (user_id, credential_id, public_key, name)
-                         VALUES (?, ?, ?, ?)''',
+                         (user_id, credential_id, credential_key, public_key, name)
+                         VALUES (?, ?, ?, ?, ?)''',
                       (session['user_id'], 
                        base64.b64encode(verification.credential_id).decode(),
+                       verification.credential_id,
                        base64.b64encode(verification.credential_public_key).decode(),
                        passkey_name))
             conn.commit()
             conn.close()
+            forget_passkey(verification.credential_id)
             
             # Clear challenge
             session.pop('passkey_challenge', None)
@@ -333,7 +382,7 @@ def passkey_register_complete():
 @login_required
 def delete_passkey(passkey_id):
     """Delete a passkey"""
-    conn = sqlite3.connect('secure_app.db')
+    conn = connect()
     c = conn.cursor()
     
     # Verify ownership and delete
@@ -353,66 +402,30 @@ def delete_passkey(passkey_id):
 @security_bp.route('/auth/2fa', methods=['GET', 'POST'])
 def verify_2fa():
     """2FA verification page"""
-    if 'pending_user_id' not in session:
+    if 'pending_login' not in session:
         return redirect(url_for('auth.login'))
     
     if request.method == 'POST':
-        token = request.form.get('token')
-        backup_code = request.form.get('backup_code')
-        
-        conn = sqlite3.connect('secure_app.db')
-        c = conn.cursor()
-        c.execute('SELECT secret, backup_codes FROM user_totp WHERE user_id = ? AND is_enabled = 1', 
-                  (session['pending_user_id'],))
-        totp_data = c.fetchone()
-        conn.close()
+        try:
+            step = verify_second_factor(token=request.form.get('token'),
+                                        backup_code=request.form.get('backup_code'))
+        except TooManyAttempts as e:
+            log_activity('login_failed', 'too many 2FA attempts', user_id=session['pending_login']['user_id'])
+            flash(str(e), 'error')
+            return render_template('security/verify_2fa.html')
+        if step:
+            return login_redirect(step)
         
-        verified = False
-        
-        if token and totp_data:
-            # Verify TOTP token
-            totp = pyotp.TOTP(totp_data[0])
-            if totp.verify(token):
-                verified = True
-        
-        elif backup_code and totp_data:
-            # Verify backup code
-            backup_codes = json.loads(totp_data[1])
-            if backup_code.upper() in backup_codes:
-                # Remove used backup code
-                backup_codes.remove(backup_code.upper())
-                conn = sqlite3.connect('secure_app.db')
-                c = conn.cursor()
-                c.execute('UPDATE user_totp SET backup_codes = ? WHERE user_id = ?',
-                          (json.dumps(backup_codes), session['pending_user_id']))
-                conn.commit()
-                conn.close()
-                verified = True
-        
-        if verified:
-            # Complete login
-            session['user_id'] = session.pop('pending_user_id')
-            
-            # Get username
-            conn = sqlite3.connect('secure_app.db')
-            c = conn.cursor()
-            c.execute('SELECT username FROM users WHERE id = ?', (session['user_id'],))
-            user = c.fetchone()
-            conn.close()
-            
-            if user:
-                session['username'] = user[0]
-            
-            flash('Login successful!', 'success')
-            return redirect(url_for('dashboard'))
-        else:
-            flash('Invalid verification code or backup code', 'error')
+        log_activity('login_failed', 'wrong 2FA code', user_id=session.get('pending_login', {}).get('user_id'))
+        flash('Invalid verification code or backup code', 'error')
     
     return render_template('security/verify_2fa.html')
 
 @security_bp.route('/auth/passkey-login', methods=['POST'])
 def passkey_login():
     """Passkey authentication endpoint"""
+    from webauthn import generate_authentication_options, verify_authentication_response
+    from webauthn.helpers.structs import UserVerificationRequirement
     try:
         data = request.get_json()
         
@@ -440,49 +453,34 @@ def passkey_login():
             if not challenge:
                 return jsonify({'error': 'No active challenge'}), 400
             
-            # Find user by credential ID
-            credential_id = data.get('id')
-            conn = sqlite3.connect('secure_app.db')
-            c = conn.cursor()
-            c.execute('''SELECT user_id, public_key, sign_count FROM user_passkeys 
-                         WHERE credential_id = ?''', (credential_id,))
-            passkey_data = c.fetchone()
+            # Find passkey by binary credential ID (one indexed read)
+            credential_key = decode_credential_id(data.get('rawId') or data.get('id'))
+            passkey = get_passkey(credential_key) if credential_key else None
             
-            if not passkey_data:
+            if not passkey:
                 return jsonify({'error': 'Passkey not found'}), 400
             
-            user_id, public_key, sign_count = passkey_data
-            
             # Verify authentication response
             verification = verify_authentication_response(
                 credential=data,
                 expected_challenge=challenge,
                 expected_origin=WEBAUTHN_ORIGIN,
                 expected_rp_id=WEBAUTHN_RP_ID,
-                credential_public_key=base64.b64decode(public_key),
-                credential_current_sign_count=sign_count
+                credential_public_key=passkey['public_key'],
+                credential_current_sign_count=passkey['sign_count']
             )
             
             if verification.verified:
-                # Update sign count
-                c.execute('UPDATE user_passkeys SET sign_count = ?, last_used = CURRENT_TIMESTAMP WHERE credential_id = ?',
-                          (verification.new_sign_count, credential_id))
+                # Sign count and last_used are written by the background writer
+                record_passkey_use(credential_key, verification.new_sign_count)
                 
-                # Get username
-                c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-                user = c.fetchone()
-                conn.commit()
-                conn.close()
+                # Complete login
+                session.pop('passkey_auth_challenge', None)
+                step = complete_login(passkey)
+                redirect_url = url_for('auth.reset_password') if step == STEP_RESET else url_for('dashboard')
                 
-                if user:
-                    # Complete login
-                    session['user_id'] = user_id
-                    session['username'] = user[0]
-                    session.pop('passkey_auth_challenge', None)
-                    
-                    return jsonify({'verified': True, 'redirect': url_for('dashboard')})
+                return jsonify({'verified': True, 'redirect': redirect_url})
             
-            conn.close()
             return jsonify({'error': 'Authentication failed'}), 400
             
     except Exception as e:
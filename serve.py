@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Production server for SecureVault
+
+Runs the app under gunicorn (Linux/macOS) or waitress (Windows, or when
+gunicorn isn't installed) instead of the single-process Werkzeug dev server.
+
+    python serve.py                          # defaults, see --help
+    python serve.py --workers 4 --threads 8
+    SECUREVAULT_WORKERS=4 python serve.py    # every option also has an env var
+
+App settings (SECUREVAULT_DATABASE, SECUREVAULT_UPLOAD_FOLDER, SECRET_KEY) are
+read by create_app in app.py.
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+def _env(name, default):
+    return os.environ.get(f'SECUREVAULT_{name}', default)
+
+def default_worker_class():
+    # gevent workers hold a slow client in a cheap greenlet instead of a thread
+    try:
+        import gevent  # noqa: F401
+        return 'gevent'
+    except ImportError:
+        return 'gthread'
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run SecureVault with a production WSGI server')
+    parser.add_argument('--host', default=_env('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(_env('PORT', 5000)))
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'waitress'], default=_env('SERVER', 'auto'),
+                        help='auto uses gunicorn when it is available')
+    parser.add_argument('--workers', type=int, default=int(_env('WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+                        help='gunicorn worker processes (default: 2 x CPUs + 1)')
+    parser.add_argument('--threads', type=int, default=int(_env('THREADS', 8)),
+                        help='threads per worker process')
+    parser.add_argument('--worker-class', default=_env('WORKER_CLASS', default_worker_class()),
+                        help='gunicorn worker class: gevent (default when installed) or gthread')
+    parser.add_argument('--connections', type=int, default=int(_env('CONNECTIONS', 1000)),
+                        help='max open connections per worker (gevent) or in total (waitress)')
+    parser.add_argument('--timeout', type=int, default=int(_env('TIMEOUT', 120)),
+                        help='seconds before a stuck request is killed')
+    parser.add_argument('--access-log', action='store_true', default=_env('ACCESS_LOG', '') == '1')
+    return parser.parse_args(argv)
+
+def run_gunicorn(app, args):
+    from gunicorn.app.base import BaseApplication
+    from app import start_background_workers
+
+    class SecureVaultServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    options = {
+        'bind': f'{args.host}:{args.port}',
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': args.worker_class,
+        'worker_connections': args.connections,
+        'timeout': args.timeout,
+        'graceful_timeout': 30,
+        'keepalive': 5,
+        # Import the app once in the master so workers share memory and configuration
+        'preload_app': True,
+        # Threads don't survive fork, so each worker starts its own
+        'post_fork': lambda server, worker: start_background_workers(),
+        'accesslog': '-' if args.access_log else None,
+    }
+    SecureVaultServer().run()
+
+def run_waitress(app, args):
+    from waitress import serve
+    from app import start_background_workers
+
+    start_background_workers()
+    # waitress buffers request and response bodies in its I/O thread, so a
+    # slow client ties up a buffer rather than one of the worker threads
+    serve(app, host=args.host, port=args.port, threads=args.threads,
+          connection_limit=args.connections, channel_timeout=args.timeout,
+          ident='SecureVault')
+
+def main(argv):
+    args = parse_args(argv)
+
+    server = args.server
+    if server == 'auto':
+        try:
+            import gunicorn  # noqa: F401
+            server = 'gunicorn'
+        except ImportError:
+            server = 'waitress'
+
+    if server == 'gunicorn' and args.worker_class == 'gevent':
+        # Patch before the app is preloaded, otherwise threads and locks created
+        # at import time are the unpatched ones
+        from gevent import monkey
+        monkey.patch_all()
+
+    from app import create_app
+    from database import init_db
+    from security import init_security_db
+    from fragments import warm_templates
+
+    app = create_app()
+    # Schema changes run once here, not in every worker
+    init_db()
+    init_security_db()
+    # Compiled before forking so every worker shares them
+    warm_templates(app)
+
+    print(f"🚀 SecureVault on http://{args.host}:{args.port} ({server})")
+    if server == 'gunicorn' and args.worker_class == 'gthread':
+        print("⚠️  gthread workers give each connection a thread until it finishes, so slow "
+              "clients can use them all up. Install gevent or put a buffering proxy in front.")
+    if server == 'gunicorn':
+        run_gunicorn(app, args)
+    else:
+        run_waitress(app, args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
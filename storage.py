@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Storage backends for uploaded files
+
+Every file row has a storage_backend name and a key (kept in files.file_path).
+Rows from before backends existed have no backend name and a file_path on the
+local disk; they are read through the 'legacy' backend.
+
+Backends are set up by create_app from the app config:
+    STORAGE_BACKEND      backend new uploads go to: local (default), sharded or s3
+    UPLOAD_FOLDER        root directory of the local backend
+    STORAGE_VOLUMES      sharded backend, {'name': '/mount/point', ...} or 'name=/path,name2=/path2'
+    STORAGE_S3_BUCKET    s3 backend (needs boto3), plus optional STORAGE_S3_PREFIX,
+    STORAGE_S3_ENDPOINT  STORAGE_S3_ENDPOINT for MinIO or other S3-compatible servers
+                         and STORAGE_S3_REGION. Credentials come from the usual AWS env vars.
+
+Move existing files between backends with:
+    python storage.py migrate <target backend> [--from <backend>]
+"""
+
+import os
+import io
+import sys
+import shutil
+import hashlib
+import argparse
+import threading
+
+# Bytes copied at a time when streaming between backends
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class StorageError(Exception):
+    """Raised when a backend is missing, misconfigured or a file can't be found"""
+
+class LocalStorage:
+    """Files in one directory"""
+
+    def __init__(self, name, root):
+        self.name = name
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def new_key(self, filename):
+        return filename
+
+    def open_write(self, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return open(path, 'wb')
+
+    def open_read(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise StorageError(f'{self.name}: {key} not found')
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+class ShardedStorage(LocalStorage):
+    """Files spread over several volumes. New files go to the volume with the
+    most free space; the volume name is part of the key, so volumes can be
+    added later without moving anything."""
+
+    def __init__(self, name, volumes):
+        self.name = name
+        self.volumes = volumes
+
+    def path(self, key):
+        volume, _, rest = key.partition('/')
+        if volume not in self.volumes:
+            raise StorageError(f'{self.name}: unknown volume {volume}')
+        return os.path.join(self.volumes[volume], rest)
+
+    def new_key(self, filename):
+        volume = max(self.volumes, key=lambda v: shutil.disk_usage(self.volumes[v]).free)
+        # Two levels of fan-out keep directories small
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        return f'{volume}/{digest[:2]}/{digest[2:4]}/{filename}'
+
+class _S3Writer(io.RawIOBase):
+    """Writable stream that uploads to S3 in parts as data arrives"""
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=data)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                # Small file, one request
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._upload_part(bytes(self.buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                      MultipartUpload={'Parts': self.parts})
+        finally:
+            self.buffer = bytearray()
+            super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Store nothing rather than a truncated file
+            if self.upload_id is not None:
+                # Don't leave half an upload (and its storage bill) behind
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+                self.upload_id = None
+            self.buffer = bytearray()
+            super().close()
+            return False
+        return super().__exit__(exc_type, exc, tb)
+
+class _S3Reader(io.RawIOBase):
+    """Seekable stream over an S3 object using ranged GETs with read-ahead,
+    so decrypting a byte range only downloads the chunks it needs"""
+
+    def __init__(self, client, bucket, key, size, read_ahead):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.length = size
+        self.read_ahead = read_ahead
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = min(size, self.length - self.position)
+        if size <= 0:
+            return b''
+
+        offset = self.position - self.buffer_start
+        if offset < 0 or offset + size > len(self.buffer):
+            fetch = max(size, self.read_ahead)
+            end = min(self.position + fetch, self.length) - 1
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                              Range=f'bytes={self.position}-{end}')
+            self.buffer = response['Body'].read()
+            self.buffer_start = self.position
+            offset = 0
+
+        data = self.buffer[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class S3Storage:
+    """Files in an S3 bucket (or anything that speaks the S3 API, like MinIO)"""
+
+    # S3 needs multipart parts of at least 5MB
+    PART_SIZE = 8 * 1024 * 1024
+    READ_AHEAD = 1024 * 1024
+
+    def __init__(self, name, bucket, prefix='', endpoint_url=None, region=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise StorageError('The s3 storage backend needs boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        self.name = name
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def new_key(self, filename):
+        return self.prefix + filename
+
+    def open_write(self, key):
+        return _S3Writer(self.client, self.bucket, key, self.PART_SIZE)
+
+    def open_read(self, key):
+        return _S3Reader(self.client, self.bucket, key, self.size(key), self.READ_AHEAD)
+
+    def size(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except ClientError:
+            raise StorageError(f'{self.name}: {key} not found')
+
+    def exists(self, key):
+        try:
+            self.size(key)
+            return True
+        except StorageError:
+            return False
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+_backends = {}
+_s3_config = {}
+_default_backend = 'local'
+_lock = threading.Lock()
+
+def _parse_volumes(volumes):
+    if isinstance(volumes, str):
+        volumes = dict(item.split('=', 1) for item in volumes.split(',') if item.strip())
+    return {name.strip(): path.strip() for name, path in volumes.items()}
+
+def configure_storage(config):
+    """Set up the backends from the app config (see the module docstring)"""
+    global _default_backend
+    backends = {
+        'legacy': LocalStorage('legacy', ''),
+        'local': LocalStorage('local', config['UPLOAD_FOLDER']),
+    }
+    if config.get('STORAGE_VOLUMES'):
+        volumes = _parse_volumes(config['STORAGE_VOLUMES'])
+        for path in volumes.values():
+            os.makedirs(path, exist_ok=True)
+        backends['sharded'] = ShardedStorage('sharded', volumes)
+
+    with _lock:
+        _backends.clear()
+        _backends.update(backends)
+        _default_backend = config.get('STORAGE_BACKEND') or 'local'
+        # The S3 client is created when first used, so boto3 is only imported if needed
+        _s3_config.clear()
+        if config.get('STORAGE_S3_BUCKET'):
+            _s3_config.update(bucket=config['STORAGE_S3_BUCKET'],
+                              prefix=config.get('STORAGE_S3_PREFIX', ''),
+                              endpoint_url=config.get('STORAGE_S3_ENDPOINT') or None,
+                              region=config.get('STORAGE_S3_REGION') or None)
+
+def register_backend(backend):
+    """Add or replace a backend, e.g. an S3Storage with a custom client"""
+    with _lock:
+        _backends[backend.name] = backend
+
+def get_storage(name=None):
+    """Backend by name, or the one new uploads go to. Legacy rows have name None
+    when read from the database, so pass 'legacy' for those (see storage_for)."""
+    name = name or _default_backend
+    with _lock:
+        if name not in _backends and name == 's3' and _s3_config:
+            _backends['s3'] = S3Storage('s3', **_s3_config)
+        if name not in _backends:
+            raise StorageError(f'Storage backend {name!r} is not configured')
+        return _backends[name]
+
+def storage_for(backend_name, key):
+    """(backend, key) for a files row's storage_backend and file_path"""
+    return get_storage(backend_name or 'legacy'), key
+
+def copy_stream(source, dest, chunk_size=COPY_CHUNK_SIZE):
+    size = 0
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        dest.write(chunk)
+        size += len(chunk)
+    return size
+
+def migrate_files(target, source=None, batch_size=100, log=print):
+    """Copy every file (optionally only those on source) to the target backend,
+    switch its row over and delete the old copy. Safe to stop and rerun."""
+    from database import connect
+
+    target_backend = get_storage(target)
+    moved = failed = 0
+    last_id = 0
+    while True:
+        conn = connect()
+        c = conn.cursor()
+        query = '''SELECT id, filename, file_path, storage_backend FROM files
+                   WHERE id > ? AND COALESCE(storage_backend, 'legacy') != ?'''
+        params = [last_id, target]
+        if source:
+            query += " AND COALESCE(storage_backend, 'legacy') = ?"
+            params.append(source)
+        c.execute(query + ' ORDER BY id LIMIT ?', params + [batch_size])
+        rows = c.fetchall()
+        conn.close()
+        if not rows:
+            break
+
+        for file_id, filename, key, backend_name in rows:
+            last_id = file_id
+            old_backend, old_key = storage_for(backend_name, key)
+            new_key = target_backend.new_key(filename)
+            try:
+                with old_backend.open_read(old_key) as src, target_backend.open_write(new_key) as dest:
+                    copied = copy_stream(src, dest)
+                if target_backend.size(new_key) != copied:
+                    raise StorageError(f'size mismatch after copying file {file_id}')
+            except (StorageError, OSError) as e:
+                log(f"❌ File {file_id}: {e}")
+                failed += 1
+                continue
+
+            # Only switch rows nobody changed or deleted while we copied
+            conn = connect()
+            c = conn.cursor()
+            c.execute('''UPDATE files SET storage_backend = ?, file_path = ?
+                         WHERE id = ? AND file_path = ? AND storage_backend IS ?''',
+                      (target, new_key, file_id, key, backend_name))
+            switched = c.rowcount == 1
+            conn.commit()
+            conn.close()
+
+            if switched:
+                old_backend.delete(old_key)
+                moved += 1
+            else:
+                target_backend.delete(new_key)
+        log(f"… {moved} moved, {failed} failed (up to file {last_id})")
+
+    return moved, failed
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Manage SecureVault file storage')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help='move files to another backend')
+    migrate.add_argument('target', help='local, sharded or s3')
+    migrate.add_argument('--from', dest='source', help='only move files on this backend (legacy for old rows)')
+    migrate.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    create_app()
+
+    moved, failed = migrate_files(args.target, args.source, args.batch_size)
+    print(f"✅ Moved {moved} files to {args.target}" + (f", {failed} failed" if failed else ''))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,47 @@
+from database import connect
+
+# Changes returned per request, clients page with the returned cursor
+CHANGES_PAGE_SIZE = 500
+MAX_CHANGES_PAGE_SIZE = 5000
+
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+
+# change_log keeps one row per note/file: recording a change replaces the row
+# with a new, higher seq. Deletes stay behind as tombstones, so a client that
+# last synced at cursor N only needs the rows with seq > N. Writes to SQLite
+# are serialized, so seqs become visible in order and a cursor never skips one.
+
+def record_change(c, user_id, entity, entity_id, op=OP_UPSERT):
+    """Log a change to a note or file, inside the caller's transaction"""
+    c.execute('''INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, op)
+                 VALUES (?, ?, ?, ?)''', (user_id, entity, entity_id, op))
+
+def record_changes(c, user_id, entity, entity_ids, op=OP_UPSERT):
+    c.executemany('''INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, op)
+                     VALUES (?, ?, ?, ?)''', [(user_id, entity, entity_id, op) for entity_id in entity_ids])
+
+def changes_since(user_id, cursor=0, limit=CHANGES_PAGE_SIZE):
+    """Changes for a user after cursor, oldest first.
+    Returns (rows, next cursor, whether more are waiting). Each row is
+    (seq, entity, entity_id, op, note title, note updated_at, note content,
+     file name, file size, file uploaded_at, user key, previous user key)."""
+    conn = connect()
+    c = conn.cursor()
+    # Fetch one extra row to know if there's another page
+    c.execute('''SELECT l.seq, l.entity, l.entity_id, l.op,
+                        n.title, n.updated_at, n.content,
+                        f.original_filename, f.file_size, f.uploaded_at,
+                        u.encryption_key, u.previous_encryption_key
+                 FROM change_log l
+                 JOIN users u ON l.user_id = u.id
+                 LEFT JOIN notes n ON l.entity = 'note' AND n.id = l.entity_id
+                 LEFT JOIN files f ON l.entity = 'file' AND f.id = l.entity_id
+                 WHERE l.user_id = ? AND l.seq > ?
+                 ORDER BY l.seq LIMIT ?''', (user_id, cursor, limit + 1))
+    rows = c.fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, rows[-1][0] if rows else cursor, has_more
@@ -47,10 +47,17 @@ def generate_secure_filename(user_id, original_filename):
     unique_id = secrets.token_hex(8)
     return f"{user_id}_{unique_id}_{secure_name}"
 
+def file_extension(filename):
+    """Lowercase extension without the dot, '' if there isn't one"""
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+def escape_like(text):
+    """Escape text for use in a LIKE pattern with ESCAPE '\\'"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
 def allowed_file_type(filename, allowed_extensions):
     """Check if file type is allowed"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+    return file_extension(filename) in allowed_extensions
 
 def create_directory_if_not_exists(directory):
     """Create directory if it doesn't exist"""
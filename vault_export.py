@@ -0,0 +1,363 @@
+import sys
+import json
+import secrets
+import zipfile
+from datetime import datetime
+from urllib.parse import quote
+from werkzeug.utils import secure_filename
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, Response, stream_with_context
+from auth import login_required
+from admin import admin_required
+from notes import encrypt_text, decrypt_text
+from files import allowed_file
+from sync import record_changes
+from activity import log_activity
+from storage import get_storage, storage_for, StorageError
+from quotas import charge, would_exceed, QuotaExceeded
+from previews import HashingReader, can_preview, queue_previews, PREVIEW_PENDING
+from filetypes import check_upload, FileTypeError
+from file_crypto import generate_file_key, unwrap_file_key, encrypt_stream, decrypt_range
+from database import connect
+
+export_bp = Blueprint('export', __name__)
+
+# Notes read from the database at a time when exporting
+EXPORT_BATCH_SIZE = 500
+
+# Rows inserted per transaction when importing
+IMPORT_BATCH_SIZE = 1000
+
+# Bytes read from a file at a time when copying it into an archive
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Already compressed formats are stored in the archive as-is
+STORED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar', 'docx'}
+
+# Fields each manifest line must have as strings, and the ones that may also be missing or null
+MANIFEST_FIELDS = {
+    'notes.jsonl': (('title', 'content'), ('created_at', 'updated_at')),
+    'files.jsonl': (('name', 'path'), ('uploaded_at',)),
+}
+
+class _ChunkBuffer:
+    """Write-only file object that zipfile writes into and we drain into the response"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def _archive_entry(name, extension):
+    info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+    info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+    return info
+
+def _file_member(file_id, original_filename):
+    """Archive path for an uploaded file. Original names can hold ../ or an
+    absolute path, so only a sanitised one goes in the path (files.jsonl keeps
+    the real name)"""
+    return f'files/{file_id}/{secure_filename(original_filename) or "file"}'
+
+def generate_vault_archive(user_id):
+    """Yield a zip of a user's notes and files, decrypting everything as it goes"""
+    buffer = _ChunkBuffer()
+    conn = connect()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT encryption_key, previous_encryption_key FROM users WHERE id = ?', (user_id,))
+        key, previous_key = c.fetchone()
+
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            # One JSON object per line, so neither side has to hold every note at once
+            with archive.open(_archive_entry('notes.jsonl', 'jsonl'), 'w', force_zip64=True) as entry:
+                # Read in batches so we don't hold a read lock while the client downloads
+                last_id = 0
+                while True:
+                    c.execute('''SELECT id, title, content, created_at, updated_at FROM notes
+                                 WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+                              (user_id, last_id, EXPORT_BATCH_SIZE))
+                    notes = c.fetchall()
+                    if not notes:
+                        break
+                    for note_id, title, content, created_at, updated_at in notes:
+                        entry.write((json.dumps({
+                            'id': note_id,
+                            'title': title,
+                            'content': decrypt_text(content, key, previous_key),
+                            'created_at': created_at,
+                            'updated_at': updated_at
+                        }) + '\n').encode())
+                        yield from buffer.drain()
+                    last_id = notes[-1][0]
+
+            c.execute('''SELECT id, original_filename, file_path, file_size, file_key, uploaded_at, storage_backend
+                         FROM files WHERE user_id = ? ORDER BY id''', (user_id,))
+            files = c.fetchall()
+
+            with archive.open(_archive_entry('files.jsonl', 'jsonl'), 'w') as entry:
+                for file_id, original_filename, _, file_size, _, uploaded_at, _ in files:
+                    entry.write((json.dumps({
+                        'name': original_filename,
+                        'path': _file_member(file_id, original_filename),
+                        'size': file_size,
+                        'uploaded_at': uploaded_at
+                    }) + '\n').encode())
+            yield from buffer.drain()
+
+            for file_id, original_filename, file_path, _, file_key, _, backend_name in files:
+                storage, storage_key = storage_for(backend_name, file_path)
+                if not storage.exists(storage_key):
+                    continue
+                extension = original_filename.rsplit('.', 1)[-1].lower()
+                name = _file_member(file_id, original_filename)
+                with archive.open(_archive_entry(name, extension), 'w', force_zip64=True) as entry, \
+                     storage.open_read(storage_key) as f:
+                    if file_key:
+                        chunks = decrypt_range(f, unwrap_file_key(file_key, key, previous_key))
+                    else:
+                        chunks = iter(lambda: f.read(COPY_CHUNK_SIZE), b'')
+                    for chunk in chunks:
+                        entry.write(chunk)
+                        yield from buffer.drain()
+
+        yield from buffer.drain()
+    finally:
+        conn.close()
+
+def import_vault_archive(user_id, archive_file):
+    """Add the notes and files from an export archive to a user's vault.
+    Returns (notes imported, files imported)."""
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT encryption_key FROM users WHERE id = ?', (user_id,))
+    key = c.fetchone()[0]
+
+    storage = get_storage()
+    notes_imported = 0
+    files_imported = 0
+    # Only this import's files, not everything else still waiting for a preview
+    preview_ids = []
+    written_keys = []
+    try:
+        with zipfile.ZipFile(archive_file) as archive:
+            names = set(archive.namelist())
+            # Reject a bad manifest before anything is imported
+            _check_manifest(archive, names)
+
+            if 'notes.jsonl' in names:
+                batch = []
+                with archive.open('notes.jsonl') as entry:
+                    for line in entry:
+                        if not line.strip():
+                            continue
+                        note = json.loads(line)
+                        batch.append((user_id, note['title'], encrypt_text(note['content'], key),
+                                      note.get('created_at'), note.get('updated_at')))
+                        if len(batch) >= IMPORT_BATCH_SIZE:
+                            notes_imported += _insert_notes(c, user_id, batch)
+                            conn.commit()
+                            batch = []
+                notes_imported += _insert_notes(c, user_id, batch)
+                conn.commit()
+
+            if 'files.jsonl' in names:
+                batch = []
+                batch_bytes = 0
+                with archive.open('files.jsonl') as entry:
+                    for line in entry:
+                        if not line.strip():
+                            continue
+                        meta = json.loads(line)
+                        if meta['path'] not in names or not allowed_file(meta['name']):
+                            continue
+
+                        # Stop before writing anything the quota can't take, charge() only
+                        # runs per batch so it would come after the whole batch was stored
+                        entry_size = archive.getinfo(meta['path']).file_size
+                        if would_exceed(c, user_id, batch_bytes + entry_size):
+                            raise QuotaExceeded('Storage quota exceeded')
+
+                        with archive.open(meta['path']) as entry_file:
+                            # Same content check as a normal upload, skip files that fail it
+                            try:
+                                mime_type, stream = check_upload(meta['name'], entry_file)
+                            except FileTypeError:
+                                continue
+
+                            filename = secure_filename(f"{user_id}_{secrets.token_hex(8)}_{meta['name']}")
+                            storage_key = storage.new_key(filename)
+                            file_key, wrapped_key = generate_file_key(key)
+                            written_keys.append(storage_key)
+                            with storage.open_write(storage_key) as dest:
+                                source = HashingReader(stream)
+                                file_size = encrypt_stream(source, dest, file_key)
+
+                        batch.append((user_id, filename, meta['name'], storage_key, file_size,
+                                      wrapped_key, meta.get('uploaded_at'), storage.name, source.hexdigest(),
+                                      PREVIEW_PENDING if can_preview(meta['name']) else None, mime_type))
+                        batch_bytes += file_size
+                        if len(batch) >= IMPORT_BATCH_SIZE:
+                            files_imported += _insert_files(c, user_id, batch, preview_ids)
+                            conn.commit()
+                            written_keys = []
+                            batch = []
+                            batch_bytes = 0
+                files_imported += _insert_files(c, user_id, batch, preview_ids)
+                conn.commit()
+                written_keys = []
+    except Exception:
+        # Don't leave encrypted files behind for rows that were never saved
+        conn.rollback()
+        for storage_key in written_keys:
+            try:
+                storage.delete(storage_key)
+            except (StorageError, OSError):
+                pass
+        raise
+    finally:
+        conn.close()
+        # Batches committed before a failure (say the quota running out) still get theirs
+        if preview_ids:
+            queue_previews(preview_ids)
+
+    return notes_imported, files_imported
+
+def _check_manifest(archive, names):
+    """Raise ValueError unless every manifest line is an object with the right field types"""
+    for manifest, (required, optional) in MANIFEST_FIELDS.items():
+        if manifest not in names:
+            continue
+        with archive.open(manifest) as entry:
+            for line in entry:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if (not isinstance(item, dict)
+                        or not all(isinstance(item.get(field), str) for field in required)
+                        or not all(isinstance(item.get(field), (str, type(None))) for field in optional)):
+                    raise ValueError(f'Malformed entry in {manifest}')
+
+def _insert_notes(c, user_id, batch):
+    if not batch:
+        return 0
+    # One INSERT per row for its id, the ids of rows others insert meanwhile aren't ours to log
+    note_ids = []
+    for row in batch:
+        c.execute('''INSERT INTO notes (user_id, title, content, created_at, updated_at)
+                     VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))''', row)
+        note_ids.append(c.lastrowid)
+    record_changes(c, user_id, 'note', note_ids)
+    log_activity('vault_imported', f'{len(batch)} notes', user_id=user_id, c=c)
+    return len(batch)
+
+def _insert_files(c, user_id, batch, preview_ids):
+    if not batch:
+        return 0
+    # Raises QuotaExceeded, which rolls back this batch and removes its files
+    charge(c, user_id, sum(row[4] for row in batch))
+    file_ids = []
+    for row in batch:
+        c.execute('''INSERT INTO files (user_id, filename, original_filename, file_path, file_size, file_key,
+                                        uploaded_at, storage_backend, content_hash, preview_status, mime_type)
+                     VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?)''', row)
+        file_ids.append(c.lastrowid)
+        if row[9] == PREVIEW_PENDING:
+            preview_ids.append(c.lastrowid)
+    record_changes(c, user_id, 'file', file_ids)
+    log_activity('vault_imported', f'{len(batch)} files', user_id=user_id, c=c)
+    return len(batch)
+
+def vault_archive_response(user_id, username):
+    """Streaming download response for a user's vault, logged as done by whoever asked"""
+    log_activity('vault_exported', f'user {user_id} ({username})')
+    download_name = f"securevault-{username}-{datetime.now().strftime('%Y%m%d')}.zip"
+    return Response(stream_with_context(generate_vault_archive(user_id)), mimetype='application/zip',
+                    headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"})
+
+@export_bp.route('/export')
+@login_required
+def export_vault():
+    return vault_archive_response(session['user_id'], session['username'])
+
+@export_bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_vault():
+    if request.method == 'POST':
+        archive = request.files.get('archive')
+        if not archive or archive.filename == '':
+            flash('No archive selected', 'error')
+            return redirect(request.url)
+
+        try:
+            notes_imported, files_imported = import_vault_archive(session['user_id'], archive.stream)
+        except (zipfile.BadZipFile, ValueError, KeyError):
+            flash('That file is not a SecureVault export', 'error')
+            return redirect(request.url)
+        except QuotaExceeded as e:
+            flash(f'{e}, the import stopped part way through', 'error')
+            return redirect(request.url)
+
+        flash(f'Imported {notes_imported} notes and {files_imported} files', 'success')
+        return redirect(url_for('dashboard'))
+
+    return render_template('import_vault.html')
+
+@export_bp.route('/admin/users/<int:user_id>/export')
+@admin_required
+def admin_export_vault(user_id):
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+    user = c.fetchone()
+    conn.close()
+
+    if not user:
+        flash('User not found', 'error')
+        return redirect(url_for('admin.manage_users'))
+
+    return vault_archive_response(user_id, user[0])
+
+def main(argv):
+    """Command line export/import: vault_export.py export|import <username> <archive.zip>"""
+    if len(argv) != 4 or argv[1] not in ('export', 'import'):
+        print("Usage: python vault_export.py export|import <username> <archive.zip>")
+        return 1
+
+    command, username, path = argv[1:]
+    from app import create_app
+    create_app()
+    conn = connect()
+    c = conn.cursor()
+    c.execute('SELECT id FROM users WHERE username = ?', (username,))
+    user = c.fetchone()
+    conn.close()
+
+    if not user:
+        print(f"❌ User not found: {username}")
+        return 1
+
+    if command == 'export':
+        with open(path, 'wb') as f:
+            for chunk in generate_vault_archive(user[0]):
+                f.write(chunk)
+        print(f"✅ Exported {username} to {path}")
+    else:
+        try:
+            with open(path, 'rb') as f:
+                notes_imported, files_imported = import_vault_archive(user[0], f)
+        except QuotaExceeded as e:
+            print(f"❌ {e}, the import stopped part way through")
+            return 1
+        print(f"✅ Imported {notes_imported} notes and {files_imported} files into {username}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))